@@ -0,0 +1,273 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Automatic allocation of the gamers of a game session to its tables.
+
+    The gamers wish to play at some tables ('possible' attendances). The
+    allocation grants as many wishes as it can while every table keeps a
+    valid number of players (within min_part / max_part and among the player
+    counts of its game) and no gamer gets two overlapping tables. A table
+    that cannot gather enough players is left closed.
+
+    The seated gamers are kept where they are : they take seats and the time
+    of their tables. The problem is NP-hard in general (the time overlaps),
+    so the solver is a greedy pass followed by a local search :
+
+    - the gamers with the fewest wishes are placed first ;
+    - the tables with an invalid number of players are completed from their
+      unplaced wishers, or emptied down to a valid number ;
+    - then, until nothing improves or the time is up, the tables take more
+      wishers when the next valid number of players can be reached, and a
+      full table takes a wisher by moving one of its gamers to another of
+      their wishes (an ejection chain of length one).
+
+    Every move keeps the allocation valid and grants one more wish, so the
+    search always ends.
+"""
+import time
+from collections import namedtuple, defaultdict
+
+from sqlalchemy import and_, or_, bindparam
+
+from gamesess.models import GameTable, GamePlayers, Attendance, MAX_PLAYERS
+from gamesess.models import ATTENDANCE_SEATED, ATTENDANCE_WISH
+
+# a table as seen by the solver : `counts` are its valid numbers of players,
+# `fixed` the number of gamers already seated
+TableSlot = namedtuple('TableSlot', 'id begin end counts fixed')
+Allocation = namedtuple('Allocation', 'session_id assignments unsatisfied closed')
+
+
+def player_counts(table, game_counts=None):
+    """ The valid numbers of players of a table, in increasing order """
+    low = table.min_part or 1
+    high = table.max_part or MAX_PLAYERS
+    return [count for count in sorted(game_counts or range(low, high + 1))
+            if low <= count <= high]
+
+
+def _overlap(first, second):
+    """ True when two scheduled (begin, end) intervals overlap """
+    return (first[0] is not None and first[1] is not None and
+            second[0] is not None and second[1] is not None and
+            first[0] < second[1] and second[0] < first[1])
+
+
+class AllocationSolver(object):
+    """ Places gamers at tables from their wishes.
+
+        `tables` are TableSlot, `wishes` (gamer_id, table_id) pairs in order
+        of preference, `busy` the (begin, end) intervals already booked by
+        each gamer.
+    """
+
+    def __init__(self, tables, wishes, busy=None, time_limit=5.0):
+        self.tables = dict((table.id, table) for table in tables)
+        self.counts = dict((table.id, frozenset(table.counts)) for table in tables)
+        self.busy = busy or {}
+        self.time_limit = time_limit
+        self.seated = dict((table.id, []) for table in tables)
+        self.playing = defaultdict(set)
+        self.wishers = defaultdict(list)
+        self.gamer_wishes = defaultdict(list)
+        self.wishes = wishes
+        for gamer_id, table_id in wishes:
+            table = self.tables.get(table_id)
+            if table is not None and table.counts and table.counts[-1] > table.fixed:
+                self.wishers[table_id].append(gamer_id)
+                self.gamer_wishes[gamer_id].append(table_id)
+
+    def size(self, table_id):
+        return self.tables[table_id].fixed + len(self.seated[table_id])
+
+    def room(self, table_id):
+        return self.tables[table_id].counts[-1] - self.size(table_id)
+
+    def valid(self, table_id, size=None):
+        """ An open table has a valid number of players. A table without
+            any placed gamer stays as it is.
+        """
+        if size is None:
+            size = self.size(table_id)
+        return size == self.tables[table_id].fixed or size in self.counts[table_id]
+
+    def free(self, gamer_id, table_id, leaving=None):
+        """ True when the gamer can play at the table : not there yet and
+            no overlap with their other tables (but `leaving`)
+        """
+        if table_id in self.playing[gamer_id]:
+            return False
+        table = self.tables[table_id]
+        interval = (table.begin, table.end)
+        for other_id in self.playing[gamer_id]:
+            other = self.tables[other_id]
+            if other_id != leaving and _overlap(interval, (other.begin, other.end)):
+                return False
+        for busy in self.busy.get(gamer_id, ()):
+            if _overlap(interval, busy):
+                return False
+        return True
+
+    def place(self, gamer_id, table_id):
+        self.seated[table_id].append(gamer_id)
+        self.playing[gamer_id].add(table_id)
+
+    def remove(self, gamer_id, table_id):
+        self.seated[table_id].remove(gamer_id)
+        self.playing[gamer_id].discard(table_id)
+
+    def candidates(self, table_id):
+        """ The wishers of a table who could be placed at it """
+        return [gamer_id for gamer_id in self.wishers[table_id] if self.free(gamer_id, table_id)]
+
+    def greedy(self):
+        for gamer_id in sorted(self.gamer_wishes, key=lambda gamer_id: len(self.gamer_wishes[gamer_id])):
+            for table_id in self.gamer_wishes[gamer_id]:
+                if self.room(table_id) > 0 and self.free(gamer_id, table_id):
+                    self.place(gamer_id, table_id)
+
+    def repair(self):
+        """ Completes or empties the tables with an invalid number of players """
+        for table_id, table in self.tables.items():
+            if self.valid(table_id):
+                continue
+            size = self.size(table_id)
+            target = [count for count in table.counts if count > size]
+            candidates = self.candidates(table_id)
+            if target and target[0] - size <= len(candidates):
+                for gamer_id in candidates[:target[0] - size]:
+                    self.place(gamer_id, table_id)
+                continue
+            target = [count for count in table.counts if table.fixed < count < size]
+            target = target and target[-1] or table.fixed
+            # the last placed gamers leave first
+            while self.size(table_id) > target:
+                self.remove(self.seated[table_id][-1], table_id)
+
+    def grow(self, table_id):
+        """ Adds wishers up to the next reachable valid number of players """
+        size = self.size(table_id)
+        candidates = self.candidates(table_id)
+        for count in self.tables[table_id].counts:
+            if size < count <= size + len(candidates):
+                for gamer_id in candidates[:count - size]:
+                    self.place(gamer_id, table_id)
+                return count - size
+        return 0
+
+    def eject(self, table_id):
+        """ Makes room at a table for a wisher by moving a seated gamer to
+            another of their wishes
+        """
+        candidates = self.candidates(table_id)
+        if not candidates:
+            return 0
+        for gamer_id in self.seated[table_id]:
+            for other_id in self.gamer_wishes[gamer_id]:
+                if (other_id != table_id and self.room(other_id) > 0 and
+                        self.valid(other_id, self.size(other_id) + 1) and
+                        self.free(gamer_id, other_id, leaving=table_id)):
+                    self.remove(gamer_id, table_id)
+                    self.place(gamer_id, other_id)
+                    self.place(candidates[0], table_id)
+                    return 1
+        return 0
+
+    def improve(self, deadline):
+        improved = True
+        while improved and time.time() < deadline:
+            improved = False
+            for table_id in self.tables:
+                if self.grow(table_id) or (self.room(table_id) == 0 and self.eject(table_id)):
+                    improved = True
+
+    def solve(self, session_id=None):
+        deadline = time.time() + self.time_limit
+        self.greedy()
+        self.repair()
+        self.improve(deadline)
+        assignments = dict((table_id, list(gamer_ids))
+                           for table_id, gamer_ids in self.seated.items() if gamer_ids)
+        unsatisfied = [(gamer_id, table_id) for gamer_id, table_id in self.wishes
+                       if table_id not in self.playing[gamer_id]]
+        closed = [table_id for table_id, gamer_ids in self.wishers.items()
+                  if gamer_ids and not self.seated[table_id] and not self.tables[table_id].fixed]
+        return Allocation(session_id, assignments, unsatisfied, closed)
+
+
+def session_problem(session, session_id):
+    """ The tables, wishes and booked intervals of a game session, from
+        three queries : (tables, wishes, busy)
+    """
+    tables = session.query(GameTable)\
+        .filter(GameTable.session_id == session_id, GameTable.active == True)\
+        .order_by(GameTable.begin, GameTable.id)\
+        .all()
+    game_counts = defaultdict(list)
+    game_ids = set(table.game_id for table in tables if table.game_id is not None)
+    if game_ids:
+        for game_id, players in session.query(GamePlayers.game_id, GamePlayers.players)\
+                .filter(GamePlayers.game_id.in_(game_ids)):
+            game_counts[game_id].append(players)
+    by_id = dict((table.id, table) for table in tables)
+    fixed = defaultdict(int)
+    wishes = []
+    busy = defaultdict(list)
+    rows = session.query(Attendance.gamer_id, Attendance.table_id, Attendance.name)\
+        .join(GameTable, Attendance.table_id == GameTable.id)\
+        .filter(GameTable.session_id == session_id, GameTable.active == True,
+                Attendance.active == True)\
+        .order_by(Attendance.id)
+    for gamer_id, table_id, name in rows:
+        if name in ATTENDANCE_SEATED:
+            fixed[table_id] += 1
+            busy[gamer_id].append((by_id[table_id].begin, by_id[table_id].end))
+        elif name == ATTENDANCE_WISH:
+            wishes.append((gamer_id, table_id))
+    slots = [TableSlot(table.id, table.begin, table.end,
+                       player_counts(table, game_counts.get(table.game_id)), fixed[table.id])
+             for table in tables]
+    return slots, wishes, busy
+
+
+def allocate_session(session, session_id, time_limit=5.0):
+    """ Computes the allocation of the wishes of a game session, without
+        changing anything
+    """
+    tables, wishes, busy = session_problem(session, session_id)
+    return AllocationSolver(tables, wishes, busy, time_limit).solve(session_id)
+
+
+def apply_allocation(session, allocation):
+    """ Seats the gamers of an allocation (their wishes become confirmé) and
+        commits. Raises ValueError, without any change, when a table or a
+        wish changed since the allocation was computed : compute it again.
+    """
+    session.commit()
+    session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+    table = GameTable.__table__
+    attendance = Attendance.__table__
+    try:
+        for table_id, gamer_ids in allocation.assignments.items():
+            taken = len(gamer_ids)
+            result = session.execute(table.update()
+                .where(and_(table.c.id == table_id, table.c.active == True,
+                            or_(table.c.max_part == None,
+                                table.c.seats_taken + taken <= table.c.max_part)))
+                .values(seats_taken=table.c.seats_taken + taken))
+            if result.rowcount != 1:
+                raise ValueError(u'Table %i changed since the allocation' % table_id)
+            for gamer_id in gamer_ids:
+                result = session.execute(attendance.update()
+                    .where(and_(attendance.c.table_id == bindparam('t'),
+                                attendance.c.gamer_id == bindparam('g'),
+                                attendance.c.active == True,
+                                attendance.c.name == ATTENDANCE_WISH))
+                    .values(name=ATTENDANCE_SEATED[0], version=attendance.c.version + 1),
+                    {'t': table_id, 'g': gamer_id})
+                if result.rowcount != 1:
+                    raise ValueError(u'The wish of gamer %i at table %i changed since the allocation'
+                                     % (gamer_id, table_id))
+    except Exception:
+        session.rollback()
+        raise
+    session.commit()
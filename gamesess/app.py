@@ -1,108 +1,60 @@
-from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
-from flask import render_template, redirect, request, url_for, flash
-
-from gamesess.models import Base, Gamer, Club, Game, GameSession
-from gamesess.forms import LoginForm
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///gamesess_test1.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = 'guess_my_secret_and_difficult_key'
-
-db = SQLAlchemy(app)
-db.Model = Base
-
-from flask import session
-from flask.ext.login import LoginManager, current_user
-from flask.ext.login import login_user, logout_user, login_required
-
-# Flask-Login initialization
-login_manager = LoginManager()
-login_manager.setup_app(app)
-login_manager.login_view = 'login'
-
-@login_manager.user_loader
-def load_user(user_id):
-    """ Flask-Login hook to load a User instance from ID """
-    return db.session.query(Gamer).get(int(user_id))
-
-# Flask-Bootstrap initialization
-from flask.ext.bootstrap import Bootstrap
-bootstrap = Bootstrap(app)
-
-from werkzeug.security import generate_password_hash, check_password_hash
-# End of extensions initializations
-
-@app.route('/')
-def main():
-    return render_template('home.html')
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" The application factory.
+
+    Importing this module builds nothing : create_app builds an application
+    with the settings of an environment and binds the extensions to it. No
+    database engine is created before the first query, so a server forking
+    its workers after create_app (gunicorn --preload) opens the connections
+    in the workers. The compiled templates are kept in a bytecode cache on
+    disk, shared by the workers and across restarts.
+"""
+import os
 
-@app.route('/about')
-def about():
-    return str(current_user)+'Auth:'+str(current_user.is_authenticated)+'About Flask Game Club Sessions'
-
-@app.route('/clubs')
-@login_required
-def clubs_list():
-    clubs = db.session.query(Club).filter_by(public=True).order_by(Club.name).all()
-    return render_template('club_list.html',clubs = clubs)
-
-@app.route('/myclubs')
-@login_required
-def user_clubs_list():
-    return 'List of clubs for the current user'
-
-@app.route('/club/<int:club_id>/')
-@login_required
-def club_details(club_id):
-    return 'Details on club %i' % club_id
-
-@app.route('/session/<int:session_id>/')
-@app.route('/soiree/<int:session_id>/')
-@app.route('/weekend/<int:session_id>/')
-def session_details(session_id):
-    return 'Details on session %i' % session_id
-
-@app.route('/table/<int:table_id>/')
-def table_details(table_id):
-    return 'Details on table %i' % table_id
-
-@app.route('/gamer/<int:gamer_id>/')
-@login_required
-def gamer_details(gamer_id):
-    return 'Details on gamer %i' % gamer_id
-
-@app.route('/game/<int:game_id>/')
-def game_details(game_id):
-    return 'Details on game/scenario %i' % game_id
-
-@app.route('/get_image')
-def get_urban_image():
-    return 'image', 200, {'Content-Type':'image/jpeg'}
-
-# Flask-Login calls
-@app.route('/login', methods=['GET','POST'])
-def login():
-    if current_user and current_user.is_authenticated:
-        return redirect(url_for('clubs_list'))
-    form = LoginForm()
-    if form.validate_on_submit():
-        #user = Gamer.query.filter_by(email=form.email.data).first()
-        user = db.session.query(Gamer).filter_by(email=form.email.data).first()
-        if user is not None and user.verify_password(form.password.data):
-            login_user(user, form.remember_me.data)
-            return redirect(request.args.get('next') or '/')
-        flash('Invalid username or password.')
-    return render_template('login.html', form=form)
+from flask import Flask
+from jinja2 import FileSystemBytecodeCache
+
+from gamesess.config import load_config
+from gamesess.extensions import db, login_manager, bootstrap, response_cache, live_hub, image_store
+from gamesess.security import init_security
+from gamesess.identity import init_identity_cache
+from gamesess.metrics import instrumentation
+
+
+def _template_options(app):
+    """ Before anything creates the Jinja environment of the application """
+    options = dict(app.jinja_options, auto_reload=app.config['TEMPLATES_AUTO_RELOAD'])
+    directory = app.config.get('TEMPLATE_CACHE_DIR')
+    if directory:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        options['bytecode_cache'] = FileSystemBytecodeCache(directory)
+    app.jinja_options = options
+
+
+def create_app(config_name=None):
+    """ A new application with the settings of an environment : the name
+        of a gamesess.config.CONFIGS entry, GAMESESS_ENV by default
+    """
+    app = Flask(__name__)
+    load_config(app, config_name)
+    _template_options(app)
+    init_security(app)
+    init_identity_cache(app)
+    instrumentation.init_app(app)
+    response_cache.init_app(app)
+    live_hub.init_app(app)
+    image_store.init_app(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+    bootstrap.init_app(app)
+
+    from gamesess.views import main
+    from gamesess.auth import auth
+    app.register_blueprint(main)
+    app.register_blueprint(auth)
+    return app
 
-@app.route('/logout')
-@login_required
-def logout():
-    logout_user()
-    flash('You have been logged out.')
-    return redirect('/')
-# EOF Flask-Login class
 
 if __name__ == '__main__':
-    app.run('0.0.0.0',8002,debug=True)
+    create_app().run('0.0.0.0', 8002)
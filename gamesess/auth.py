@@ -0,0 +1,57 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Logging in and out, with Flask-Login """
+from flask import Blueprint
+from flask import render_template, redirect, request, url_for, flash
+from flask.ext.login import current_user, login_user, logout_user, login_required
+
+from gamesess.models import Gamer
+from gamesess.forms import LoginForm
+from gamesess.extensions import db, login_manager
+from gamesess.security import hasher, verifier, login_throttle
+from gamesess.identity import load_identity
+
+auth = Blueprint('auth', __name__)
+
+@login_manager.user_loader
+def load_user(user_id):
+    """ Flask-Login hook to load a User instance from ID """
+    return load_identity(db.session, int(user_id))
+
+@auth.route('/login', methods=['GET','POST'])
+def login():
+    if current_user and current_user.is_authenticated:
+        return redirect(url_for('main.clubs_list'))
+    form = LoginForm()
+    if form.validate_on_submit():
+        email = form.email.data
+        if login_throttle.is_blocked(email):
+            flash('Too many failed attempts, please try again later.')
+            return render_template('login.html', form=form), 429
+        #user = Gamer.query.filter_by(email=form.email.data).first()
+        user = db.session.query(Gamer).filter_by(email=email, active=True).first()
+        if user is None:
+            # a hash is checked all the same : unknown (or deactivated) emails answer as slowly
+            verified = verifier.verify(hasher, None, form.password.data)
+        else:
+            verified = user.verify_password(form.password.data)
+        if verified is None:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('login.html', form=form), 503
+        if verified:
+            login_throttle.reset(email)
+            if user.password_needs_rehash:
+                user.password = form.password.data
+                db.session.commit()
+            login_user(user, form.remember_me.data)
+            return redirect(request.args.get('next') or '/')
+        login_throttle.failure(email)
+        flash('Invalid username or password.')
+    return render_template('login.html', form=form)
+
+@auth.route('/logout')
+@login_required
+def logout():
+    logout_user()
+    flash('You have been logged out.')
+    return redirect('/')
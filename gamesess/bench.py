@@ -0,0 +1,816 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Helpers for the benchmarks run from manage.py : synthetic data and
+    SQL statement counting.
+"""
+import asyncore
+import os
+import random
+import smtpd
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, create_engine, distinct, event, func
+from sqlalchemy.orm import sessionmaker
+
+from gamesess.models import Base, Gamer, Club, GamerClub, GameSession, GameTable, Game, GamePlayers, Attendance
+from gamesess.models import ATTENDANCE_STATUSES, ATTENDANCE_SEATED, ATTENDANCE_WAITLIST, ATTENDANCE_WISH
+from gamesess.models import parse_parts
+
+
+class QueryCounter(object):
+    """ Counts the statements sent to an engine within a `with` block """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def memory_session(url='sqlite://'):
+    """ A session on a fresh database (in memory by default) """
+    from gamesess.database import wrap_cte
+    engine = wrap_cte(create_engine(url))
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def seed_agenda(session, tables=500, attendances=5000, seed=42):
+    """ One club, one session with `tables` tables and `attendances`
+        attendances spread over them. Returns the GameSession id.
+    """
+    rnd = random.Random(seed)
+    engine = session.get_bind()
+    per_table = max(attendances // max(tables, 1), 1)
+    gamers = max(per_table * 4, 100)
+    engine.execute(Gamer.__table__.insert(), [
+        {'id': i + 1, 'login': u'gamer%i' % i, 'last_name': u'GAMER', 'first_name': u'%i' % i,
+         'active': True} for i in range(gamers)])
+    engine.execute(Club.__table__.insert(), [{'id': 1, 'name': u'Bench club', 'public': True}])
+    engine.execute(Game.__table__.insert(), [
+        {'id': i + 1, 'name': u'Game %i' % i, 'parts': '2-6', 'average_duration': 60, 'active': True}
+        for i in range(50)])
+    begin = datetime(2017, 5, 26, 20, 0, 0)
+    engine.execute(GameSession.__table__.insert(), [
+        {'id': 1, 'name': u'Bench session', 'begin': begin, 'end': begin + timedelta(hours=4),
+         'club_id': 1, 'active': True}])
+    engine.execute(GameTable.__table__.insert(), [
+        {'id': i + 1, 'name': u'Table %i' % i, 'session_id': 1, 'game_id': rnd.randint(1, 50),
+         'min_part': 2, 'max_part': rnd.randint(3, per_table + 2), 'begin': begin,
+         'end': begin + timedelta(hours=2), 'active': True} for i in range(tables)])
+    rows = []
+    for table_id in range(1, tables + 1):
+        for gamer_id in rnd.sample(range(1, gamers + 1), per_table):
+            rows.append({'table_id': table_id, 'gamer_id': gamer_id, 'active': True,
+                         'name': rnd.choice(ATTENDANCE_STATUSES)})
+    engine.execute(Attendance.__table__.insert(), rows[:attendances])
+    return 1
+
+
+def timed(function, runs):
+    """ Runs `function` `runs` times : returns the durations in milliseconds """
+    durations = []
+    for i in range(runs):
+        start = time.time()
+        function()
+        durations.append((time.time() - start) * 1000.0)
+    return durations
+
+
+def seed_game_trees(session, depth=90, width=2000):
+    """ A chain of `depth` games (each one the expansion of the previous one)
+        and a game with `width` expansions spread over two levels.
+        Returns the ids of the deep root, the deep leaf and the wide root.
+    """
+    engine = session.get_bind()
+    rows = [{'id': 1, 'name': u'Deep 0', 'parts': '2-4', 'parent_id': None}]
+    rows.extend({'id': i + 1, 'name': u'Deep %i' % i, 'parts': '2-4', 'parent_id': i}
+                for i in range(1, depth))
+    wide_root = depth + 1
+    rows.append({'id': wide_root, 'name': u'Wide', 'parts': '2-4', 'parent_id': None})
+    first_level = max(width // 10, 1)
+    for i in range(width):
+        parent_id = i < first_level and wide_root or wide_root + 1 + i % first_level
+        rows.append({'id': wide_root + 1 + i, 'name': u'Wide %i' % i, 'parts': '2-4',
+                     'parent_id': parent_id})
+    engine.execute(Game.__table__.insert(), rows)
+    return 1, depth, wide_root
+
+
+def _write_worker(uri, config, tuned, seconds, worker, results):
+    """ Inserts attendances one transaction at a time for `seconds` seconds """
+    from sqlalchemy.exc import OperationalError
+    from gamesess.database import make_engine
+    if tuned:
+        engine = make_engine(uri, config)
+    else:
+        engine = create_engine(uri, connect_args={'timeout': 0})
+    table = Attendance.__table__
+    done = errors = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            with engine.begin() as connection:
+                connection.execute(table.insert(), {'table_id': worker, 'gamer_id': done + 1,
+                                                    'name': u'possible', 'active': True})
+            done += 1
+        except OperationalError:
+            # database is locked
+            errors += 1
+    results.put((done, errors))
+
+
+def bench_writes(path, config, workers=4, seconds=5, tuned=True):
+    """ Runs `workers` writing processes on a fresh SQLite file : returns
+        (writes, lock errors, writes per second)
+    """
+    from multiprocessing import Process, Queue
+    from gamesess.database import make_engine
+    if os.path.exists(path):
+        os.remove(path)
+    uri = 'sqlite:///%s' % path
+    engine = tuned and make_engine(uri, config) or create_engine(uri)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    results = Queue()
+    processes = [Process(target=_write_worker, args=(uri, config, tuned, seconds, worker + 1, results))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    totals = [results.get() for process in processes]
+    for process in processes:
+        process.join()
+    writes = sum(done for done, errors in totals)
+    errors = sum(errors for done, errors in totals)
+    return writes, errors, writes / float(seconds)
+
+
+def _seat_worker(Session, tables, gamers, requests, seed, results):
+    """ Random join and leave requests (half each), one transaction each """
+    from sqlalchemy.exc import OperationalError
+    from gamesess.booking import join_table, leave_table
+    rnd = random.Random(seed)
+    session = Session()
+    done = errors = 0
+    for i in range(requests):
+        table_id, gamer_id = rnd.randint(1, tables), rnd.randint(1, gamers)
+        try:
+            if rnd.random() < 0.5:
+                join_table(session, table_id, gamer_id)
+            else:
+                leave_table(session, table_id, gamer_id)
+            done += 1
+        except OperationalError:
+            session.rollback()
+            errors += 1
+    session.close()
+    results.append((done, errors))
+
+
+def _overbooking_triggers(engine):
+    """ Records in an `overbooking` table every write that leaves a table
+        with more seated gamers than max_part, even if it is fixed later.
+    """
+    seated = u', '.join(u"'%s'" % status for status in ATTENDANCE_SEATED)
+    count = (u'(SELECT count(*) FROM attendance WHERE table_id = NEW.table_id AND name IN (%s))'
+             % seated)
+    engine.execute('CREATE TABLE overbooking (table_id INTEGER, seated INTEGER)')
+    for event_name in ('INSERT', 'UPDATE OF name'):
+        engine.execute(
+            u'CREATE TRIGGER check_seats_%s AFTER %s ON attendance '
+            u'WHEN NEW.name IN (%s) BEGIN '
+            u'INSERT INTO overbooking SELECT NEW.table_id, %s '
+            u'WHERE %s > (SELECT max_part FROM gametable WHERE id = NEW.table_id); END'
+            % (event_name.split()[0].lower(), event_name, seated, count, count))
+
+
+def check_seats(session):
+    """ The tables breaking a reservation invariant : more seated gamers than
+        max_part, a seat counter out of sync, or waitlisted gamers while seats
+        are free. Returns a list of messages.
+    """
+    seated = dict(session.query(Attendance.table_id, func.count(Attendance.id))
+                  .filter(Attendance.name.in_(ATTENDANCE_SEATED)).group_by(Attendance.table_id))
+    waiting = dict(session.query(Attendance.table_id, func.count(Attendance.id))
+                   .filter(Attendance.name == ATTENDANCE_WAITLIST).group_by(Attendance.table_id))
+    problems = []
+    for table in session.query(GameTable).order_by(GameTable.id):
+        count = seated.get(table.id, 0)
+        if count > table.max_part:
+            problems.append(u'%s overbooked : %i seated for %i seats' % (table, count, table.max_part))
+        if count != table.seats_taken:
+            problems.append(u'%s counter %i for %i seated' % (table, table.seats_taken, count))
+        if waiting.get(table.id) and count < table.max_part:
+            problems.append(u'%s has free seats and a waitlist' % table)
+    return problems
+
+
+def stress_seats(path, config, threads=16, requests=3000, tables=10, seats=5, gamers=10):
+    """ `threads` threads send `requests` join/leave requests in total to
+        `tables` tables of `seats` seats, on a fresh SQLite file through the
+        tuned engine. Returns (requests done, lock errors, requests per
+        second, invariant violations).
+    """
+    import threading
+    from gamesess.database import make_engine
+    if os.path.exists(path):
+        os.remove(path)
+    config = dict(config, SQLALCHEMY_POOL_SIZE=threads)
+    engine = make_engine('sqlite:///%s' % path, config)
+    Base.metadata.create_all(engine)
+    _overbooking_triggers(engine)
+    begin = datetime(2017, 5, 26, 20, 0, 0)
+    engine.execute(GameSession.__table__.insert(), [
+        {'id': 1, 'name': u'Stress session', 'begin': begin, 'end': begin + timedelta(hours=4)}])
+    engine.execute(GameTable.__table__.insert(), [
+        {'id': i + 1, 'name': u'Table %i' % i, 'session_id': 1, 'min_part': 2, 'max_part': seats,
+         'active': True} for i in range(tables)])
+    Session = sessionmaker(bind=engine)
+    results = []
+    workers = [threading.Thread(target=_seat_worker,
+                                args=(Session, tables, gamers, requests // threads, worker, results))
+               for worker in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.time() - start
+    session = Session()
+    problems = [u'Table %i overbooked : %i seated' % tuple(row)
+                for row in session.execute('SELECT DISTINCT table_id, seated FROM overbooking')]
+    problems.extend(check_seats(session))
+    session.close()
+    engine.dispose()
+    done = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    return done, errors, done / seconds, problems
+
+
+def seed_convention(session, tables=400, gamers=300, bookings=8, seed=42):
+    """ A week-end session of `tables` tables of 1 to 4 hours, starting on
+        the half hours, each of `gamers` gamers booking `bookings` tables at
+        random. Some tables overflow the session window. Returns the
+        GameSession id.
+    """
+    rnd = random.Random(seed)
+    engine = session.get_bind()
+    begin = datetime(2017, 5, 26, 18, 0, 0)
+    end = begin + timedelta(hours=48)
+    engine.execute(GameSession.__table__.insert(), [
+        {'id': 1, 'name': u'Convention', 'type': u'Week-End', 'begin': begin, 'end': end,
+         'active': True}])
+    rows = []
+    for i in range(tables):
+        table_begin = begin + timedelta(minutes=30 * rnd.randint(0, 95))
+        rows.append({'id': i + 1, 'name': u'Table %i' % i, 'session_id': 1, 'max_part': 6,
+                     'begin': table_begin, 'end': table_begin + timedelta(hours=rnd.randint(1, 4)),
+                     'active': True})
+    engine.execute(GameTable.__table__.insert(), rows)
+    engine.execute(Attendance.__table__.insert(), [
+        {'table_id': table_id, 'gamer_id': gamer_id, 'name': rnd.choice(ATTENDANCE_SEATED),
+         'active': True}
+        for gamer_id in range(1, gamers + 1)
+        for table_id in rnd.sample(range(1, tables + 1), bookings)])
+    return 1
+
+
+def pairwise_conflicts(bookings):
+    """ Reference for sweep_conflicts : compares every pair of bookings """
+    from gamesess.schedule import Conflict
+    conflicts = []
+    for i, (gamer_id, table_id, begin, end) in enumerate(bookings):
+        for other_gamer, other_id, other_begin, other_end in bookings[i + 1:]:
+            if other_gamer == gamer_id and other_begin < end and begin < other_end:
+                conflicts.append(Conflict(gamer_id, table_id, other_id))
+    return conflicts
+
+
+def seed_wishes(session, tables=200, gamers=1000, wishes=5, seed=42):
+    """ A week-end session of `tables` tables of 3 or 4 hours, on games
+        played at 3 to 6 or at 4 or 6 players. Each gamer wishes to play at
+        `wishes` tables at random ; one gamer in ten is already seated
+        somewhere. Returns the GameSession id.
+    """
+    rnd = random.Random(seed)
+    engine = session.get_bind()
+    parts = ('3-6', '4; 6', '2-4', '5-8')
+    engine.execute(Game.__table__.insert(), [
+        {'id': i + 1, 'name': u'Game %i' % i, 'parts': part, 'active': True}
+        for i, part in enumerate(parts)])
+    engine.execute(GamePlayers.__table__.insert(), [
+        {'game_id': i + 1, 'players': count}
+        for i, part in enumerate(parts) for count in parse_parts(part)])
+    begin = datetime(2017, 5, 26, 18, 0, 0)
+    engine.execute(GameSession.__table__.insert(), [
+        {'id': 1, 'name': u'Convention', 'type': u'Week-End', 'begin': begin,
+         'end': begin + timedelta(hours=48), 'active': True}])
+    rows = []
+    for i in range(tables):
+        table_begin = begin + timedelta(hours=2 * rnd.randint(0, 21))
+        rows.append({'id': i + 1, 'name': u'Table %i' % i, 'session_id': 1,
+                     'game_id': rnd.randint(1, len(parts)), 'min_part': 3, 'max_part': 6,
+                     'begin': table_begin, 'end': table_begin + timedelta(hours=rnd.randint(3, 4)),
+                     'active': True})
+    engine.execute(GameTable.__table__.insert(), rows)
+    rows = []
+    for gamer_id in range(1, gamers + 1):
+        table_ids = rnd.sample(range(1, tables + 1), wishes)
+        seated = rnd.random() < 0.1 and table_ids.pop() or None
+        rows.extend({'table_id': table_id, 'gamer_id': gamer_id, 'name': ATTENDANCE_WISH,
+                     'active': True} for table_id in table_ids)
+        if seated:
+            rows.append({'table_id': seated, 'gamer_id': gamer_id, 'name': ATTENDANCE_SEATED[0],
+                         'active': True})
+    engine.execute(Attendance.__table__.insert(), rows)
+    return 1
+
+
+def allocation_bound(tables, wishes):
+    """ An upper bound of the wishes an allocation can grant : the seats
+        left at each table, limited by the number of its wishers
+    """
+    wishers = {}
+    for gamer_id, table_id in wishes:
+        wishers[table_id] = wishers.get(table_id, 0) + 1
+    return sum(min(table.counts[-1] - table.fixed, wishers.get(table.id, 0))
+               for table in tables if table.counts and table.counts[-1] > table.fixed)
+
+
+def check_allocation(tables, wishes, busy, allocation):
+    """ The broken constraints of an allocation, as messages """
+    from gamesess.allocation import _overlap
+    tables = dict((table.id, table) for table in tables)
+    wishes = set(wishes)
+    problems = []
+    playing = {}
+    for table_id, gamer_ids in allocation.assignments.items():
+        table = tables[table_id]
+        size = table.fixed + len(gamer_ids)
+        if size not in table.counts:
+            problems.append(u'Table %i : %i players, valid : %s' % (table_id, size, table.counts))
+        for gamer_id in gamer_ids:
+            if (gamer_id, table_id) not in wishes:
+                problems.append(u'Gamer %i placed at table %i without a wish' % (gamer_id, table_id))
+            playing.setdefault(gamer_id, []).append(table_id)
+    for gamer_id, table_ids in playing.items():
+        intervals = [(tables[table_id].begin, tables[table_id].end) for table_id in table_ids]
+        booked = list(busy.get(gamer_id, ()))
+        for i, interval in enumerate(intervals):
+            if any(_overlap(interval, other) for other in intervals[i + 1:] + booked):
+                problems.append(u'Gamer %i has overlapping tables' % gamer_id)
+    return problems
+
+
+CATALOG_WORDS = (u'Aventuriers', u'Rail', u'Château', u'Forêt', u'Dragons', u'Épées', u'Mystères',
+                 u'Liège', u'Océan', u'Étoiles', u'Royaume', u'Pirates', u'Cités', u'Légendes',
+                 u'Trésor', u'Héros', u'Marché', u'Empire', u'Île', u'Sorcières')
+CATALOG_LINKS = (u'du', u'de la', u'des', u'et', u'contre')
+
+
+def seed_catalog(session, games=100000, clubs=1000, seed=42):
+    """ `games` games named from a small French vocabulary (with accents)
+        and `clubs` public clubs, inserted through the Core : the search
+        triggers index them.
+    """
+    rnd = random.Random(seed)
+    engine = session.get_bind()
+
+    def name():
+        return u'%s %s %s %i' % (rnd.choice(CATALOG_WORDS), rnd.choice(CATALOG_LINKS),
+                                 rnd.choice(CATALOG_WORDS), rnd.randint(1, 9999))
+    engine.execute(Game.__table__.insert(), [
+        {'id': i + 1, 'name': name(), 'parts': '2-4', 'active': True} for i in range(games)])
+    engine.execute(Club.__table__.insert(), [
+        {'id': i + 1, 'name': u'Club %s' % name(), 'description': name(), 'address': u'Liège',
+         'public': True, 'active': True} for i in range(clubs)])
+
+
+# mainland France and Belgium, in degrees
+GEO_BOUNDS = (42.3, 51.5, -4.8, 8.2)
+
+
+def seed_geo_clubs(session, clubs=100000, bounds=GEO_BOUNDS, seed=42):
+    """ `clubs` public clubs at random points within (south, north, west,
+        east) bounds, inserted through the Core : the geo triggers index
+        them. One club in ten is private and stays out of the index.
+    """
+    rnd = random.Random(seed)
+    south, north, west, east = bounds
+    session.get_bind().execute(Club.__table__.insert(), [
+        {'id': i + 1, 'name': u'Club %i' % (i + 1), 'public': i % 10 != 0, 'active': True,
+         'latitude': rnd.uniform(south, north), 'longitude': rnd.uniform(west, east)}
+        for i in range(clubs)])
+
+
+def scan_nearby(session, latitude, longitude, radius, limit=None):
+    """ The reference of gamesess.geo.nearby_clubs : the haversine distance
+        of every public club, without the spatial index
+    """
+    from gamesess.geo import NearbyClub, haversine
+    rows = session.query(Club.id, Club.latitude, Club.longitude)\
+        .filter(Club.active == True, Club.public == True,
+                Club.latitude != None, Club.longitude != None)
+    hits = [NearbyClub(club_id, haversine(latitude, longitude, club_lat, club_lon))
+            for club_id, club_lat, club_lon in rows]
+    hits = sorted((hit for hit in hits if hit.distance <= radius), key=lambda hit: hit.distance)
+    return hits[:limit] if limit else hits
+
+
+def seed_club_history(session, sessions=20000, tables=5, attendances=4, seed=42):
+    """ One club with `sessions` weekly sessions of `tables` tables each,
+        every table with `attendances` attendances. Returns the Club id.
+    """
+    rnd = random.Random(seed)
+    engine = session.get_bind()
+    engine.execute(Club.__table__.insert(), [{'id': 1, 'name': u'Club historique', 'public': True,
+                                              'active': True}])
+    begin = datetime(1990, 1, 5, 20, 0, 0)
+    table_id = 0
+    for first in range(0, sessions, 1000):
+        session_rows, table_rows, attendance_rows = [], [], []
+        for session_id in range(first + 1, min(first + 1000, sessions) + 1):
+            session_begin = begin + timedelta(days=7 * session_id)
+            session_rows.append({'id': session_id, 'name': u'Soirée %i' % session_id, 'club_id': 1,
+                                 'type': u'Soiree', 'begin': session_begin,
+                                 'end': session_begin + timedelta(hours=4), 'active': True})
+            for i in range(tables):
+                table_id += 1
+                table_rows.append({'id': table_id, 'name': u'Table %i' % table_id,
+                                   'session_id': session_id, 'begin': session_begin,
+                                   'end': session_begin + timedelta(hours=rnd.randint(1, 4)),
+                                   'min_part': 2, 'max_part': 6, 'active': True})
+                attendance_rows.extend({'table_id': table_id, 'gamer_id': gamer_id, 'active': True,
+                                        'name': rnd.choice(ATTENDANCE_STATUSES)}
+                                       for gamer_id in rnd.sample(range(1, 200), attendances))
+        engine.execute(GameSession.__table__.insert(), session_rows)
+        engine.execute(GameTable.__table__.insert(), table_rows)
+        engine.execute(Attendance.__table__.insert(), attendance_rows)
+    return 1
+
+
+SITE_PASSWORD = u'bench'
+
+
+def site_email(gamer_id):
+    return u'gamer%i@bench.example.org' % gamer_id
+
+
+def seed_site(session, clubs=20, gamers=500, sessions=10, tables=8, games=300, attendances=4,
+              memberships=3, seed=42):
+    """ A whole site : `clubs` clubs (half of them public) with `sessions`
+        sessions each, `tables` tables per session and `attendances`
+        attendances per table, a catalog of `games` games and `gamers`
+        gamers, members of `memberships` clubs. Every gamer logs in with
+        site_email(id) and SITE_PASSWORD. Returns the numbers of rows by
+        table name, which are also the highest ids.
+    """
+    from gamesess.security import hasher
+    rnd = random.Random(seed)
+    engine = session.get_bind()
+    # one hash for everybody : hashing is the slow part of the login
+    password_hashed = hasher.hash(SITE_PASSWORD)
+    engine.execute(Gamer.__table__.insert(), [
+        {'id': i, 'login': u'gamer%i' % i, 'last_name': rnd.choice(CATALOG_WORDS).upper(),
+         'first_name': u'%i' % i, 'email': site_email(i), 'password_hashed': password_hashed,
+         'active': True} for i in range(1, gamers + 1)])
+    engine.execute(Club.__table__.insert(), [
+        {'id': i, 'name': u'Club %s %i' % (rnd.choice(CATALOG_WORDS), i),
+         'description': u'%s %s' % (rnd.choice(CATALOG_WORDS), rnd.choice(CATALOG_WORDS)),
+         'address': u'Liège', 'public': i % 2 == 1, 'active': True} for i in range(1, clubs + 1)])
+    engine.execute(GamerClub.__table__.insert(), [
+        {'club_id': club_id, 'gamer_id': gamer_id, 'active': True,
+         'role': gamer_id <= clubs and u'manager' or u'user'}
+        for gamer_id in range(1, gamers + 1)
+        for club_id in rnd.sample(range(1, clubs + 1), min(memberships, clubs))])
+    parts = ('2-4', '3-6', '4; 6', '2', '5-8')
+    game_parts = [rnd.choice(parts) for i in range(games)]
+    engine.execute(Game.__table__.insert(), [
+        {'id': i + 1, 'name': u'%s %s %s' % (rnd.choice(CATALOG_WORDS), rnd.choice(CATALOG_LINKS),
+                                            rnd.choice(CATALOG_WORDS)),
+         'parts': part, 'average_duration': rnd.choice((30, 60, 90, 120)),
+         # one game in five is an expansion of an earlier one
+         'parent_id': i > 10 and rnd.random() < 0.2 and rnd.randint(1, i) or None, 'active': True}
+        for i, part in enumerate(game_parts)])
+    engine.execute(GamePlayers.__table__.insert(), [
+        {'game_id': i + 1, 'players': count}
+        for i, part in enumerate(game_parts) for count in parse_parts(part)])
+    begin = datetime(2017, 5, 26, 20, 0, 0)
+    session_rows, table_rows, attendance_rows = [], [], []
+    for club_id in range(1, clubs + 1):
+        for week in range(sessions):
+            session_id = len(session_rows) + 1
+            session_begin = begin + timedelta(days=7 * week, hours=club_id % 3)
+            session_rows.append({'id': session_id, 'name': u'Soirée %i' % session_id,
+                                 'club_id': club_id, 'type': u'Soiree', 'state': u'confirmed',
+                                 'begin': session_begin, 'end': session_begin + timedelta(hours=5),
+                                 'active': True})
+            for i in range(tables):
+                table_id = len(table_rows) + 1
+                table_begin = session_begin + timedelta(hours=rnd.randint(0, 2))
+                max_part = rnd.randint(max(attendances, 3), attendances + 3)
+                table_rows.append({'id': table_id, 'name': u'Table %i' % table_id,
+                                   'session_id': session_id, 'game_id': rnd.randint(1, games),
+                                   'begin': table_begin,
+                                   'end': table_begin + timedelta(hours=rnd.randint(1, 3)),
+                                   'min_part': 2, 'max_part': max_part, 'active': True})
+                seated = 0
+                for gamer_id in rnd.sample(range(1, gamers + 1), min(attendances, gamers)):
+                    name = rnd.choice(ATTENDANCE_STATUSES)
+                    seated += name in ATTENDANCE_SEATED
+                    attendance_rows.append({'table_id': table_id, 'gamer_id': gamer_id,
+                                            'name': name, 'active': True})
+                table_rows[-1]['seats_taken'] = seated
+    for table, rows in ((GameSession.__table__, session_rows), (GameTable.__table__, table_rows),
+                        (Attendance.__table__, attendance_rows)):
+        if rows:
+            engine.execute(table.insert(), rows)
+    return {'club': clubs, 'gamer': gamers, 'game': games, 'gamesession': len(session_rows),
+            'gametable': len(table_rows), 'attendance': len(attendance_rows)}
+
+
+
+def mutate_site(session, counts, changes=2000, seed=7):
+    """ `changes` random changes to a site of seed_site, through the
+        booking functions, the ORM and the Core : seats taken and left,
+        statuses changed, tables moved, resized, deleted or added, sessions
+        moved to another club or deleted. Returns the number of changes by
+        kind.
+    """
+    from gamesess.booking import join_table, leave_table
+    rnd = random.Random(seed)
+    done = {}
+
+    def table_id():
+        return rnd.randint(1, counts['gametable'])
+
+    def gamer_id():
+        return rnd.randint(1, counts['gamer'])
+
+    for change in range(changes):
+        kind = rnd.choice(('join', 'join', 'join', 'leave', 'leave', 'status', 'deactivate',
+                           'move', 'game', 'resize', 'delete_table', 'add_table', 'club', 'delete_session'))
+        if kind == 'join':
+            join_table(session, table_id(), gamer_id(), rnd.choice((None,) + ATTENDANCE_STATUSES[:3]))
+        elif kind == 'leave':
+            attendance = session.query(Attendance).filter_by(table_id=table_id()).first()
+            if attendance is not None:
+                leave_table(session, attendance.table_id, attendance.gamer_id)
+        elif kind in ('status', 'deactivate'):
+            attendance = session.query(Attendance).get(rnd.randint(1, counts['attendance']))
+            if attendance is not None:
+                if kind == 'status':
+                    attendance.name = rnd.choice(ATTENDANCE_STATUSES)
+                else:
+                    attendance.active = not attendance.active
+        elif kind in ('move', 'game', 'resize', 'delete_table'):
+            table = session.query(GameTable).get(table_id())
+            if table is None:
+                continue
+            if kind == 'move':
+                table.session_id = rnd.randint(1, counts['gamesession'])
+            elif kind == 'game':
+                table.game_id = rnd.choice((None, rnd.randint(1, counts['game'])))
+            elif kind == 'resize':
+                table.min_part, table.max_part = rnd.choice(((2, 4), (3, 6), (None, None), (1, 2)))
+            else:
+                session.delete(table)
+        elif kind == 'add_table':
+            table = GameTable(name=u'Table', session_id=rnd.randint(1, counts['gamesession']),
+                              game_id=rnd.randint(1, counts['game']), min_part=2, max_part=5, active=True)
+            session.add(table)
+            session.flush()
+            session.execute(Attendance.__table__.insert(), [
+                {'table_id': table.id, 'gamer_id': gamer, 'name': rnd.choice(ATTENDANCE_STATUSES), 'active': True}
+                for gamer in rnd.sample(range(1, counts['gamer'] + 1), 3)])
+        elif kind == 'club':
+            session.query(GameSession).filter_by(id=rnd.randint(1, counts['gamesession']))\
+                .update({'club_id': rnd.choice((None, rnd.randint(1, counts['club'])))})
+        else:
+            session.query(GameSession).filter_by(id=rnd.randint(1, counts['gamesession'])).delete()
+        session.commit()
+        done[kind] = done.get(kind, 0) + 1
+    return done
+
+
+def live_club_stats(session, club_id, games=10):
+    """ The reference of gamesess.stats.club_stats without the rollups :
+        the seated attendances joined up to the club on every call
+    """
+    seated = and_(Attendance.active == True, Attendance.name.in_(ATTENDANCE_SEATED))
+    top_games = session.query(Game, func.count(Attendance.id), func.count(distinct(GameTable.id)))\
+        .join(GameTable, GameTable.game_id == Game.id)\
+        .join(GameSession, GameSession.id == GameTable.session_id)\
+        .join(Attendance, Attendance.table_id == GameTable.id)\
+        .filter(GameSession.club_id == club_id, seated)\
+        .group_by(Game.id)\
+        .order_by(func.count(Attendance.id).desc(), func.count(distinct(GameTable.id)).desc(), Game.id)\
+        .limit(games).all()
+    gamers = session.query(GameSession.id, func.count(distinct(Attendance.gamer_id)))\
+        .join(GameTable, GameTable.session_id == GameSession.id)\
+        .join(Attendance, Attendance.table_id == GameTable.id)\
+        .filter(GameSession.club_id == club_id, seated)\
+        .group_by(GameSession.id).all()
+    return top_games, gamers
+
+
+_STARTUP_SCRIPT = '''
+import json, sys, time
+marks = [time.time()]
+from gamesess.app import create_app
+marks.append(time.time())
+app = create_app(sys.argv[1])
+marks.append(time.time())
+client = app.test_client()
+for i in range(2):
+    client.get(sys.argv[2])
+    marks.append(time.time())
+print(json.dumps(marks))
+'''
+STARTUP_STEPS = ('interpreter', 'import', 'create_app', 'first request', 'second request')
+
+
+def startup_times(config_name, path='/login', cwd=None):
+    """ Milliseconds spent by a new process in each of STARTUP_STEPS, up to
+        its second request to `path`
+    """
+    import json
+    import subprocess
+    import sys
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', _STARTUP_SCRIPT,
+                                          config_name, path], cwd=cwd, stderr=devnull)
+    marks = [start] + json.loads(output.strip().splitlines()[-1])
+    return [(marks[i + 1] - marks[i]) * 1000.0 for i in range(len(marks) - 1)]
+
+
+def command_time(args, cwd=None):
+    """ Milliseconds from the start to the end of a manage.py command """
+    import subprocess
+    import sys
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-W', 'ignore', 'manage.py'] + list(args), cwd=cwd,
+                              stdout=devnull, stderr=devnull)
+    return (time.time() - start) * 1000.0
+
+
+def max_rss():
+    """ Peak resident memory of the process, in MiB (Linux) """
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _live_subscriber(hub, key, events, ready, latencies):
+    received = 0
+    for item in hub.listen(key):
+        if received == 0 and item is None:
+            # first wake-up : the bench is ready
+            ready.release()
+            continue
+        if item is not None:
+            latencies.append(time.time() - item[2]['sent'])
+            received += 1
+            if received == events:
+                return
+
+
+def bench_live(subscribers=2000, events=50, channels=10, interval=0.01):
+    """ `subscribers` threads spread over `channels` channels of a LiveHub,
+        `events` events published on each channel. Returns (idle CPU
+        seconds per second, latencies in ms sorted, expected deliveries).
+    """
+    from gamesess.live import LiveHub
+    hub = LiveHub(heartbeat=0)
+    ready = threading.Semaphore(0)
+    latencies = []
+    threading.stack_size(256 * 1024)
+    workers = [threading.Thread(target=_live_subscriber,
+                                args=(hub, i % channels, events, ready, latencies))
+               for i in range(subscribers)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    while sum(hub.subscribers(key) for key in range(channels)) < subscribers:
+        time.sleep(0.01)
+    hub.beat()
+    for worker in workers:
+        ready.acquire()
+    # every subscriber waits : measure the CPU used while nothing happens
+    cpu = time.clock()
+    time.sleep(1.0)
+    idle = time.clock() - cpu
+    for i in range(events):
+        for key in range(channels):
+            hub.publish(key, 'seats', {'sent': time.time()})
+        time.sleep(interval)
+    for worker in workers:
+        worker.join(10)
+    return idle, sorted(latency * 1000.0 for latency in latencies), subscribers * events
+
+
+def seed_images(store, images=20, width=1600, height=1200, seed=42):
+    """ Stores `images` synthetic photographs (JPEG, every fourth a PNG with
+        transparency) : their names
+    """
+    from io import BytesIO
+    from PIL import Image, ImageDraw
+    rnd = random.Random(seed)
+    names = []
+    for i in range(images):
+        mode, kind = (i % 4 == 3) and ('RGBA', 'PNG') or ('RGB', 'JPEG')
+        image = Image.new(mode, (width, height), (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+        draw = ImageDraw.Draw(image)
+        for j in range(200):
+            x, y = rnd.randint(0, width), rnd.randint(0, height)
+            draw.ellipse((x, y, x + rnd.randint(10, 300), y + rnd.randint(10, 300)),
+                         fill=tuple(rnd.randint(0, 255) for k in mode))
+        # some noise, as in a photograph
+        image = Image.blend(image, Image.frombytes(mode, image.size, os.urandom(width * height * len(mode))), 0.1)
+        stream = BytesIO()
+        image.save(stream, kind, quality=90)
+        stream.seek(0)
+        names.append(store.save(stream))
+    return names
+
+
+def _image_client(host, port, paths, requests, headers, results):
+    from gamesess.loadtest import HttpDriver
+    driver = HttpDriver(host, port)
+    received, statuses = 0, {}
+    try:
+        for i in range(requests):
+            status, body = driver.get(paths[i % len(paths)], headers)
+            received += len(body)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        driver.close()
+    results.append((received, statuses))
+
+
+def fetch_images(port, paths, requests=500, concurrency=4, headers=None, host='127.0.0.1'):
+    """ `requests` GET of the paths by each of `concurrency` keep-alive
+        clients : (bytes received, seconds, {status: count})
+    """
+    results = []
+    clients = [threading.Thread(target=_image_client, args=(host, port, paths, requests, headers, results))
+               for i in range(concurrency)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    seconds = time.time() - start
+    statuses = {}
+    for received, client_statuses in results:
+        for status, count in client_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    return sum(received for received, client_statuses in results), seconds, statuses
+
+
+class SmtpSink(smtpd.SMTPServer):
+    """ A local SMTP server keeping the mails it receives, the stand-in of
+        the mail server for the benchmarks and the development
+        (manage.py smtp_sink). The first `failures` mails are refused with
+        a temporary error.
+    """
+
+    def __init__(self, port=0, failures=0, echo=False):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', port), None)
+        self.port = self.socket.getsockname()[1]
+        self.failures = failures
+        self.echo = echo
+        self.refused = 0
+        self.messages = []
+        self._thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.refused < self.failures:
+            self.refused += 1
+            return '451 4.3.0 Try again later'
+        self.messages.append((mailfrom, rcpttos, data))
+        if self.echo:
+            print(data + '\n')
+
+    def start(self):
+        """ Serves in a thread (the SMTP server holds the asyncore loop) """
+        self._thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05}, name='smtp-sink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        asyncore.close_all()
+        self._thread.join()
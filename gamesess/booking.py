@@ -0,0 +1,153 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Seat reservations at the game tables.
+
+    GameTable.seats_taken counts the seated attendances of a table. A seat is
+    taken with one conditional UPDATE of that counter, which only matches
+    while the counter is below max_part : two gamers can never get the last
+    seat, whatever the interleaving of their requests. A gamer asking for a
+    seat at a full table is put on the waitlist, and the first waitlisted
+    gamer gets the seat freed by a seated gamer who leaves.
+
+    Attendance rows carry a version number (optimistic concurrency) : a
+    change made from a stale read fails, the whole transaction (seat counter
+    included) is rolled back and the reservation is retried.
+"""
+from sqlalchemy import and_, or_, func
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+
+from gamesess.models import GameTable, Attendance, ATTENDANCE_STATUSES, ATTENDANCE_SEATED, ATTENDANCE_WAITLIST
+
+RETRIES = 5
+
+
+def _take_seat(session, table_id):
+    """ Takes a seat at an active table that is not full : True on success """
+    table = GameTable.__table__
+    result = session.execute(table.update()
+        .where(and_(table.c.id == table_id, table.c.active == True,
+                    or_(table.c.max_part == None, table.c.seats_taken < table.c.max_part)))
+        .values(seats_taken=table.c.seats_taken + 1))
+    return result.rowcount == 1
+
+
+def _release_seat(session, table_id):
+    table = GameTable.__table__
+    session.execute(table.update()
+        .where(and_(table.c.id == table_id, table.c.seats_taken > 0))
+        .values(seats_taken=table.c.seats_taken - 1))
+
+
+def _free_seat(session, table_id):
+    """ Gives a freed seat to the first waitlisted gamer, if any """
+    waiting = session.query(Attendance)\
+        .filter_by(table_id=table_id, name=ATTENDANCE_WAITLIST, active=True)\
+        .order_by(Attendance.modified, Attendance.id)\
+        .first()
+    if waiting is None:
+        _release_seat(session, table_id)
+    else:
+        waiting.name = ATTENDANCE_SEATED[0]
+
+
+def _attendance(session, table_id, gamer_id):
+    return session.query(Attendance)\
+        .filter_by(table_id=table_id, gamer_id=gamer_id)\
+        .populate_existing()\
+        .first()
+
+
+def _retry(session, operation):
+    """ Runs `operation` in a transaction of its own and commits, retrying it
+        on a concurrent change. On SQLite the transaction takes the write lock
+        from its start (the reads then see the latest data).
+    """
+    session.commit()
+    for attempt in range(RETRIES):
+        try:
+            session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+            result = operation()
+            session.commit()
+            return result
+        except (StaleDataError, IntegrityError, OperationalError):
+            # OperationalError : the database was locked by another writer
+            session.rollback()
+            if attempt == RETRIES - 1:
+                raise
+
+
+def join_table(session, table_id, gamer_id, status=None):
+    """ Registers a gamer at a table and commits.
+
+        A seated status (confirmé, initiateur) takes a seat if one is left,
+        otherwise the gamer is waitlisted ; 'possible' never takes a seat.
+        Without a status, a seated gamer keeps theirs and the others ask
+        for a seat as confirmé. Returns the status of the gamer at the
+        table, None when the table is unknown or inactive.
+    """
+    if status is not None and (status not in ATTENDANCE_STATUSES or status == ATTENDANCE_WAITLIST):
+        raise ValueError(u'Invalid attendance status : %s' % status)
+
+    def operation():
+        if not session.query(GameTable.id).filter_by(id=table_id, active=True).first():
+            return None
+        attendance = _attendance(session, table_id, gamer_id)
+        if attendance is None:
+            attendance = Attendance(table_id=table_id, gamer_id=gamer_id)
+            session.add(attendance)
+        elif not attendance.active:
+            attendance.active = True
+            attendance.name = None
+        current = attendance.name
+        if status is None or status in ATTENDANCE_SEATED:
+            if current in ATTENDANCE_SEATED or current == ATTENDANCE_WAITLIST:
+                if current in ATTENDANCE_SEATED:
+                    attendance.name = status or current
+                # a waitlisted gamer keeps their rank
+            elif _take_seat(session, table_id):
+                attendance.name = status or ATTENDANCE_SEATED[0]
+            else:
+                attendance.name = ATTENDANCE_WAITLIST
+        else:
+            attendance.name = status
+            if current in ATTENDANCE_SEATED:
+                _free_seat(session, table_id)
+        session.flush()
+        return attendance.name
+    return _retry(session, operation)
+
+
+def leave_table(session, table_id, gamer_id):
+    """ Removes a gamer from a table and commits : their seat goes to the
+        first waitlisted gamer. Returns False when they were not at the table.
+    """
+    def operation():
+        attendance = _attendance(session, table_id, gamer_id)
+        if attendance is None:
+            return False
+        seated = attendance.active and attendance.name in ATTENDANCE_SEATED
+        session.delete(attendance)
+        session.flush()
+        if seated:
+            _free_seat(session, table_id)
+            session.flush()
+        return True
+    return _retry(session, operation)
+
+
+def rebuild_seat_counts(session):
+    """ Recomputes GameTable.seats_taken from the seated attendances.
+        Returns the ids of the tables whose counter was wrong.
+    """
+    counts = dict(session.query(Attendance.table_id, func.count(Attendance.id))
+                  .filter(Attendance.active == True, Attendance.name.in_(ATTENDANCE_SEATED))
+                  .group_by(Attendance.table_id))
+    fixed = []
+    for table_id, seats_taken in session.query(GameTable.id, GameTable.seats_taken):
+        if seats_taken != counts.get(table_id, 0):
+            fixed.append(table_id)
+            session.query(GameTable).filter_by(id=table_id)\
+                .update({'seats_taken': counts.get(table_id, 0)}, synchronize_session=False)
+    session.commit()
+    return fixed
@@ -0,0 +1,256 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Caches : a thread safe LRU and the response/fragment cache of the views """
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask.ext.login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class LRUCache(object):
+    """ A thread safe LRU cache whose entries expire after `ttl` seconds.
+
+        Keeps hit/miss counters to check how much work it saves.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size=None, ttl=None):
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            self._data.clear()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or (self.ttl and entry[0] < now):
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + (self.ttl or 0), value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class NullBackend(object):
+    """ Caches nothing """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryBackend(object):
+    """ In-process LRU backend : one cache per worker """
+
+    def __init__(self, max_size=1024, timeout=300):
+        self.lru = LRUCache(max_size=max_size, ttl=timeout)
+
+    def get(self, key):
+        return self.lru.get(key)
+
+    def set(self, key, value, timeout=None):
+        # the LRU has a single ttl : `timeout` is ignored
+        self.lru.set(key, value)
+
+    def delete(self, key):
+        self.lru.invalidate(key)
+
+    def clear(self):
+        self.lru.clear()
+
+
+class FileBackend(object):
+    """ One pickle file per entry in a local directory, shared by all the
+        workers of the host. Files are replaced atomically with a rename.
+    """
+
+    def __init__(self, directory, timeout=300):
+        self.directory = directory
+        self.timeout = timeout
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as entry:
+                expires, value = pickle.load(entry)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires and expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        expires = timeout and time.time() + timeout or 0
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(handle, 'wb') as entry:
+            pickle.dump((expires, value), entry, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class ResponseCache(object):
+    """ Caches rendered views and fragments in a pluggable backend.
+
+        Every entry depends on tags (table names). Each tag has a random
+        generation stored in the backend and included in the keys of the
+        entries depending on it : invalidating a tag only means giving it a
+        new generation, which works the same way for every worker sharing
+        the backend. Tags are invalidated when changes to the watched models
+        are committed through the ORM.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or NullBackend()
+
+    def init_app(self, app):
+        config = app.config
+        kind = config.get('CACHE_BACKEND', 'memory')
+        timeout = config.get('CACHE_DEFAULT_TIMEOUT', 300)
+        if kind == 'memory':
+            self.backend = MemoryBackend(config.get('CACHE_SIZE', 1024), timeout)
+        elif kind == 'file':
+            self.backend = FileBackend(config['CACHE_DIR'], timeout)
+        else:
+            self.backend = NullBackend()
+
+    def _generation(self, tag):
+        key = 'tag:%s' % tag
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set(key, generation, 0)
+        return generation
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.set('tag:%s' % tag, uuid.uuid4().hex, 0)
+
+    def make_key(self, key, tags):
+        generations = ','.join(self._generation(tag) for tag in sorted(tags))
+        return u'%s|%s' % (key, generations)
+
+    def get_or_set(self, key, tags, producer, timeout=None):
+        """ The cached value of `key`, computed by `producer` on a miss """
+        full_key = self.make_key(key, tags)
+        value = self.backend.get(full_key)
+        if value is None:
+            value = producer()
+            self.backend.set(full_key, value, timeout)
+        return value
+
+    def cached(self, tags=(), vary_user=False, timeout=None):
+        """ View decorator caching the successful GET responses.
+
+            The key varies with the path and query string, with the gamer
+            when `vary_user` is set and otherwise with the authentication
+            state (the navbar differs). Requests with pending flash messages
+            are never cached.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method != 'GET' or session.get('_flashes'):
+                    return view(*args, **kwargs)
+                if vary_user:
+                    user_key = current_user.is_authenticated and current_user.get_id() or u'-'
+                else:
+                    user_key = current_user.is_authenticated and u'auth' or u'-'
+                key = u'view:%s|%s|%s' % (request.endpoint, request.full_path, user_key)
+                full_key = self.make_key(key, tags)
+                cached = self.backend.get(full_key)
+                if cached is not None:
+                    data, status, headers = cached
+                    return current_app.response_class(data, status, headers)
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    self.backend.set(full_key, (response.get_data(), response.status_code,
+                                                list(response.headers)), timeout)
+                return response
+            return wrapper
+        return decorator
+
+    def watch(self, *models):
+        """ Invalidates the tables of `models` when changes to them are committed """
+        tables = dict((model, model.__tablename__) for model in models)
+
+        @event.listens_for(Session, 'after_flush')
+        def _collect_changed_tables(db_session, flush_context):
+            changed = db_session.info.setdefault('changed_cache_tags', set())
+            for instance in list(db_session.new) + list(db_session.dirty) + list(db_session.deleted):
+                tag = tables.get(type(instance))
+                if tag is not None:
+                    changed.add(tag)
+
+        @event.listens_for(Session, 'after_commit')
+        def _invalidate_changed_tables(db_session):
+            self.invalidate(*db_session.info.pop('changed_cache_tags', ()))
+
+        @event.listens_for(Session, 'after_rollback')
+        def _forget_changed_tables(db_session):
+            db_session.info.pop('changed_cache_tags', None)
@@ -0,0 +1,67 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Conditional GET : ETag and Last-Modified derived from the `modified`
+    column of the rows a view depends on.
+
+    Last-Modified has a resolution of one second : it is left out while the
+    latest change is in the current second, the ETag tells the next ones.
+"""
+import hashlib
+import time
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask.ext.login import current_user
+
+
+def _http_date(value):
+    """ Local naive datetime (as stored by the models) to naive UTC, in seconds """
+    return datetime.utcfromtimestamp(time.mktime(value.timetuple()))
+
+
+def conditional(versions, daily=False):
+    """ View decorator answering 304 Not Modified without calling the view.
+
+        `versions(**view_args)` must return the (latest modified, row counts)
+        of the data shown by the view, see services.last_change. The ETag
+        also depends on the URL and on the current gamer, as the pages do.
+        With `daily`, the page depends on the current date too (sessions
+        "from today") : nothing older than midnight validates. Requests with
+        pending flash messages are always answered by the view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return view(*args, **kwargs)
+            modified, counts = versions(**kwargs)
+            if daily:
+                today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+                modified = max(modified or today, today)
+            user_key = current_user.is_authenticated and current_user.get_id() or u'-'
+            etag = hashlib.sha1(repr((request.full_path, user_key, modified, counts))).hexdigest()
+            last_modified = modified is not None and _http_date(modified) or None
+            if last_modified is not None and last_modified >= _http_date(datetime.now()):
+                # a change later in this second would keep the same date : the ETag only
+                last_modified = None
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = (last_modified is not None and request.if_modified_since is not None
+                                and last_modified <= request.if_modified_since)
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
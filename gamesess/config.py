@@ -1 +1,168 @@
- 
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Application settings.
+
+    One class per environment (CONFIGS), selected by create_app or by the
+    GAMESESS_ENV environment variable : development by default.
+    Every setting of Config can be overridden with an environment variable
+    named GAMESESS_<SETTING>, e.g. GAMESESS_SQLALCHEMY_DATABASE_URI or
+    GAMESESS_SQLALCHEMY_POOL_SIZE=8. Values are converted to the type of
+    the default value.
+"""
+import os
+
+ENV_PREFIX = 'GAMESESS_'
+ENV_VARIABLE = 'GAMESESS_ENV'
+DEFAULT_ENV = 'development'
+
+
+class Config(object):
+    DEBUG = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///gamesess_test1.db'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SECRET_KEY = 'guess_my_secret_and_difficult_key'
+
+    # Connection pool, per worker process : size it to the threads of a worker
+    SQLALCHEMY_POOL_SIZE = 5
+    SQLALCHEMY_MAX_OVERFLOW = 5
+    SQLALCHEMY_POOL_TIMEOUT = 10 # seconds
+    # Second pool (same size) of query_only connections for the GET requests
+    DB_READONLY_POOL = False
+
+    # SQLite pragmas applied on every new connection
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL' # safe with WAL, FULL otherwise
+    SQLITE_BUSY_TIMEOUT = 5000 # milliseconds
+    SQLITE_MMAP_SIZE = 268435456 # bytes
+    SQLITE_CACHE_SIZE = -16000 # negative = KiB
+    SQLITE_FOREIGN_KEYS = False
+
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256'
+    PASSWORD_HASH_ITERATIONS = 150000
+    PASSWORD_VERIFY_WORKERS = 0 # 0 = verify on the request thread
+    LOGIN_MAX_FAILURES = 5
+    LOGIN_FAILURE_WINDOW = 300 # seconds
+
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60 # seconds
+
+    CLUBS_PER_PAGE = 20
+    SESSION_HORIZON = 90 # days of sessions created ahead from the rules of the clubs
+    NEARBY_RADIUS = 50 # km, default and maximum radius of the clubs near a point
+    LIVE_HEARTBEAT = 15 # seconds between two keep-alives of the live updates
+    SEARCH_RESULTS = 20
+
+    # Request instrumentation, exposed at /metrics (see gamesess.metrics)
+    METRICS_ENABLED = False
+    METRICS_N_PLUS_ONE = 10 # repeats of a statement flagging a request
+    METRICS_PROFILER = False
+    METRICS_PROFILER_INTERVAL = 0.005 # seconds
+    # /metrics : the token of the scraper (Authorization: Bearer <token>),
+    # otherwise the addresses (separated by spaces) of the direct clients
+    METRICS_TOKEN = None
+    METRICS_ALLOWED_ADDRESSES = '127.0.0.1 ::1'
+
+    # memory (per process : invalidations do not reach the other workers),
+    # file (shared by the workers of the host) or null
+    CACHE_BACKEND = 'memory'
+    CACHE_DIR = '/tmp/gamesess_cache'
+    CACHE_DEFAULT_TIMEOUT = 300 # seconds
+
+    # Uploaded images (see gamesess.images)
+    IMAGE_ROOT = '/tmp/gamesess_images'
+    IMAGE_WORKERS = 2 # processes resizing the uploads, 0 = manage.py make_thumbnails only
+    IMAGE_MAX_BYTES = 8388608
+    USE_X_SENDFILE = False # the front server sends the files (X-Sendfile)
+
+    # Deferred jobs (see gamesess.jobs), run by manage.py run_jobs
+    JOB_WORKERS = 2
+    JOB_BATCH = 20 # jobs claimed at once by a worker
+    JOB_POLL_INTERVAL = 1.0 # seconds between two looks at an empty queue
+    JOB_LEASE = 300 # seconds : the jobs of a silent worker are claimed again after
+    JOB_MAX_ATTEMPTS = 8
+    JOB_BACKOFF = 30 # seconds before the first retry, doubled at each attempt
+    JOB_MAX_BACKOFF = 3600
+    JOB_RETENTION = 7 # days the done jobs are kept (manage.py purge_jobs)
+
+    # Mails to the gamers (see gamesess.notifications)
+    MAIL_SENDER = 'seances@gamesess.local'
+    SMTP_HOST = 'localhost'
+    SMTP_PORT = 25
+    SMTP_TIMEOUT = 10 # seconds
+    DIGEST_DELAY = 60 # seconds : the changes of this delay go in one mail per gamer
+
+    # Compiled templates, shared by the workers ('' = compile in each worker)
+    TEMPLATE_CACHE_DIR = '/tmp/gamesess_templates'
+    TEMPLATES_AUTO_RELOAD = False # check the template files for changes
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    TEMPLATES_AUTO_RELOAD = True
+    SMTP_PORT = 8025 # manage.py smtp_sink
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    PASSWORD_HASH_ITERATIONS = 1000
+    CACHE_BACKEND = 'null'
+    IMAGE_WORKERS = 0
+    SMTP_PORT = 8025
+    DIGEST_DELAY = 0
+
+
+class ProductionConfig(Config):
+    # several workers : the tag generations must be shared
+    CACHE_BACKEND = 'file'
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def _convert(value, default):
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, (int, long)):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def environ_overrides(config, environ=None):
+    """ The settings of `config` overridden in the environment """
+    environ = os.environ if environ is None else environ
+    result = {}
+    for key in dir(config):
+        if key.isupper() and ENV_PREFIX + key in environ:
+            result[key] = _convert(environ[ENV_PREFIX + key], getattr(config, key))
+    return result
+
+
+def settings(config=Config):
+    """ The settings as a dict, environment overrides applied """
+    result = dict((key, getattr(config, key)) for key in dir(config) if key.isupper())
+    result.update(environ_overrides(config))
+    return result
+
+
+def config_class(name=None):
+    """ The settings class of an environment, GAMESESS_ENV by default """
+    name = name or os.environ.get(ENV_VARIABLE) or DEFAULT_ENV
+    try:
+        return CONFIGS[name]
+    except KeyError:
+        raise ValueError(u'Unknown environment : %s (%s)' % (name, ', '.join(sorted(CONFIGS))))
+
+
+def load_config(app, config=None):
+    """ `config` is a settings class or the name of an environment """
+    if config is None or isinstance(config, basestring):
+        config = config_class(config)
+    app.config.update(settings(config))
@@ -0,0 +1,197 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Database engines : SQLite pragmas, connection pools and the routing of
+    the GET requests to an optional pool of read-only connections.
+"""
+import os
+
+from flask import has_request_context, request
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+READONLY_BIND = 'readonly'
+
+
+def sqlite_pragmas(config, readonly=False):
+    """ The PRAGMA statements for a new connection, from the settings """
+    pragmas = [
+        'PRAGMA journal_mode=%s' % config.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'PRAGMA synchronous=%s' % config.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'PRAGMA busy_timeout=%i' % config.get('SQLITE_BUSY_TIMEOUT', 5000),
+        'PRAGMA mmap_size=%i' % config.get('SQLITE_MMAP_SIZE', 0),
+        'PRAGMA cache_size=%i' % config.get('SQLITE_CACHE_SIZE', -2000),
+        'PRAGMA foreign_keys=%s' % (config.get('SQLITE_FOREIGN_KEYS') and 'ON' or 'OFF'),
+    ]
+    if readonly:
+        pragmas.append('PRAGMA query_only=ON')
+    return pragmas
+
+
+def tune_engine(engine, config, readonly=False):
+    """ Applies the pragmas to every new SQLite connection of the engine.
+
+        Transactions are begun by SQLAlchemy rather than by the sqlite3
+        module, which starts them only before a write and leaves the reads
+        outside of any transaction. The execution option `sqlite_begin`
+        ('IMMEDIATE') takes the write lock at the start of a transaction.
+    """
+    if engine.dialect.name != 'sqlite':
+        return engine
+    pragmas = sqlite_pragmas(config, readonly)
+
+    @event.listens_for(engine, 'connect')
+    def _apply_pragmas(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def _begin(connection):
+        connection.execute('BEGIN %s' % connection.get_execution_options().get('sqlite_begin', 'DEFERRED'))
+    return wrap_cte(engine)
+
+
+def wrap_cte(engine):
+    """ The sqlite3 module gives no cursor description to a statement
+        starting with WITH when it returns no rows : the statements of the
+        SQLite engine are run as a sub-select instead.
+    """
+    if engine.dialect.name != 'sqlite':
+        return engine
+
+    @event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def _wrap_cte(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('WITH'):
+            statement = 'SELECT * FROM (%s)' % statement
+        return statement, parameters
+    return engine
+
+
+def guard_fork(engine):
+    """ A pooled connection is only used by the process which opened it :
+        a worker forked with connections in the pool (the engine was used
+        before the fork) discards them and opens its own.
+    """
+    @event.listens_for(engine, 'connect')
+    def _remember_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def _check_pid(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            # the parent still owns it : forget it without closing it
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection record belongs to pid %s, attempting to check out in pid %s'
+                % (connection_record.info['pid'], os.getpid()))
+    return engine
+
+
+def sqlite_pool_options(config, options):
+    """ A pool of connections shared by the threads of a worker instead of
+        a new connection (and new pragmas) per checkout.
+    """
+    options['poolclass'] = QueuePool
+    options['pool_size'] = config.get('SQLALCHEMY_POOL_SIZE') or 5
+    options.setdefault('max_overflow', config.get('SQLALCHEMY_MAX_OVERFLOW') or 0)
+    options.setdefault('pool_timeout', config.get('SQLALCHEMY_POOL_TIMEOUT') or 10)
+    connect_args = options.setdefault('connect_args', {})
+    connect_args['check_same_thread'] = False
+    connect_args['timeout'] = config.get('SQLITE_BUSY_TIMEOUT', 5000) / 1000.0
+    return options
+
+
+def make_engine(uri, config, readonly=False):
+    """ A tuned engine outside of the Flask application (scripts, benchmarks) """
+    options = {}
+    info = make_url(uri)
+    if info.drivername == 'sqlite' and info.database not in (None, '', ':memory:'):
+        sqlite_pool_options(config, options)
+    return guard_fork(tune_engine(create_engine(info, **options), config, readonly))
+
+
+class RoutingSession(SignallingSession):
+    """ Sends the reads of GET/HEAD requests to the read-only pool, until the
+        session writes : it then sticks to the main engine up to the end of
+        the transaction, to read its own writes.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def _reads_only(self):
+        return (self.app.config.get('DB_READONLY_POOL')
+                and has_request_context() and request.method in ('GET', 'HEAD')
+                and not self._flushing and not self.info.get('has_written'))
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._reads_only():
+            return self.db.get_engine(self.app, bind=READONLY_BIND)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_written(session, flush_context):
+    session.info['has_written'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_written(session):
+    session.info.pop('has_written', None)
+
+
+class Database(SQLAlchemy):
+    """ Flask-SQLAlchemy with tuned SQLite engines and a read-only bind """
+
+    def __init__(self, *args, **kwargs):
+        self._tuned = set()
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def init_app(self, app):
+        if app.config.get('DB_READONLY_POOL'):
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.setdefault(READONLY_BIND, app.config['SQLALCHEMY_DATABASE_URI'])
+            app.config['SQLALCHEMY_BINDS'] = binds
+        SQLAlchemy.init_app(self, app)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername == 'sqlite' and options.get('poolclass') is not StaticPool:
+            # file database : replaces the NullPool set by Flask-SQLAlchemy
+            sqlite_pool_options(app.config, options)
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine not in self._tuned:
+            # before the first connection : engines connect lazily
+            self._tuned.add(engine)
+            tune_engine(engine, app.config, readonly=bind == READONLY_BIND)
+            guard_fork(engine)
+        return engine
+
+    def dispose(self, app):
+        """ Closes the pooled connections of every engine : no connection
+            may be shared by two processes, dispose before forking workers
+        """
+        for bind in list(get_state(app).connectors):
+            self.get_engine(app, bind).dispose()
+
+    def use_database(self, app, uri):
+        """ Points the application (and its read-only bind) to another
+            database : its engines are created on the next use
+        """
+        self.session.remove()
+        self.dispose(app)
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        binds = app.config.get('SQLALCHEMY_BINDS')
+        if binds and READONLY_BIND in binds:
+            binds[READONLY_BIND] = uri
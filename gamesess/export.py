@@ -0,0 +1,191 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Exports of the sessions of a club : an iCalendar feed and a JSON feed.
+
+    Both are generators of encoded chunks, meant for a streamed response.
+    The rows are read with yield_per, in batches of EXPORT_BATCH, and never
+    all loaded : the memory used does not depend on the history of the club.
+
+    The feeds of a private club are read by its members or with its feed
+    token (a calendar application does not log in).
+"""
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime
+
+from gamesess.models import GameSession, GameTable, Game, Attendance
+
+EXPORT_BATCH = 500
+CHUNK_SIZE = 16384 # bytes
+ICAL_PRODID = u'-//gamesess//Seances de club//FR'
+ICAL_LINE = 75 # octets, RFC 5545
+# compact, and without sort_keys which disables the C encoder
+_json = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def feed_token(secret, club_id):
+    """ The token of the feeds of a club, derived from the secret key of the
+        application : it changes with that key
+    """
+    return hmac.new(str(secret), 'club-feed:%i' % club_id, hashlib.sha256).hexdigest()[:32]
+
+
+def _chunks(pieces, size=CHUNK_SIZE):
+    """ Groups small encoded pieces into chunks of about `size` bytes """
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _ical_text(value):
+    """ Escapes a TEXT value of iCalendar """
+    return (value or u'').replace(u'\\', u'\\\\').replace(u';', u'\\;').replace(u',', u'\\,')\
+        .replace(u'\r\n', u'\\n').replace(u'\n', u'\\n')
+
+
+def _ical_line(name, value):
+    """ One content line, folded at 75 octets without splitting a character """
+    line = u'%s:%s' % (name, value)
+    encoded = line.encode('utf-8')
+    if len(encoded) <= ICAL_LINE:
+        return encoded + '\r\n'
+    parts, current, limit = [], '', ICAL_LINE
+    for char in line:
+        encoded = char.encode('utf-8')
+        if len(current) + len(encoded) > limit:
+            parts.append(current)
+            # the continuation lines start with a space
+            current, limit = '', ICAL_LINE - 1
+        current += encoded
+    parts.append(current)
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _ical_local(value):
+    """ Floating local time : the dates are stored in the local time of the club """
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def _ical_utc(value):
+    return datetime.utcfromtimestamp(time.mktime(value.timetuple())).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _ical_event(uid, summary, description, begin, end, modified):
+    lines = [('BEGIN', 'VEVENT'), ('UID', uid),
+             ('DTSTAMP', _ical_utc(modified or begin)),
+             ('DTSTART', _ical_local(begin)), ('DTEND', _ical_local(end)),
+             ('SUMMARY', _ical_text(summary))]
+    if description:
+        lines.append(('DESCRIPTION', _ical_text(description)))
+    lines.append(('END', 'VEVENT'))
+    return ''.join(_ical_line(name, value) for name, value in lines)
+
+
+def club_sessions(session, club_id):
+    """ The active sessions of a club, as rows, by date """
+    return session.query(GameSession.id, GameSession.name, GameSession.type, GameSession.state,
+                         GameSession.begin, GameSession.end, GameSession.modified)\
+        .filter(GameSession.club_id == club_id, GameSession.active == True)\
+        .order_by(GameSession.begin)\
+        .yield_per(EXPORT_BATCH)
+
+
+def club_tables(session, club_id):
+    """ The active tables of the active sessions of a club, as rows, by
+        session date (the tables of a session come from its index)
+    """
+    return session.query(GameTable.id, GameTable.session_id, GameTable.name, GameTable.begin,
+                         GameTable.end, GameTable.min_part, GameTable.max_part,
+                         GameTable.seats_taken, GameTable.modified, GameTable.game_id, Game.name)\
+        .join(GameSession, GameTable.session_id == GameSession.id)\
+        .outerjoin(Game, GameTable.game_id == Game.id)\
+        .filter(GameSession.club_id == club_id, GameSession.active == True,
+                GameTable.active == True)\
+        .order_by(GameSession.begin)\
+        .yield_per(EXPORT_BATCH)
+
+
+def club_attendances(session, club_id):
+    """ The active attendances at the tables of club_tables, as rows """
+    return session.query(Attendance.id, Attendance.table_id, Attendance.gamer_id, Attendance.name,
+                         Attendance.modified)\
+        .join(GameTable, Attendance.table_id == GameTable.id)\
+        .join(GameSession, GameTable.session_id == GameSession.id)\
+        .filter(GameSession.club_id == club_id, GameSession.active == True,
+                GameTable.active == True, Attendance.active == True)\
+        .order_by(GameSession.begin)\
+        .yield_per(EXPORT_BATCH)
+
+
+def club_ical(session, club):
+    """ The iCalendar feed of a club : one event per session and one per
+        scheduled table
+    """
+    def pieces():
+        yield ''.join(_ical_line(name, value) for name, value in [
+            ('BEGIN', 'VCALENDAR'), ('VERSION', '2.0'), ('PRODID', ICAL_PRODID),
+            ('CALSCALE', 'GREGORIAN'), ('X-WR-CALNAME', _ical_text(club.name))])
+        for session_id, name, kind, state, begin, end, modified in club_sessions(session, club.id):
+            yield _ical_event(u'gamesession-%i@gamesess' % session_id, name,
+                              u' - '.join(value for value in (kind, state) if value),
+                              begin, end, modified)
+        for row in club_tables(session, club.id):
+            table_id, session_id, name, begin, end = row[:5]
+            modified, game_name = row[8], row[10]
+            if begin is None or end is None:
+                continue
+            yield _ical_event(u'gametable-%i@gamesess' % table_id,
+                              name or game_name or u'Table %i' % table_id,
+                              game_name, begin, end, modified)
+        yield _ical_line('END', 'VCALENDAR')
+    return _chunks(pieces())
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _json_array(name, keys, rows):
+    """ `"name": [...]` with one object per row """
+    yield '"%s":[' % name
+    separator = ''
+    for row in rows:
+        yield separator + _json(dict(zip(keys, [_json_value(value) for value in row])))
+        separator = ','
+    yield ']'
+
+
+def club_json(session, club, gamer_ids=True):
+    """ The JSON feed of a club : the club, then flat arrays of its
+        sessions, tables and attendances, linked by their ids. Without
+        `gamer_ids`, the attendances do not tell who attends.
+    """
+    attendance_keys = ('id', 'table_id', 'gamer_id', 'status', 'modified')
+    attendances = club_attendances(session, club.id)
+    if not gamer_ids:
+        attendance_keys = ('id', 'table_id', 'status', 'modified')
+        attendances = (row[:2] + row[3:] for row in attendances)
+
+    def pieces():
+        yield '{"club":%s,' % _json({'id': club.id, 'name': club.name, 'address': club.address})
+        for piece in _json_array('sessions', ('id', 'name', 'type', 'state', 'begin', 'end', 'modified'),
+                                 club_sessions(session, club.id)):
+            yield piece
+        yield ','
+        for piece in _json_array('tables', ('id', 'session_id', 'name', 'begin', 'end', 'min_part',
+                                            'max_part', 'seats_taken', 'modified', 'game_id', 'game'),
+                                 club_tables(session, club.id)):
+            yield piece
+        yield ','
+        for piece in _json_array('attendances', attendance_keys, attendances):
+            yield piece
+        yield '}'
+    return _chunks(pieces())
@@ -0,0 +1,37 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" The extensions of the application, created unbound : create_app binds
+    them to the application it builds.
+
+    The listeners of the ORM events are global (they watch every Session) :
+    they are registered here once, whatever the number of applications.
+"""
+from flask.ext.bootstrap import Bootstrap
+from flask.ext.login import LoginManager
+
+from gamesess.cache import ResponseCache
+from gamesess.database import Database
+from gamesess.images import ImageStore
+from gamesess.live import LiveHub
+from gamesess.notifications import watch_session_states
+from gamesess.models import Base, Gamer, Club, Game, GameSession, GamerClub, GameTable, Attendance
+from gamesess.services import table_occupancy
+
+db = Database()
+db.Model = Base
+
+login_manager = LoginManager()
+login_manager.login_view = 'auth.login'
+
+bootstrap = Bootstrap()
+
+response_cache = ResponseCache()
+response_cache.watch(Club, GamerClub, GameSession, GameTable, Attendance, Game, Gamer)
+
+image_store = ImageStore()
+
+live_hub = LiveHub()
+live_hub.watch_occupancy(table_occupancy)
+
+# the attendees are told by the job workers
+watch_session_states()
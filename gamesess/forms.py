@@ -3,6 +3,7 @@
 #from flask_wtf import Form
 #from wtforms import Form
 from flask.ext.wtf import Form
+from flask.ext.wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import Required, Email, Length
 
@@ -11,3 +12,10 @@ class LoginForm(Form):
     password = PasswordField('Password', validators=[Required()])
     remember_me = BooleanField('Keep me logged in')
     submit = SubmitField('LogIn')
+
+class SeatForm(Form):
+    submit = SubmitField('OK')
+
+class ImageForm(Form):
+    image = FileField('Image', validators=[FileRequired()])
+    submit = SubmitField('Envoyer')
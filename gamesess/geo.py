@@ -0,0 +1,143 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Clubs near a point : the coordinates of the public clubs in a spatial
+    index, an SQLite R*Tree.
+
+    Every active public club with coordinates has a (point) box in the
+    R*Tree, kept up to date by triggers on the club table like the search
+    index. A search within a radius selects the candidates in the bounding
+    box of the circle through the R*Tree, then computes the great circle
+    (haversine) distance of these candidates only. The nearest clubs are
+    searched within a growing radius.
+
+    The R*Tree stores 32-bit floats rounded outwards : the boxes are a few
+    metres larger, never smaller, and the distances are computed from the
+    coordinates of the club table.
+"""
+from collections import namedtuple
+from math import asin, ceil, cos, degrees, log, radians, sin, sqrt, pi
+
+from sqlalchemy import event
+
+from gamesess.models import Base
+
+GEO_TABLE = 'club_geo'
+EARTH_RADIUS = 6371.0088 # km, mean radius
+HALF_CIRCUMFERENCE = pi * EARTH_RADIUS
+GEO_CONDITION = (u'{row}.active AND {row}.public AND {row}.latitude IS NOT NULL '
+                 u'AND {row}.longitude IS NOT NULL')
+# first radius of the nearest clubs search, in km : doubled until enough clubs
+NEAREST_RADIUS = 10.0
+# enough to reach the antipode from NEAREST_RADIUS
+MAX_DOUBLINGS = int(ceil(log(HALF_CIRCUMFERENCE / NEAREST_RADIUS, 2)))
+
+NearbyClub = namedtuple('NearbyClub', 'club_id distance')
+
+
+def geo_ddl():
+    """ The statements creating the R*Tree and its triggers """
+    insert = (u'INSERT INTO %s SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude '
+              u'WHERE %s;' % (GEO_TABLE, GEO_CONDITION.format(row='new')))
+    delete = u'DELETE FROM %s WHERE id = old.id;' % GEO_TABLE
+    return [
+        u'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING rtree(id, min_lat, max_lat, min_lon, max_lon)'
+        % GEO_TABLE,
+        u'CREATE TRIGGER IF NOT EXISTS club_geo_insert AFTER INSERT ON club BEGIN %s END' % insert,
+        u'CREATE TRIGGER IF NOT EXISTS club_geo_update AFTER UPDATE OF latitude, longitude, active, public '
+        u'ON club BEGIN %s %s END' % (delete, insert),
+        u'CREATE TRIGGER IF NOT EXISTS club_geo_delete AFTER DELETE ON club BEGIN %s END' % delete,
+    ]
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_geo_index(target, connection, **kw):
+    """ Creates the R*Tree and its triggers with the tables, when missing.
+        A new R*Tree on an existing club table must be filled (see
+        upgrade_schema).
+    """
+    if connection.dialect.name == 'sqlite':
+        for statement in geo_ddl():
+            connection.execute(statement)
+
+
+def fill_geo(connection):
+    """ Refills the R*Tree from the club table, through a connection or a
+        session. Returns the number of clubs indexed.
+    """
+    connection.execute(u'DELETE FROM %s' % GEO_TABLE)
+    connection.execute(u'INSERT INTO %s SELECT id, latitude, latitude, longitude, longitude '
+                       u'FROM club WHERE %s' % (GEO_TABLE, GEO_CONDITION.format(row='club')))
+    return connection.execute(u'SELECT count(*) FROM %s' % GEO_TABLE).scalar()
+
+
+def haversine(latitude, longitude, other_latitude, other_longitude):
+    """ Great circle distance between two points, in km """
+    half_lat = radians(other_latitude - latitude) / 2
+    half_lon = radians(other_longitude - longitude) / 2
+    a = sin(half_lat) ** 2 + cos(radians(latitude)) * cos(radians(other_latitude)) * sin(half_lon) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+
+def bounding_boxes(latitude, longitude, radius):
+    """ The (south, north, west, east) boxes in degrees covering the circle
+        of `radius` km around a point : one box, two when the circle
+        crosses the antimeridian
+    """
+    angle = radius / EARTH_RADIUS
+    south, north = latitude - degrees(angle), latitude + degrees(angle)
+    if south <= -90 or north >= 90 or sin(angle) >= cos(radians(latitude)):
+        # a pole is within the circle : every longitude
+        return [(max(south, -90.0), min(north, 90.0), -180.0, 180.0)]
+    delta = degrees(asin(sin(angle) / cos(radians(latitude))))
+    west, east = longitude - delta, longitude + delta
+    if west < -180:
+        return [(south, north, west + 360, 180.0), (south, north, -180.0, east)]
+    if east > 180:
+        return [(south, north, west, 180.0), (south, north, -180.0, east - 360)]
+    return [(south, north, west, east)]
+
+
+def candidates(session, boxes):
+    """ The (id, latitude, longitude) of the indexed clubs within the boxes """
+    sql = (u'SELECT club.id, club.latitude, club.longitude FROM %s JOIN club ON club.id = %s.id '
+           u'WHERE max_lat >= :south AND min_lat <= :north AND max_lon >= :west AND min_lon <= :east'
+           % (GEO_TABLE, GEO_TABLE))
+    rows = []
+    for south, north, west, east in boxes:
+        rows.extend(session.execute(sql, {'south': south, 'north': north, 'west': west, 'east': east}))
+    return rows
+
+
+def nearby_clubs(session, latitude, longitude, radius, limit=None):
+    """ The public clubs within `radius` km of a point, nearest first, as
+        NearbyClub
+    """
+    rows = candidates(session, bounding_boxes(latitude, longitude, radius))
+    # the terms of the origin once, then one pass over the candidates
+    lat, lon = radians(latitude), radians(longitude)
+    cos_lat = cos(lat)
+    diameter = 2 * EARTH_RADIUS
+    hits = []
+    for club_id, club_lat, club_lon in rows:
+        club_lat, club_lon = radians(club_lat), radians(club_lon)
+        a = sin((club_lat - lat) / 2) ** 2 + cos_lat * cos(club_lat) * sin((club_lon - lon) / 2) ** 2
+        distance = diameter * asin(min(1.0, sqrt(a)))
+        if distance <= radius:
+            hits.append(NearbyClub(club_id, distance))
+    hits.sort(key=lambda hit: hit.distance)
+    return hits[:limit] if limit else hits
+
+
+def nearest_clubs(session, latitude, longitude, count, max_radius=HALF_CIRCUMFERENCE):
+    """ The `count` public clubs nearest to a point within `max_radius` km,
+        as NearbyClub. Searches within NEAREST_RADIUS, doubled until enough
+        clubs are found (at most MAX_DOUBLINGS times) : the clubs within a
+        radius are exactly the nearest.
+    """
+    radius = min(NEAREST_RADIUS, max_radius)
+    for doubling in range(MAX_DOUBLINGS):
+        hits = nearby_clubs(session, latitude, longitude, radius, count)
+        if len(hits) >= count or radius >= max_radius:
+            return hits
+        radius = min(radius * 2, max_radius)
+    return nearby_clubs(session, latitude, longitude, radius, count)
@@ -0,0 +1,55 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Cache of the authenticated identities used by the Flask-Login user_loader.
+
+    Entries are detached GamerIdentity objects : reading them never hits the
+    database. A gamer is evicted as soon as a change to it (deactivation, new
+    password hash, ...) is flushed, and once more when that change is committed
+    (a concurrent request may have cached the old row in between). Other
+    workers see the change when the TTL expires.
+"""
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from gamesess.cache import LRUCache
+from gamesess.models import Gamer, GamerIdentity
+
+identity_cache = LRUCache(max_size=1024, ttl=60)
+
+
+def init_identity_cache(app):
+    identity_cache.configure(
+        max_size=app.config.get('USER_CACHE_SIZE', 1024),
+        ttl=app.config.get('USER_CACHE_TTL', 60))
+
+
+def load_identity(session, user_id):
+    """ Returns the GamerIdentity of an active gamer, from the cache if possible """
+    identity = identity_cache.get(user_id)
+    if identity is None:
+        gamer = session.query(Gamer).filter_by(id=user_id, active=True).first()
+        if gamer is None:
+            return None
+        identity = GamerIdentity.from_gamer(gamer)
+        identity_cache.set(user_id, identity)
+    return identity
+
+
+@event.listens_for(Session, 'after_flush')
+def _evict_flushed_gamers(session, flush_context):
+    changed = session.info.setdefault('changed_gamer_ids', set())
+    for instance in list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Gamer) and instance.id is not None:
+            changed.add(instance.id)
+            identity_cache.invalidate(instance.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _evict_committed_gamers(session):
+    for gamer_id in session.info.pop('changed_gamer_ids', ()):
+        identity_cache.invalidate(gamer_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_flushed_gamers(session):
+    session.info.pop('changed_gamer_ids', None)
@@ -0,0 +1,253 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Uploaded images (box art of the games, logos of the clubs), stored by
+    content on the local disk.
+
+    An image is named after the SHA-256 of its bytes : <digest>.<ext>. The
+    original is written once under IMAGE_ROOT/original/, the resized
+    variants (VARIANTS, JPEG) under IMAGE_ROOT/<variant>/ by a pool of
+    worker processes (IMAGE_WORKERS) right after the upload, or by
+    manage.py make_thumbnails. A request never resizes anything : until its
+    variant is ready, the original is sent without long-lived caching.
+
+    A file never changes once written (written aside then renamed), so the
+    responses carry an immutable Cache-Control for a year. The files are
+    sent by the WSGI server (wsgi.file_wrapper, sendfile with gunicorn) or
+    by the front server with USE_X_SENDFILE, with Range support.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+from multiprocessing import Pool
+
+from flask import request, send_file
+
+ORIGINAL = 'original'
+# variant : the box (pixels) the image is fitted in
+VARIANTS = {
+    'thumb': (160, 160),
+    'medium': (640, 640),
+}
+VARIANT_EXT = 'jpg'
+JPEG_QUALITY = 85
+# the first bytes of the accepted formats
+SIGNATURES = (
+    ('\xff\xd8\xff', 'jpg'),
+    ('\x89PNG\r\n\x1a\n', 'png'),
+    ('GIF87a', 'gif'),
+    ('GIF89a', 'gif'),
+)
+NAME = re.compile(r'^[0-9a-f]{64}\.(jpg|png|gif)$')
+CHUNK = 65536
+YEAR = 365 * 24 * 3600
+
+
+def image_type(head):
+    """ The extension of an image from its first bytes, None when unknown """
+    for signature, ext in SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+def image_path(root, variant, name):
+    """ Files are spread over 256 directories per variant """
+    if variant != ORIGINAL:
+        name = '%s.%s' % (name.split('.')[0], VARIANT_EXT)
+    return os.path.join(root, variant, name[:2], name)
+
+
+def _makedirs(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created meanwhile by another process
+            if not os.path.isdir(directory):
+                raise
+    return directory
+
+
+def _write_aside(path, write):
+    """ Writes a file through a temporary file renamed at the end : the
+        readers never see a partial file
+    """
+    directory = _makedirs(os.path.dirname(path))
+    handle, temporary = tempfile.mkstemp(dir=directory, prefix='.upload-')
+    try:
+        with os.fdopen(handle, 'wb') as target:
+            result = write(target)
+        os.rename(temporary, path)
+    except:
+        os.unlink(temporary)
+        raise
+    return result
+
+
+def make_variants(root, name, variants=VARIANTS):
+    """ Writes the missing variants of an original : the names of the
+        variants made. Runs in the worker processes (or in manage.py), never
+        in a request.
+    """
+    from PIL import Image
+    missing = [variant for variant in sorted(variants)
+               if not os.path.exists(image_path(root, variant, name))]
+    if not missing:
+        return []
+    original = Image.open(image_path(root, ORIGINAL, name))
+    largest = max(variants[variant] for variant in missing)
+    # JPEG : decode at the smallest scale still larger than the variants
+    original.draft('RGB', largest)
+    if original.mode in ('RGBA', 'LA', 'P'):
+        original = original.convert('RGBA')
+        background = Image.new('RGB', original.size, (255, 255, 255))
+        background.paste(original, mask=original.split()[-1])
+        original = background
+    elif original.mode != 'RGB':
+        original = original.convert('RGB')
+    for variant in missing:
+        resized = original.copy()
+        resized.thumbnail(variants[variant], Image.ANTIALIAS)
+        _write_aside(image_path(root, variant, name),
+                     lambda target: resized.save(target, 'JPEG', quality=JPEG_QUALITY,
+                                                 optimize=True, progressive=True))
+    return missing
+
+
+def _make_variants(args):
+    """ make_variants for the pools : (name, variants made, error) """
+    root, name = args
+    try:
+        return name, make_variants(root, name), None
+    except Exception as error:
+        return name, [], u'%s' % error
+
+
+class ImageStore(object):
+    """ The images of an application and its pool of resizing workers """
+
+    def __init__(self, root=None, workers=0, max_bytes=8 * 1024 * 1024):
+        self.root = root
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger(__name__)
+        self._pool = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.root = app.config['IMAGE_ROOT']
+        self.workers = app.config['IMAGE_WORKERS']
+        self.max_bytes = app.config['IMAGE_MAX_BYTES']
+        self.logger = app.logger
+
+    def path(self, variant, name):
+        return image_path(self.root, variant, name)
+
+    def save(self, stream):
+        """ Stores an uploaded image and returns its name. Raises ValueError
+            for an unknown format or a file larger than max_bytes.
+        """
+        head = stream.read(CHUNK)
+        ext = image_type(head)
+        if ext is None:
+            raise ValueError(u'Unsupported image format (JPEG, PNG or GIF)')
+        digest = hashlib.sha256()
+
+        def write(target):
+            size, chunk = 0, head
+            while chunk:
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ValueError(u'Image larger than %i bytes' % self.max_bytes)
+                digest.update(chunk)
+                target.write(chunk)
+                chunk = stream.read(CHUNK)
+        # the name is only known at the end : written aside, then moved
+        incoming = _makedirs(os.path.join(self.root, ORIGINAL, 'incoming'))
+        handle, partial = tempfile.mkstemp(dir=incoming)
+        try:
+            with os.fdopen(handle, 'wb') as target:
+                write(target)
+            name = '%s.%s' % (digest.hexdigest(), ext)
+            path = self.path(ORIGINAL, name)
+            if os.path.exists(path):
+                # the same image was already uploaded
+                os.unlink(partial)
+            else:
+                _makedirs(os.path.dirname(path))
+                os.rename(partial, path)
+        except:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise
+        return name
+
+    def _worker_pool(self):
+        # a pool is not shared with a forked child (server workers)
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = Pool(self.workers)
+            self._pid = os.getpid()
+        return self._pool
+
+    def submit(self, name):
+        """ Queues the resizing of an image, when the store has workers.
+            A failure is logged : the original is sent meanwhile, and
+            make_thumbnails tries again.
+        """
+        if self.workers:
+            self._worker_pool().apply_async(_make_variants, ((self.root, name),), callback=self._resized)
+
+    def _resized(self, result):
+        # in the result thread of the pool
+        name, made, error = result
+        if error is not None:
+            self.logger.error(u'Resizing of the image %s failed : %s', name, error)
+
+    def originals(self):
+        """ The names of the stored originals """
+        directory = os.path.join(self.root, ORIGINAL)
+        for shard in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+            if len(shard) == 2:
+                for name in sorted(os.listdir(os.path.join(directory, shard))):
+                    if NAME.match(name):
+                        yield name
+
+    def make_missing(self, processes=None):
+        """ Makes the missing variants of every original with a pool of
+            `processes` : yields (name, variants made, error)
+        """
+        pool = Pool(processes)
+        try:
+            for result in pool.imap_unordered(_make_variants, ((self.root, name) for name in self.originals())):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def send(self, variant, name):
+        """ The response sending a variant of an image (404 when unknown) """
+        if not NAME.match(name) or (variant != ORIGINAL and variant not in VARIANTS):
+            return None
+        path = self.path(variant, name)
+        immutable = True
+        if variant != ORIGINAL and not os.path.exists(path):
+            # not resized yet : the original, for now
+            path, immutable = self.path(ORIGINAL, name), False
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        response = send_file(path, mimetype=mimetypes.guess_type(path)[0], add_etags=False,
+                             cache_timeout=immutable and YEAR or 0)
+        response.set_etag('%s-%s' % (variant, os.path.basename(path)))
+        if immutable:
+            response.headers['Cache-Control'] = 'public, max-age=%i, immutable' % YEAR
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        if response.headers.get('X-Sendfile'):
+            # the front server answers the conditions and the ranges
+            return response
+        return response.make_conditional(request, accept_ranges=True, complete_length=size)
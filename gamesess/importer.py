@@ -0,0 +1,312 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Bulk import of club rosters and game catalogs from CSV or JSON files.
+
+    Rows are streamed from the file and inserted with executemany in batches,
+    inside large transactions. Primary keys are allocated in memory from the
+    current maximum id, so foreign keys (creator, parent game, club, gamer)
+    are resolved without reading back the inserted rows : an import must be
+    the only writer of the tables it fills while it runs.
+"""
+import csv
+import io
+import json
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+from sqlalchemy import bindparam, func
+
+from gamesess.models import Gamer, Club, GamerClub, Game, GamePlayers, parse_parts
+from gamesess.security import hasher
+
+
+def read_rows(path):
+    """ Yields the rows of a .csv (with a header line), .jsonl (one object
+        per line) or .json (a list of objects) file as dicts of unicode.
+    """
+    if path.endswith('.csv'):
+        with open(path, 'rb') as source:
+            for row in csv.DictReader(source):
+                yield dict((key.decode('utf-8'), (value or '').decode('utf-8'))
+                           for key, value in row.items())
+    elif path.endswith('.jsonl'):
+        with io.open(path, encoding='utf-8') as source:
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+    elif path.endswith('.json'):
+        # a JSON document can only be parsed as a whole
+        with io.open(path, encoding='utf-8') as source:
+            for row in json.load(source):
+                yield row
+    else:
+        raise ValueError(u'Unsupported file type : %s' % path)
+
+
+def _hash_password(password):
+    return hasher.hash(password)
+
+
+def _value(row, key):
+    value = row.get(key)
+    if isinstance(value, basestring):
+        value = value.strip()
+    return value or None
+
+
+def _coordinates(row):
+    """ The (latitude, longitude) of a row in degrees, (None, None) when
+        missing. Raises ValueError on invalid coordinates.
+    """
+    latitude, longitude = row.get('latitude'), row.get('longitude')
+    if isinstance(latitude, basestring):
+        latitude = latitude.strip()
+    if isinstance(longitude, basestring):
+        longitude = longitude.strip()
+    if latitude in (None, u'') and longitude in (None, u''):
+        return None, None
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError(u'Invalid coordinates : %s, %s' % (row.get('latitude'), row.get('longitude')))
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError(u'Invalid coordinates : %s, %s' % (latitude, longitude))
+    return latitude, longitude
+
+
+class BulkImporter(object):
+    """ Imports rows of one kind (gamers, clubs, members, games) in batches.
+
+        Gamers are referenced by email or login, clubs and games by name.
+        Rows already in the database (same email/login or name) are skipped.
+    """
+    kinds = ('gamers', 'clubs', 'members', 'games')
+
+    def __init__(self, session, batch_size=1000, commit_every=50000, processes=None):
+        self.session = session
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.processes = processes
+        self.inserted = 0
+        self.skipped = 0
+        self.errors = []
+        self._gamers = None
+        self._clubs = None
+        self._games = None
+        self._next_ids = {}
+        self._pending_parents = []
+
+    # in-memory resolution of the foreign keys
+
+    def _next_id(self, model):
+        if model not in self._next_ids:
+            self._next_ids[model] = (self.session.query(func.max(model.id)).scalar() or 0) + 1
+        value = self._next_ids[model]
+        self._next_ids[model] += 1
+        return value
+
+    @property
+    def gamers(self):
+        if self._gamers is None:
+            self._gamers = {}
+            for gamer_id, email, login in self.session.query(Gamer.id, Gamer.email, Gamer.login):
+                for key in (email, login):
+                    if key:
+                        self._gamers[key.lower()] = gamer_id
+        return self._gamers
+
+    @property
+    def clubs(self):
+        if self._clubs is None:
+            self._clubs = dict((name, club_id) for club_id, name in self.session.query(Club.id, Club.name))
+        return self._clubs
+
+    @property
+    def games(self):
+        if self._games is None:
+            self._games = dict((name, game_id) for game_id, name in self.session.query(Game.id, Game.name))
+        return self._games
+
+    def _gamer_id(self, reference):
+        return reference and self.gamers.get(reference.lower()) or None
+
+    # batches
+
+    def _batches(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _insert(self, model, records):
+        if records:
+            self.session.execute(model.__table__.insert(), records)
+
+    def _flush_batch(self, inserted_before):
+        if self.inserted // self.commit_every > inserted_before // self.commit_every:
+            self.session.commit()
+
+    def run(self, kind, rows):
+        """ Imports the rows : returns (inserted, skipped, seconds) """
+        if kind not in self.kinds:
+            raise ValueError(u'Unknown kind of rows : %s' % kind)
+        start = time.time()
+        pool = kind == 'gamers' and Pool(self.processes) or None
+        try:
+            for batch in self._batches(rows):
+                inserted_before = self.inserted
+                getattr(self, '_import_%s' % kind)(batch, pool)
+                self._flush_batch(inserted_before)
+            if kind == 'games':
+                self._link_pending_parents()
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return self.inserted, self.skipped, time.time() - start
+
+    def _import_gamers(self, batch, pool):
+        now = datetime.now()
+        fresh = []
+        # the keys of the batch : self.gamers only gets them once hashed
+        batch_keys = set()
+        for row in batch:
+            keys = [key.lower() for key in (_value(row, 'email'), _value(row, 'login')) if key]
+            if not keys or any(key in self.gamers or key in batch_keys for key in keys):
+                self.skipped += 1
+                continue
+            birthdate = _value(row, 'birthdate')
+            try:
+                birthdate = birthdate and datetime.strptime(birthdate, '%Y-%m-%d').date()
+            except ValueError:
+                self.skipped += 1
+                self.errors.append(u'Invalid birthdate for %s : %s' % (keys[0], birthdate))
+                continue
+            batch_keys.update(keys)
+            fresh.append((row, keys, birthdate))
+        passwords = [_value(row, 'password') for row, keys, birthdate in fresh]
+        to_hash = [password for password in passwords if password]
+        hashes = iter(pool.map(_hash_password, to_hash, chunksize=max(len(to_hash) // 32, 1)))
+        records = []
+        for (row, keys, birthdate), password in zip(fresh, passwords):
+            gamer_id = self._next_id(Gamer)
+            records.append({
+                'id': gamer_id, 'created': now, 'modified': now, 'active': True,
+                'create_id': self._gamer_id(_value(row, 'creator')),
+                'first_name': _value(row, 'first_name'),
+                'last_name': _value(row, 'last_name'),
+                'surname': _value(row, 'surname'),
+                'login': _value(row, 'login') or _value(row, 'email'),
+                'email': _value(row, 'email'),
+                'birthdate': birthdate,
+                'password_hashed': password and next(hashes) or None,
+            })
+            for key in keys:
+                self.gamers[key] = gamer_id
+        self._insert(Gamer, records)
+        self.inserted += len(records)
+
+    def _import_clubs(self, batch, pool):
+        now = datetime.now()
+        records = []
+        for row in batch:
+            name = _value(row, 'name')
+            if not name or name in self.clubs:
+                self.skipped += 1
+                continue
+            try:
+                latitude, longitude = _coordinates(row)
+            except ValueError as error:
+                self.skipped += 1
+                self.errors.append(unicode(error))
+                continue
+            club_id = self._next_id(Club)
+            records.append({
+                'id': club_id, 'created': now, 'modified': now, 'active': True,
+                'create_id': self._gamer_id(_value(row, 'creator')),
+                'name': name,
+                'description': _value(row, 'description'),
+                'address': _value(row, 'address'),
+                'public': _value(row, 'public') in (True, 1, u'1', u'true', u'yes', u'oui'),
+                'latitude': latitude, 'longitude': longitude,
+            })
+            self.clubs[name] = club_id
+        self._insert(Club, records)
+        self.inserted += len(records)
+
+    def _import_members(self, batch, pool):
+        now = datetime.now()
+        records = []
+        for row in batch:
+            club_id = self.clubs.get(_value(row, 'club'))
+            gamer_id = self._gamer_id(_value(row, 'gamer'))
+            if club_id is None or gamer_id is None:
+                self.skipped += 1
+                self.errors.append(u'Unknown club or gamer : %s / %s' % (row.get('club'), row.get('gamer')))
+                continue
+            records.append({
+                'created': now, 'modified': now, 'active': True,
+                'create_id': self._gamer_id(_value(row, 'creator')),
+                'club_id': club_id, 'gamer_id': gamer_id,
+                'role': _value(row, 'role') or u'user',
+            })
+        self._insert(GamerClub, records)
+        self.inserted += len(records)
+
+    def _import_games(self, batch, pool):
+        now = datetime.now()
+        records = []
+        players = []
+        for row in batch:
+            name = _value(row, 'name')
+            if not name or name in self.games:
+                self.skipped += 1
+                continue
+            parts = _value(row, 'parts')
+            try:
+                counts = parse_parts(parts)
+            except ValueError as error:
+                self.skipped += 1
+                self.errors.append(unicode(error))
+                continue
+            game_id = self._next_id(Game)
+            parent = _value(row, 'parent')
+            parent_id = parent and self.games.get(parent)
+            if parent and parent_id is None:
+                # the parent may come later in the file
+                self._pending_parents.append((game_id, parent))
+            duration = _value(row, 'average_duration')
+            records.append({
+                'id': game_id, 'created': now, 'modified': now, 'active': True,
+                'create_id': self._gamer_id(_value(row, 'creator')),
+                'name': name, 'parts': parts, 'parent_id': parent_id,
+                'average_duration': duration and int(duration) or None,
+            })
+            players.extend({'game_id': game_id, 'players': count} for count in counts)
+            self.games[name] = game_id
+        self._insert(Game, records)
+        self._insert(GamePlayers, players)
+        self.inserted += len(records)
+
+    def _link_pending_parents(self):
+        links = []
+        for game_id, parent in self._pending_parents:
+            parent_id = self.games.get(parent)
+            if parent_id is None:
+                self.errors.append(u'Unknown parent game : %s' % parent)
+            else:
+                links.append({'game_id': game_id, 'parent': parent_id})
+        if links:
+            table = Game.__table__
+            self.session.execute(
+                table.update().where(table.c.id == bindparam('game_id')).values(parent_id=bindparam('parent')),
+                links)
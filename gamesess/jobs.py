@@ -0,0 +1,289 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Deferred work : a persistent queue of jobs in the database, run by
+    worker processes (manage.py run_jobs), no broker needed.
+
+    A job is queued (enqueue) within the transaction of the change that
+    calls for it : it exists if and only if the change is committed. A job
+    queued again with the same kind and key while still pending is not
+    duplicated (a unique partial index on the pending jobs).
+
+    A worker claims a batch of due jobs in one IMMEDIATE transaction and
+    holds them for JOB_LEASE seconds : the jobs of a worker that died are
+    claimed again after. Each job runs in its own IMMEDIATE transaction
+    (SQLite has one writer), its handler writes and the job marked done
+    committed together. A job that fails is
+    retried after JOB_BACKOFF seconds, doubled at each attempt (with some
+    jitter) up to JOB_MAX_BACKOFF, and given up after JOB_MAX_ATTEMPTS.
+
+    Delivery is at least once : a handler with effects outside of the
+    database (a mail sent) must tolerate running again.
+
+    The handlers are registered by kind with @job, at import time.
+"""
+import json
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from collections import namedtuple, defaultdict
+from datetime import datetime, timedelta
+from itertools import count
+
+from sqlalchemy import and_, or_, select, func
+
+from gamesess.models import Job, JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+JobHandler = namedtuple('JobHandler', 'function max_attempts')
+KindStats = namedtuple('KindStats', 'kind pending running done failed retries mean_latency max_latency throughput')
+
+HANDLERS = {}
+# called by the workers when the queue is empty, with no argument
+IDLE_HOOKS = []
+
+_claims = count(1)
+
+
+def job(kind, max_attempts=None):
+    """ Registers the handler of a kind of job : function(session, payload) """
+    def register(function):
+        HANDLERS[kind] = JobHandler(function, max_attempts)
+        return function
+    return register
+
+
+def on_idle(function):
+    IDLE_HOOKS.append(function)
+    return function
+
+
+def enqueue(session, kind, payload=None, key=None, delay=0):
+    """ Queues a job in the transaction of `session`, to run in `delay`
+        seconds. Returns False when a pending job of the same kind and key
+        already exists (it stays as it is).
+    """
+    now = datetime.now()
+    result = session.execute(Job.__table__.insert().prefix_with('OR IGNORE'), {
+        'created': now, 'kind': kind, 'key': key, 'payload': json.dumps(payload),
+        'state': JOB_PENDING, 'attempts': 0, 'run_at': now + timedelta(seconds=delay)})
+    return result.rowcount == 1
+
+
+def backoff(attempts, base, cap):
+    """ Seconds before the retry of a job failed `attempts` times """
+    delay = min(cap, base * 2 ** (attempts - 1))
+    # spread the retries of the jobs failed together
+    return delay * (0.5 + random.random() / 2)
+
+
+def claim(session, worker, limit, lease):
+    """ Claims up to `limit` due jobs for `lease` seconds : their rows """
+    table = Job.__table__
+    now = datetime.now()
+    token = '%s:%s:%i' % (worker, os.getpid(), next(_claims))
+    due = select([table.c.id])\
+        .where(or_(and_(table.c.state == JOB_PENDING, table.c.run_at <= now),
+                   and_(table.c.state == JOB_RUNNING, table.c.locked_until < now)))\
+        .order_by(table.c.run_at, table.c.id)\
+        .limit(limit)
+    session.commit()
+    session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+    try:
+        session.execute(table.update()
+            .where(table.c.id.in_(due))
+            .values(state=JOB_RUNNING, locked_by=token, locked_until=now + timedelta(seconds=lease),
+                    started=now, attempts=table.c.attempts + 1))
+        rows = session.execute(select([table])
+            .where(and_(table.c.locked_by == token, table.c.state == JOB_RUNNING))
+            .order_by(table.c.run_at, table.c.id)).fetchall()
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    return rows
+
+
+def _claimed(row):
+    table = Job.__table__
+    return and_(table.c.id == row.id, table.c.locked_by == row.locked_by, table.c.state == JOB_RUNNING)
+
+
+def _retry(session, row, error, config):
+    """ Schedules the next attempt of a failed job, or gives it up """
+    table = Job.__table__
+    now = datetime.now()
+    handler = HANDLERS.get(row.kind)
+    max_attempts = handler and (handler.max_attempts or config['JOB_MAX_ATTEMPTS']) or 0
+    if row.attempts >= max_attempts:
+        session.execute(table.update().where(_claimed(row))
+            .values(state=JOB_FAILED, finished=now, locked_by=None, locked_until=None, error=error))
+        return JOB_FAILED
+    run_at = now + timedelta(seconds=backoff(row.attempts, config['JOB_BACKOFF'], config['JOB_MAX_BACKOFF']))
+    retried = session.execute(table.update().prefix_with('OR IGNORE').where(_claimed(row))
+        .values(state=JOB_PENDING, run_at=run_at, locked_by=None, locked_until=None, error=error))
+    if retried.rowcount == 0:
+        # the same job was queued again meanwhile : it does the work
+        session.execute(table.update().where(_claimed(row))
+            .values(state=JOB_DONE, finished=now, locked_by=None, locked_until=None,
+                    error=u'%s (superseded by a pending job)' % error))
+    return JOB_PENDING
+
+
+def run_job(session, row, config):
+    """ Runs a claimed job and records the outcome : done, pending (to be
+        retried), failed, or running when its lease ran out meanwhile
+    """
+    try:
+        session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+        handler = HANDLERS.get(row.kind)
+        if handler is None:
+            raise LookupError(u'No handler for the jobs %s' % row.kind)
+        handler.function(session, json.loads(row.payload or 'null'))
+        done = session.execute(Job.__table__.update().where(_claimed(row))
+            .values(state=JOB_DONE, finished=datetime.now(), locked_by=None, locked_until=None, error=None))
+        if done.rowcount == 0:
+            # the lease ran out and another worker claimed the job
+            session.rollback()
+            return JOB_RUNNING
+        session.commit()
+        return JOB_DONE
+    except Exception as error:
+        session.rollback()
+        outcome = _retry(session, row, u'%s: %s' % (type(error).__name__, error), config)
+        session.commit()
+        return outcome
+
+
+class WorkerStats(object):
+    """ The jobs run by a worker : {kind: {outcome: count}} and the time spent """
+
+    def __init__(self):
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+        self.seconds = defaultdict(float)
+
+    def add(self, kind, outcome, seconds):
+        self.outcomes[kind][outcome] += 1
+        self.seconds[kind] += seconds
+
+    @property
+    def jobs(self):
+        return sum(sum(outcomes.values()) for outcomes in self.outcomes.values())
+
+    def __str__(self):
+        return u', '.join(u'%s %s (%.2f s)' % (kind, u' '.join(u'%s %i' % item for item in sorted(outcomes.items())),
+                                               self.seconds[kind])
+                          for kind, outcomes in sorted(self.outcomes.items())) or u'no job'
+
+
+def _unfinished(session):
+    table = Job.__table__
+    return session.execute(select([table.c.id])
+        .where(table.c.state.in_((JOB_PENDING, JOB_RUNNING))).limit(1)).first() is not None
+
+
+def work(session, config, worker, drain=False, stop=None):
+    """ Claims and runs the due jobs until `stop` (a threading.Event) is
+        set or, with `drain`, until no job is pending or running. Returns
+        the WorkerStats.
+    """
+    stats = WorkerStats()
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        rows = claim(session, worker, config['JOB_BATCH'], config['JOB_LEASE'])
+        for row in rows:
+            start = time.time()
+            stats.add(row.kind, run_job(session, row, config), time.time() - start)
+        if not rows:
+            for hook in IDLE_HOOKS:
+                hook()
+            if drain and not _unfinished(session):
+                break
+            stop.wait(config['JOB_POLL_INTERVAL'])
+    for hook in IDLE_HOOKS:
+        hook()
+    session.close()
+    return stats
+
+
+def _worker_process(app, number, drain, reports):
+    from gamesess.extensions import db
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    name = '%s-%i' % (socket.gethostname(), number)
+    start = time.time()
+    with app.app_context():
+        stats = work(db.session, app.config, name, drain, stop)
+        db.session.remove()
+    if reports is not None:
+        reports.put((number, stats.jobs, time.time() - start, unicode(stats)))
+
+
+def start_workers(app, processes, drain=False, reports=None):
+    """ Starts the worker processes : the database engines must be disposed
+        of before, no connection may cross a fork. A worker that ends puts
+        (number, jobs, seconds, stats) in the multiprocessing queue reports
+    """
+    from multiprocessing import Process
+    workers = [Process(target=_worker_process, args=(app, number, drain, reports), name='jobs-worker-%i' % number)
+               for number in range(1, processes + 1)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def queue_stats(session):
+    """ KindStats of every kind of job in the table : jobs per state,
+        retries, seconds from queued to done (mean and max) and jobs done per
+        second between the first start and the last end
+    """
+    table = Job.__table__
+    latency = (func.julianday(table.c.finished) - func.julianday(table.c.created)) * 86400.0
+    states = defaultdict(dict)
+    for kind, state, jobs, attempts in session.execute(
+            select([table.c.kind, table.c.state, func.count(), func.sum(table.c.attempts)])
+            .group_by(table.c.kind, table.c.state)):
+        states[kind][state] = (jobs, attempts or 0)
+    span = (func.julianday(func.max(table.c.finished)) - func.julianday(func.min(table.c.started))) * 86400.0
+    done = dict((row[0], row[1:]) for row in session.execute(
+        select([table.c.kind, func.avg(latency), func.max(latency), span])
+        .where(table.c.state == JOB_DONE)
+        .group_by(table.c.kind)))
+    result = []
+    for kind in sorted(states):
+        jobs = dict((state, states[kind].get(state, (0, 0))[0])
+                    for state in (JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_FAILED))
+        # attempts beyond the first of the finished jobs
+        retries = sum(states[kind].get(state, (0, 0))[1] for state in (JOB_DONE, JOB_FAILED))\
+            - jobs[JOB_DONE] - jobs[JOB_FAILED]
+        mean, longest, seconds = done.get(kind, (None, None, None))
+        throughput = seconds is not None and jobs[JOB_DONE] / max(seconds, 0.001) or None
+        result.append(KindStats(kind, jobs[JOB_PENDING], jobs[JOB_RUNNING], jobs[JOB_DONE], jobs[JOB_FAILED],
+                                retries, mean, longest, throughput))
+    return result
+
+
+def purge_jobs(session, before):
+    """ Deletes the jobs done before a datetime and commits : their number """
+    table = Job.__table__
+    deleted = session.execute(table.delete()
+        .where(and_(table.c.state == JOB_DONE, table.c.finished < before))).rowcount
+    session.commit()
+    return deleted
+
+
+@job('rebuild_stats', max_attempts=3)
+def _rebuild_stats(session, payload):
+    from gamesess.stats import fill_stats
+    fill_stats(session)
+
+
+@job('invalidate_cache')
+def _invalidate_cache(session, payload):
+    """ payload : the tags (tables) to invalidate, every entry without """
+    from gamesess.extensions import response_cache
+    if payload:
+        response_cache.invalidate(*payload)
+    else:
+        response_cache.backend.clear()
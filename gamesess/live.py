@@ -0,0 +1,202 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Live updates pushed to the browsers with Server-Sent Events.
+
+    LiveHub is an in-process publish/subscribe hub : one channel per game
+    session, holding the last BACKLOG events in a ring. Publishing appends
+    to the ring and wakes the subscribers of the channel ; a subscriber only
+    keeps the id of the last event it sent. Nothing is copied per
+    subscriber and an idle subscriber costs one blocked wait : no polling.
+    The waits are plain threading primitives, so under gevent (monkey
+    patched, e.g. gunicorn -k gevent) every subscriber is a greenlet and
+    thousands of idle connections do not need thousands of threads. A
+    single heartbeat thread wakes all the channels to keep the connections
+    open through the proxies.
+
+    The event ids increase over the whole hub : a browser reconnecting with
+    Last-Event-ID gets the events it missed, or a 'reset' event when they
+    are no longer in the ring (the page must then be reloaded).
+
+    The hub lives in one process : with several worker processes, each
+    worker only pushes the changes committed by itself.
+"""
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from gamesess.models import Attendance
+
+BACKLOG = 256
+HEARTBEAT = 15 # seconds
+RESET = 'reset'
+
+
+class Channel(object):
+
+    def __init__(self, last_id):
+        self.condition = threading.Condition(threading.Lock())
+        self.events = deque(maxlen=BACKLOG)
+        # the events up to `floor` are not in the ring any more
+        self.floor = last_id
+        self.last_id = last_id
+        self.beats = 0
+        self.subscribers = 0
+
+    def since(self, last_id):
+        """ The (id, name, data) events after `last_id`, None when some of
+            them are lost. Called with the condition held.
+        """
+        if last_id < self.floor:
+            return None
+        return [item for item in self.events if item[0] > last_id]
+
+
+class LiveHub(object):
+    """ Fan-out of the events of each channel to its subscribers """
+
+    def __init__(self, heartbeat=HEARTBEAT):
+        self.heartbeat = heartbeat
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._last_id = 0
+        self._beating = False
+
+    def init_app(self, app):
+        self.heartbeat = app.config.get('LIVE_HEARTBEAT', HEARTBEAT)
+
+    def __len__(self):
+        return len(self._channels)
+
+    def subscribers(self, key):
+        channel = self._channels.get(key)
+        return channel and channel.subscribers or 0
+
+    def publish(self, key, name, data):
+        """ Sends an event to the subscribers of a channel, if any """
+        with self._lock:
+            channel = self._channels.get(key)
+            if channel is None:
+                # still counted : a channel created later starts after it
+                self._last_id = next(self._ids)
+                return None
+        with channel.condition:
+            with self._lock:
+                event_id = self._last_id = next(self._ids)
+            if len(channel.events) == channel.events.maxlen:
+                channel.floor = channel.events[0][0]
+            channel.events.append((event_id, name, data))
+            channel.last_id = event_id
+            channel.condition.notify_all()
+        return event_id
+
+    def _subscribe(self, key):
+        with self._lock:
+            channel = self._channels.get(key)
+            if channel is None:
+                channel = self._channels[key] = Channel(self._last_id)
+            channel.subscribers += 1
+            if not self._beating and self.heartbeat:
+                self._beating = True
+                beater = threading.Thread(target=self._beat, name='live-heartbeat')
+                beater.daemon = True
+                beater.start()
+            return channel
+
+    def _unsubscribe(self, key, channel):
+        with self._lock:
+            channel.subscribers -= 1
+            if not channel.subscribers and self._channels.get(key) is channel:
+                del self._channels[key]
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat)
+            self.beat()
+
+    def beat(self):
+        """ Wakes every subscriber, which sends a keep-alive """
+        for channel in list(self._channels.values()):
+            with channel.condition:
+                channel.beats += 1
+                channel.condition.notify_all()
+
+    def listen(self, key, last_id=None):
+        """ Generator of the (id, name, data) events of a channel, None for
+            a keep-alive. Starts after `last_id`, or with the next event.
+        """
+        channel = self._subscribe(key)
+        try:
+            with channel.condition:
+                seen = channel.last_id if last_id is None else last_id
+            while True:
+                with channel.condition:
+                    beats = channel.beats
+                    while channel.last_id <= seen and channel.beats == beats:
+                        channel.condition.wait()
+                    pending = channel.since(seen)
+                    last = channel.last_id
+                if pending is None:
+                    yield (last, RESET, None)
+                    seen = last
+                elif not pending:
+                    yield None
+                else:
+                    for item in pending:
+                        yield item
+                    seen = pending[-1][0]
+        finally:
+            self._unsubscribe(key, channel)
+
+    def stream(self, key, last_id=None):
+        """ The events of a channel in the text/event-stream format """
+        yield 'retry: 3000\n\n'
+        for item in self.listen(key, last_id):
+            if item is None:
+                yield ':\n\n'
+            else:
+                event_id, name, data = item
+                yield 'id: %i\nevent: %s\ndata: %s\n\n' % (
+                    event_id, name, json.dumps(data, separators=(',', ':')))
+
+    def watch_occupancy(self, occupancy):
+        """ Publishes a 'seats' event on the channel of its session for
+            every table whose attendances changed, after the commit.
+            `occupancy(session, table_ids)` returns TableOccupancy rows.
+        """
+        @event.listens_for(Session, 'after_flush')
+        def _collect_tables(db_session, flush_context):
+            if not self._channels:
+                return
+            tables = db_session.info.setdefault('live_tables', set())
+            for instance in list(db_session.new) + list(db_session.dirty) + list(db_session.deleted):
+                if isinstance(instance, Attendance) and instance.table_id is not None:
+                    tables.add(instance.table_id)
+
+        @event.listens_for(Session, 'before_commit')
+        def _read_occupancy(db_session):
+            if not self._channels:
+                return
+            # commit only flushes after this event : read the occupancy
+            # from the final state of the transaction
+            db_session.flush()
+            tables = db_session.info.pop('live_tables', None)
+            if tables:
+                db_session.info['live_occupancy'] = occupancy(db_session, tables)
+
+        @event.listens_for(Session, 'after_commit')
+        def _publish_occupancy(db_session):
+            for row in db_session.info.pop('live_occupancy', ()):
+                self.publish(row.session_id, 'seats', {
+                    'table': row.table_id, 'seated': row.seated,
+                    'remaining': row.remaining, 'waiting': row.waiting})
+
+        @event.listens_for(Session, 'after_rollback')
+        def _forget_occupancy(db_session):
+            db_session.info.pop('live_tables', None)
+            db_session.info.pop('live_occupancy', None)
@@ -0,0 +1,326 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Load tests of the application : the real routes, replayed from a plan.
+
+    A plan is a reproducible list of (route, path) requests drawn from the
+    ids of a synthetic site (see bench.seed_site). It is replayed twice :
+    through the Flask test client, one request at a time, which also counts
+    the SQL statements of every request, and through HTTP against a local
+    pre-forked server (the workers share one listening socket) by several
+    client threads, which measures the latency under concurrency and the
+    throughput. Every client logs in first through the /login form.
+
+    The results are plain dicts, saved as JSON : compare_results tells the
+    regressions between two runs.
+"""
+import Cookie
+import httplib
+import json
+import platform
+import random
+import re
+import socket
+import sqlite3
+import threading
+import time
+import urllib
+from collections import defaultdict
+from datetime import datetime
+from multiprocessing import Process
+
+from sqlalchemy.engine import Engine
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from gamesess.bench import QueryCounter, site_email, SITE_PASSWORD
+
+SEARCH_WORDS = (u'aventuriers', u'chateau', u'dra', u'liege', u'ile pirates')
+# route : (weight, path, table of the ids)
+ROUTES = (
+    ('clubs', 2, '/clubs', None),
+    ('myclubs', 1, '/myclubs', None),
+    ('club', 2, '/club/%i/', 'club'),
+    ('session', 4, '/session/%i/', 'gamesession'),
+    ('table', 4, '/table/%i/', 'gametable'),
+    ('game', 2, '/game/%i/', 'game'),
+    ('search', 1, '/search?q=%s', None),
+)
+LOGIN = 'login'
+# a slower percentile beyond the tolerance must also lose this much
+NOISE_MS = 2.0
+
+_csrf_token = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"|value="([^"]+)"[^>]*name="csrf_token"')
+
+
+def request_plan(counts, requests, seed=42):
+    """ `requests` (route, path) pairs drawn by weight, the ids within the
+        `counts` of rows returned by seed_site
+    """
+    rnd = random.Random(seed)
+    routes = [route for route in ROUTES for i in range(route[1])]
+    plan = []
+    for i in range(requests):
+        name, weight, path, table = rnd.choice(routes)
+        if table is not None:
+            path = path % rnd.randint(1, counts[table])
+        elif '%s' in path:
+            path = path % urllib.quote(rnd.choice(SEARCH_WORDS).encode('utf-8'))
+        plan.append((name, path))
+    return plan
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(samples, seconds):
+    """ The statistics of (route, milliseconds, status, statements) samples
+        collected in `seconds` seconds
+    """
+    routes = defaultdict(list)
+    for sample in samples:
+        routes[sample[0]].append(sample)
+    result = {'requests': len(samples), 'seconds': round(seconds, 3),
+              'throughput': round(len(samples) / max(seconds, 0.001), 1), 'routes': {}}
+    for name, route_samples in routes.items():
+        durations = sorted(sample[1] for sample in route_samples)
+        statements = [sample[3] for sample in route_samples if sample[3] is not None]
+        result['routes'][name] = {
+            'count': len(durations),
+            'errors': sum(1 for sample in route_samples if sample[2] >= 400),
+            'mean_ms': round(sum(durations) / len(durations), 3),
+            'p50_ms': round(percentile(durations, 0.50), 3),
+            'p95_ms': round(percentile(durations, 0.95), 3),
+            'p99_ms': round(percentile(durations, 0.99), 3),
+            'queries': statements and round(sum(statements) / float(len(statements)), 2) or None,
+        }
+    return result
+
+
+def _form_token(body):
+    match = _csrf_token.search(body)
+    return match and (match.group(1) or match.group(2)) or ''
+
+
+class TestClientDriver(object):
+    """ Requests through the Flask test client : (status, body) """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_data()
+
+    def post(self, path, data):
+        response = self.client.post(path, data=data)
+        return response.status_code, response.get_data()
+
+
+class HttpDriver(object):
+    """ Requests over one keep-alive HTTP connection, with its cookies :
+        (status, body). Redirections are not followed.
+    """
+
+    def __init__(self, host, port):
+        self.connection = httplib.HTTPConnection(host, port, timeout=60)
+        self.connection.connect()
+        self.connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.cookies = Cookie.SimpleCookie()
+
+    def _request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % (name, morsel.coded_value)
+                                          for name, morsel in self.cookies.items())
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        for header in response.msg.getheaders('set-cookie'):
+            self.cookies.load(header)
+        if response.getheader('connection', '').lower() == 'close':
+            self.connection.close()
+        return response.status, data
+
+    def get(self, path, headers=None):
+        return self._request('GET', path, headers=headers)
+
+    def post(self, path, data):
+        return self._request('POST', path, urllib.urlencode(data),
+                             {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def close(self):
+        self.connection.close()
+
+
+def log_in(driver, gamer_id):
+    """ Fills the login form of a gamer of seed_site : the (route,
+        milliseconds, status, statements) sample of the POST
+    """
+    status, body = driver.get('/login')
+    start = time.time()
+    status, body = driver.post('/login', {'csrf_token': _form_token(body), 'email': site_email(gamer_id),
+                                          'password': SITE_PASSWORD})
+    duration = (time.time() - start) * 1000.0
+    if status != 302:
+        raise ValueError(u'Gamer %i could not log in (%i)' % (gamer_id, status))
+    return (LOGIN, duration, status, None)
+
+
+def run_client(app, plan, gamer_id=1, engine=Engine):
+    """ Replays a plan through the test client, counting the statements
+        sent to `engine` (every engine by default) by each request
+    """
+    driver = TestClientDriver(app)
+    with QueryCounter(engine) as counter:
+        samples = [log_in(driver, gamer_id)]
+        start = time.time()
+        for name, path in plan:
+            counter.count = 0
+            del counter.statements[:]
+            begin = time.time()
+            status, body = driver.get(path)
+            samples.append((name, (time.time() - begin) * 1000.0, status, counter.count))
+        seconds = time.time() - start
+    return summarize(samples, seconds)
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def setup(self):
+        WSGIRequestHandler.setup(self)
+        # the headers are written line by line : no Nagle delay between them
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(app, workers=4, host='127.0.0.1', port=0):
+    """ Starts `workers` processes, each one a threaded server accepting on
+        the same socket. The database engines must be disposed of before,
+        no connection may cross a fork. Returns (port, processes).
+    """
+    server = make_server(host, port, app, threaded=True, request_handler=_QuietHandler)
+    processes = [Process(target=server.serve_forever, name='loadtest-worker-%i' % i)
+                 for i in range(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    # the workers own the socket now
+    server.socket.close()
+    return server.server_port, processes
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def _http_client(host, port, gamer_id, plan, samples, errors, ready, go):
+    driver = HttpDriver(host, port)
+    try:
+        try:
+            samples.append(log_in(driver, gamer_id))
+        finally:
+            ready.release()
+        go.wait()
+        for name, path in plan:
+            begin = time.time()
+            status, body = driver.get(path)
+            samples.append((name, (time.time() - begin) * 1000.0, status, None))
+    except Exception as e:
+        errors.append(u'%s : %s' % (e.__class__.__name__, e))
+    finally:
+        driver.close()
+
+
+def run_http(port, plan, concurrency=8, host='127.0.0.1', workers=None):
+    """ Replays a plan over HTTP, split between `concurrency` client
+        threads, each one logged in as another gamer. The clock starts
+        once they are all logged in.
+    """
+    samples, errors = [], []
+    ready, go = threading.Semaphore(0), threading.Event()
+    clients = [threading.Thread(target=_http_client,
+                                args=(host, port, i + 1, plan[i::concurrency], samples, errors, ready, go))
+               for i in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        ready.acquire()
+    start = time.time()
+    go.set()
+    for client in clients:
+        client.join()
+    result = summarize(samples, time.time() - start)
+    result['concurrency'] = concurrency
+    result['workers'] = workers
+    result['client_errors'] = errors
+    return result
+
+
+def environment(settings):
+    """ What the numbers depend on, saved with them """
+    try:
+        import subprocess
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           stderr=subprocess.STDOUT).strip()
+    except Exception:
+        revision = None
+    return {'revision': revision, 'date': datetime.now().isoformat(),
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(), 'settings': settings}
+
+
+def save_results(path, results):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as source:
+        return json.load(source)
+
+
+def compare_results(baseline, current, tolerance=0.25):
+    """ The regressions of `current` against `baseline`, as messages : more
+        statements for a route, a p95 latency or a throughput worse by more
+        than `tolerance`, new errors
+    """
+    problems = []
+    if baseline.get('scale') != current.get('scale'):
+        problems.append(u'Different scales : %r and %r' % (baseline.get('scale'), current.get('scale')))
+        return problems
+    for phase, results in sorted(current.get('phases', {}).items()):
+        base = baseline.get('phases', {}).get(phase)
+        if base is None:
+            continue
+        if (base.get('workers'), base.get('concurrency')) != (results.get('workers'), results.get('concurrency')):
+            problems.append(u'%s : not compared, run with %s workers and %s clients instead of %s and %s' % (
+                phase, results.get('workers'), results.get('concurrency'), base.get('workers'),
+                base.get('concurrency')))
+            continue
+        if results['throughput'] < base['throughput'] * (1 - tolerance):
+            problems.append(u'%s : %.1f requests/s instead of %.1f' % (
+                phase, results['throughput'], base['throughput']))
+        for name, route in sorted(results['routes'].items()):
+            old = base['routes'].get(name)
+            if old is None:
+                continue
+            if route['queries'] is not None and old['queries'] is not None and \
+                    route['queries'] > old['queries']:
+                problems.append(u'%s %s : %.1f queries instead of %.1f' % (
+                    phase, name, route['queries'], old['queries']))
+            if route['p95_ms'] > old['p95_ms'] * (1 + tolerance) and \
+                    route['p95_ms'] - old['p95_ms'] > NOISE_MS:
+                problems.append(u'%s %s : p95 %.1f ms instead of %.1f ms' % (
+                    phase, name, route['p95_ms'], old['p95_ms']))
+            if route['errors'] > old['errors']:
+                problems.append(u'%s %s : %i errors instead of %i' % (
+                    phase, name, route['errors'], old['errors']))
+    return problems
@@ -0,0 +1,298 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Opt-in instrumentation of the requests (METRICS_ENABLED).
+
+    Per endpoint : number of requests, wall time (histogram), template render
+    time, number of SQL statements and SQL time, and the requests flagged
+    N+1 : the same parameterized statement (same SQL text, whatever the
+    values bound) run at least METRICS_N_PLUS_ONE times. The metrics are kept
+    in memory by the worker and exposed in the Prometheus text format at
+    /metrics.
+
+    /metrics and /metrics/profile answer the requests bearing METRICS_TOKEN
+    (Authorization: Bearer <token>) when it is set, otherwise the clients of
+    METRICS_ALLOWED_ADDRESSES connected directly : a request relayed by a
+    proxy (X-Forwarded-For, Forwarded) would come from the address of the
+    proxy, it is refused.
+
+    The cost is a few attribute updates per request and per statement, low
+    enough to leave it on. The sampling profiler (METRICS_PROFILER) is a
+    separate switch : a thread samples the stacks of the threads running a
+    request every METRICS_PROFILER_INTERVAL seconds, and /metrics/profile
+    returns the counts as collapsed stacks (flame graph format).
+"""
+import hmac
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import request, abort
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROXY_HEADERS = ('X-Forwarded-For', 'Forwarded')
+
+_current = threading.local()
+
+
+class RequestStats(object):
+    __slots__ = ('start', 'sql_start', 'sql_count', 'sql_time', 'render_time', 'statements')
+
+    def __init__(self):
+        self.start = time.time()
+        self.sql_start = None
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.statements = Counter()
+
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.buckets = [0] * len(BUCKETS)
+        self.wall_time = 0.0
+        self.render_time = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.n_plus_one = 0
+        # the most repeated statement of the last flagged request
+        self.repeated = None
+
+    def add(self, wall_time, stats, threshold):
+        self.count += 1
+        self.wall_time += wall_time
+        for i, bound in enumerate(BUCKETS):
+            if wall_time <= bound:
+                self.buckets[i] += 1
+        self.render_time += stats.render_time
+        self.sql_count += stats.sql_count
+        self.sql_time += stats.sql_time
+        if stats.statements:
+            statement, repeats = stats.statements.most_common(1)[0]
+            if repeats >= threshold:
+                self.n_plus_one += 1
+                self.repeated = (repeats, statement)
+
+
+class TimedTemplate(Template):
+    """ Adds the time spent rendering to the current request """
+
+    def render(self, *args, **kwargs):
+        stats = getattr(_current, 'stats', None)
+        if stats is None:
+            return Template.render(self, *args, **kwargs)
+        start = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            stats.render_time += time.time() - start
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_current, 'stats', None)
+    if stats is not None:
+        stats.sql_start = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_current, 'stats', None)
+    if stats is not None and stats.sql_start is not None:
+        stats.sql_time += time.time() - stats.sql_start
+        stats.sql_count += 1
+        stats.statements[statement] += 1
+
+
+class SamplingProfiler(object):
+    """ Counts the stacks of the threads running a request, by endpoint """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.running = {}
+        self.samples = Counter()
+        self._thread = None
+
+    @property
+    def active(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sample_loop, name='metrics-profiler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._thread = None
+
+    def _sample_loop(self):
+        me = threading.current_thread()
+        while self._thread is me:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident, endpoint in list(self.running.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(endpoint)
+                    self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """ One 'endpoint;outer frame;...;inner frame count' line per stack """
+        return ''.join('%s %i\n' % (stack, count) for stack, count in sorted(self.samples.items()))
+
+
+class Instrumentation(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.threshold = 10
+        self.endpoints = defaultdict(EndpointStats)
+        self.profiler = SamplingProfiler()
+        self.token = None
+        self.allowed_addresses = ('127.0.0.1', '::1')
+        self._lock = threading.Lock()
+        self._app = None
+
+    def init_app(self, app):
+        self._app = app
+        config = app.config
+        self.threshold = config.get('METRICS_N_PLUS_ONE', 10)
+        self.profiler.interval = config.get('METRICS_PROFILER_INTERVAL', 0.005)
+        self.token = config.get('METRICS_TOKEN') or None
+        self.allowed_addresses = tuple(config.get('METRICS_ALLOWED_ADDRESSES', '127.0.0.1 ::1').split())
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+        app.add_url_rule('/metrics/profile', 'metrics_profile', self._profile_view)
+        if config.get('METRICS_ENABLED', False):
+            self.enable()
+        if config.get('METRICS_PROFILER', False):
+            self.profiler.start()
+
+    def enable(self):
+        """ Installs the SQL and template hooks, once """
+        if self.enabled:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        if self._app is not None:
+            self._app.jinja_env.template_class = TimedTemplate
+            self._app.jinja_env.cache.clear()
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+            self.profiler.samples.clear()
+
+    def _before_request(self):
+        if self.enabled:
+            _current.stats = RequestStats()
+        if self.profiler.active:
+            self.profiler.running[threading.current_thread().ident] = request.endpoint or '-'
+
+    def _teardown_request(self, exc=None):
+        # also called when the view failed
+        stats = getattr(_current, 'stats', None)
+        if stats is not None:
+            _current.stats = None
+            wall_time = time.time() - stats.start
+            with self._lock:
+                self.endpoints[request.endpoint or '-'].add(wall_time, stats, self.threshold)
+        if self.profiler.running:
+            self.profiler.running.pop(threading.current_thread().ident, None)
+
+    def snapshot(self):
+        """ [(endpoint, EndpointStats)] sorted by total wall time """
+        with self._lock:
+            return sorted(self.endpoints.items(), key=lambda item: -item[1].wall_time)
+
+    def prometheus(self):
+        """ The metrics in the Prometheus text format """
+        lines = []
+        snapshot = self.snapshot()
+
+        def metric(name, kind, help_text, values):
+            lines.append('# HELP gamesess_%s %s' % (name, help_text))
+            lines.append('# TYPE gamesess_%s %s' % (name, kind))
+            for suffix, endpoint, labels, value in values:
+                lines.append('gamesess_%s%s{endpoint="%s"%s} %s' % (
+                    name, suffix, _label(endpoint), labels, _number(value)))
+
+        histogram = []
+        for endpoint, stats in snapshot:
+            for bound, count in zip(BUCKETS, stats.buckets):
+                histogram.append(('_bucket', endpoint, ',le="%s"' % bound, count))
+            histogram.append(('_bucket', endpoint, ',le="+Inf"', stats.count))
+            histogram.append(('_sum', endpoint, '', stats.wall_time))
+            histogram.append(('_count', endpoint, '', stats.count))
+        metric('request_seconds', 'histogram', 'Wall time of the requests.', histogram)
+        for name, attribute, help_text in (
+                ('render_seconds_total', 'render_time', 'Time spent rendering templates.'),
+                ('sql_statements_total', 'sql_count', 'SQL statements executed.'),
+                ('sql_seconds_total', 'sql_time', 'Time spent executing SQL statements.'),
+                ('n_plus_one_total', 'n_plus_one', 'Requests repeating a statement (N+1).')):
+            metric(name, 'counter', help_text,
+                   [('', endpoint, '', getattr(stats, attribute)) for endpoint, stats in snapshot])
+        return '\n'.join(lines) + '\n'
+
+    def _authorized(self):
+        if self.token:
+            presented = request.headers.get('Authorization', u'').encode('utf-8')
+            return hmac.compare_digest(presented, (u'Bearer %s' % self.token).encode('utf-8'))
+        if any(header in request.headers for header in PROXY_HEADERS):
+            # remote_addr is the address of the proxy
+            return False
+        return request.remote_addr in self.allowed_addresses
+
+    def _check_access(self):
+        if not self._authorized():
+            abort(404)
+
+    def _metrics_view(self):
+        self._check_access()
+        if not self.enabled:
+            abort(404)
+        return self.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    def _profile_view(self):
+        self._check_access()
+        if not self.profiler.active and not self.profiler.samples:
+            abort(404)
+        return self.profiler.collapsed(), 200, {'Content-Type': 'text/plain'}
+
+
+def parse_prometheus(text):
+    """ {endpoint: {metric: value}} from the text of /metrics, without the
+        histogram buckets and the gamesess_ prefix
+    """
+    result = defaultdict(dict)
+    for line in text.splitlines():
+        if not line or line.startswith('#') or '_bucket{' in line:
+            continue
+        name, value = line.rsplit(' ', 1)
+        metric, labels = name.split('{', 1)
+        endpoint = re.search(r'endpoint="((?:[^"\\]|\\.)*)"', labels).group(1)
+        result[endpoint][metric[len('gamesess_'):]] = float(value)
+    return result
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return isinstance(value, float) and repr(value) or str(value)
+
+
+instrumentation = Instrumentation()
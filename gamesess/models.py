@@ -3,16 +3,20 @@
 from datetime import datetime, date
 from datetime import timedelta
 
-from werkzeug.security import generate_password_hash, check_password_hash
+from gamesess.security import hasher, verifier
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker,relationship,backref
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, Text, ForeignKey, Date
+from sqlalchemy.orm import sessionmaker,relationship,backref,validates
+from sqlalchemy import Boolean, Column, DateTime, Float, Integer, String, Text, ForeignKey, Date
+from sqlalchemy import Index, text
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
 class Club(Base):
     """A club of gamer organizing sessions of games around numerous tables"""
     __tablename__ = 'club'
+    __table_args__ = (
+        Index('ix_club_public_name', 'public', 'name'),
+    )
 
     id = Column(Integer, primary_key=True)
     created = Column(DateTime, default=datetime.now)
@@ -24,7 +28,10 @@ class Club(Base):
     description = Column(Text)
     address = Column(Text)
     public = Column(Boolean, default=False)
-    # gps_coord
+    # degrees (WGS 84), indexed in the R*Tree of gamesess.geo
+    latitude = Column(Float)
+    longitude = Column(Float)
+    logo = Column(String(80)) # name of the image in the ImageStore
 
     creator = relationship('Gamer', foreign_keys=[create_id])
     modifier = relationship('Gamer', foreign_keys=[modify_id])
@@ -32,29 +39,8 @@ class Club(Base):
     def __repr__(self):
         return (self.name and self.name or u'Club [%i]' % self.id)
 
-class Gamer(Base):
-    """ A Gamer and/or a user in a club.
-        Also serves as USERS database for Flask-Login
-    """
-    __tablename__ = 'gamer'
-
-    id = Column(Integer, primary_key=True)
-    created = Column(Integer, default=datetime.now)
-    modified = Column(Integer, default=datetime.now, onupdate=datetime.now)
-    create_id = Column(Integer, ForeignKey('gamer.id'))
-    modify_id = Column(Integer, ForeignKey('gamer.id'))
-    active = Column(Boolean, default=True)
-    first_name = Column(String(50))
-    last_name = Column(String(50))
-    surname = Column(String(50))
-    login = Column(String(50))
-    last_login = Column(DateTime)
-    birthdate = Column(Date)
-    password_hashed = Column(String(128))
-    email = Column(String(255))
-    
-    creator = relationship('Gamer', foreign_keys=[create_id])
-    modifier = relationship('Gamer', foreign_keys=[modify_id])
+class GamerMixin(object):
+    """ Naming and Flask-Login behaviour shared by Gamer and GamerIdentity """
 
     def __repr__(self):
         return self._get_name()
@@ -78,15 +64,6 @@ class Gamer(Base):
             result = 77
         return result
         
-    @property
-    def password(self):
-        raise AttributeError(u'Password is not a readable attribute')
-    @password.setter
-    def password(self,password):
-        self.password_hashed = generate_password_hash(password)
-    def verify_password(self,password):
-        return check_password_hash(self.password_hashed,password)
-
     # Flask-Login methods and properties
     def get_id(self):
         return unicode(self.id)
@@ -100,6 +77,58 @@ class Gamer(Base):
     def is_authenticated(self):
         return True
         
+class Gamer(GamerMixin, Base):
+    """ A Gamer and/or a user in a club.
+        Also serves as USERS database for Flask-Login
+    """
+    __tablename__ = 'gamer'
+
+    id = Column(Integer, primary_key=True)
+    created = Column(Integer, default=datetime.now)
+    modified = Column(Integer, default=datetime.now, onupdate=datetime.now)
+    create_id = Column(Integer, ForeignKey('gamer.id'))
+    modify_id = Column(Integer, ForeignKey('gamer.id'))
+    active = Column(Boolean, default=True)
+    first_name = Column(String(50))
+    last_name = Column(String(50))
+    surname = Column(String(50))
+    login = Column(String(50))
+    last_login = Column(DateTime)
+    birthdate = Column(Date)
+    password_hashed = Column(String(128))
+    email = Column(String(255), index=True)
+    
+    creator = relationship('Gamer', foreign_keys=[create_id])
+    modifier = relationship('Gamer', foreign_keys=[modify_id])
+
+    @property
+    def password(self):
+        raise AttributeError(u'Password is not a readable attribute')
+    @password.setter
+    def password(self,password):
+        self.password_hashed = hasher.hash(password)
+    def verify_password(self,password):
+        """ True/False, or None when the verification pool is saturated """
+        return verifier.verify(hasher,self.password_hashed,password)
+    @property
+    def password_needs_rehash(self):
+        return hasher.needs_rehash(self.password_hashed)
+
+class GamerIdentity(GamerMixin):
+    """ A lightweight copy of a Gamer, detached from any session.
+        This is what Flask-Login keeps as current_user between requests.
+    """
+    columns = ('id', 'active', 'first_name', 'last_name', 'surname', 'login',
+               'birthdate', 'email')
+
+    def __init__(self, **values):
+        for name in self.columns:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def from_gamer(cls, gamer):
+        return cls(**dict((name, getattr(gamer, name)) for name in cls.columns))
+
 class GamerClub(Base):
     """ A Club can have many manager and more users"""
     __tablename__ = 'gamerclub'
@@ -111,8 +140,8 @@ class GamerClub(Base):
     modify_id = Column(Integer, ForeignKey('gamer.id'))
     active = Column(Boolean,default=True)
     role = Column(String(50)) ## manager/user
-    club_id = Column(Integer, ForeignKey('club.id'))
-    gamer_id = Column(Integer, ForeignKey('gamer.id'))
+    club_id = Column(Integer, ForeignKey('club.id'), index=True)
+    gamer_id = Column(Integer, ForeignKey('gamer.id'), index=True)
 
     creator = relationship('Gamer', foreign_keys=[create_id])
     modifier = relationship('Gamer', foreign_keys=[modify_id])
@@ -121,6 +150,11 @@ class GamerClub(Base):
 class GameSession(Base):
     """ A Game Session where gamers can play many games with others"""
     __tablename__ = 'gamesession'
+    __table_args__ = (
+        Index('ix_gamesession_club_id_begin', 'club_id', 'begin'),
+        # an occurrence of a rule is materialized once
+        Index('ix_gamesession_rule_id_begin', 'rule_id', 'begin', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     created = Column(DateTime, default=datetime.now)
@@ -134,6 +168,7 @@ class GameSession(Base):
     type = Column(String(20)) # current values = Soiree/Week-End
     state = Column(String(20)) # current values = possible/confirmed/done/cancel
     club_id = Column(Integer, ForeignKey('club.id'))
+    rule_id = Column(Integer, ForeignKey('sessionrule.id')) # generated by a SessionRule
 
     creator = relationship('Gamer', foreign_keys=[create_id])
     modifier = relationship('Gamer', foreign_keys=[modify_id])
@@ -159,9 +194,63 @@ class GameSession(Base):
         else:
             return (0,0,0,0)
 
+RULE_WEEKLY = 'weekly'
+RULE_MONTHLY = 'monthly'
+RULE_WEEKEND = 'weekend'
+# SessionRule.nth : the first to the fifth day of the month, or the last one
+RULE_NTHS = (-1, 1, 2, 3, 4, 5)
+# the GameSession.type of the sessions of each kind of rule
+RULE_SESSION_TYPES = {RULE_WEEKLY: u'Soiree', RULE_MONTHLY: u'Soiree', RULE_WEEKEND: u'Week-End'}
+
+class SessionRule(Base):
+    """ A recurring game session of a club, e.g. every last Friday of the
+        month from 20:00 to 24:00. See gamesess.recurrence.
+    """
+    __tablename__ = 'sessionrule'
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, default=datetime.now)
+    modified = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    create_id = Column(Integer, ForeignKey('gamer.id'))
+    modify_id = Column(Integer, ForeignKey('gamer.id'))
+    active = Column(Boolean, default=True)
+    club_id = Column(Integer, ForeignKey('club.id'), index=True)
+    name = Column(String, nullable=False) # of the sessions, {date} is the begin : u"Soirée du {date:%d/%m/%Y}"
+    type = Column(String(20)) # GameSession.type, RULE_SESSION_TYPES by default
+    frequency = Column(String(20), nullable=False) # weekly/monthly/weekend
+    interval = Column(Integer, nullable=False, default=1) # every n weeks (weekly) or months
+    weekday = Column(Integer, nullable=False) # 0 = Monday ; first day of a weekend : Friday or Saturday
+    nth = Column(Integer) # monthly/weekend : 1 to 5, -1 for the last one of the month
+    start = Column(Integer, nullable=False) # minutes after midnight
+    duration = Column(Integer, nullable=False) # minutes
+    first = Column(Date, nullable=False)
+    last = Column(Date)
+    # the sessions beginning before are in the gamesession table
+    materialized_until = Column(DateTime)
+
+    club = relationship('Club')
+    creator = relationship('Gamer', foreign_keys=[create_id])
+    modifier = relationship('Gamer', foreign_keys=[modify_id])
+
+    @validates('nth')
+    def _check_nth(self, key, nth):
+        if nth is not None and nth not in RULE_NTHS:
+            raise ValueError(u'Invalid rank of the day in the month : %s' % nth)
+        return nth
+
+    @property
+    def session_type(self):
+        return self.type or RULE_SESSION_TYPES.get(self.frequency)
+
+    def __repr__(self):
+        return (self.name and self.name or u'Rule [%i]' % self.id)
+
 class GameTable(Base):
     """A table groups gamers around a game"""
     __tablename__ = 'gametable'
+    __table_args__ = (
+        Index('ix_gametable_session_id_begin', 'session_id', 'begin'),
+    )
 
     id = Column(Integer, primary_key=True)
     created = Column(DateTime, default=datetime.now)
@@ -176,6 +265,8 @@ class GameTable(Base):
     min_part = Column(Integer)
     max_part = Column(Integer)
     type = Column(String(50)) # proposition, confirmé
+    # seated attendances, kept up to date by gamesess.booking
+    seats_taken = Column(Integer, nullable=False, default=0, server_default='0')
     game_id = Column(Integer,ForeignKey('game.id'))
     session_id = Column(Integer,ForeignKey('gamesession.id'))
 
@@ -185,6 +276,26 @@ class GameTable(Base):
     def __repr__(self):
         return (self.name and self.name or u'Table [%i]' % self.id)
 
+MAX_PLAYERS = 100
+
+def parse_parts(parts):
+    """ The sorted player counts of a Game.parts text : ranges "2-5" and/or
+        single values separated by ";" (or ","). Raises ValueError when the
+        text is malformed.
+    """
+    result = set()
+    if not parts or not parts.strip():
+        return []
+    for srange in parts.replace(',', ';').split(';'):
+        bounds = [bound.strip() for bound in srange.split('-')]
+        if len(bounds) > 2 or not all(bound.isdigit() for bound in bounds):
+            raise ValueError(u'Invalid number of players : %r' % parts)
+        begin, end = sorted(int(bound) for bound in (bounds[0], bounds[-1]))
+        if begin < 1 or end > MAX_PLAYERS:
+            raise ValueError(u'Invalid number of players : %r' % parts)
+        result.update(range(begin, end + 1))
+    return sorted(result)
+
 class Game(Base):
     """A game is a proposed game : can be a game or a scenario"""
     __tablename__ = 'game'
@@ -197,47 +308,51 @@ class Game(Base):
     active = Column(Boolean, default=True)
     name = Column(String(255))
     parts = Column(String(200)) # can be a range "2-5" or a list of possibilities : "2; 4"
-    parent_id = Column(Integer,ForeignKey('game.id'))
+    parent_id = Column(Integer,ForeignKey('game.id'), index=True)
     average_duration = Column(Integer) # in minutes
+    image = Column(String(80)) # box art, name of the image in the ImageStore
     
     creator = relationship('Gamer', foreign_keys=[create_id])
     modifier = relationship('Gamer', foreign_keys=[modify_id])
     #parent = relationship('Game', remote_side=[id])
     children = relationship('Game', backref=backref('parent', remote_side=[id]))
+    player_counts = relationship('GamePlayers', cascade='all, delete-orphan')
 
     def __repr__(self):
         return (self.name and self.name or u'Game [%i]' % self.id)
 
+    @validates('parts')
+    def _sync_player_counts(self, key, parts):
+        self.player_counts = [GamePlayers(players=count) for count in parse_parts(parts)]
+        return parts
+
     @property
     def parts_as_list(self):
-        if ';' in self.parts:
-            ranges = self.parts.split(';')
-        else:
-            ranges = [self.parts,]
-        result = []
-        for srange in ranges:
-            if srange.count('-') == 1:
-                (sbegin,send) = srange.split('-')
-                begin = int(sbegin)
-                end = int(send)
-                if begin > end:
-                    (begin,end) = (end,begin)
-                value = begin
-                while value <= end:
-                    if value not in result:
-                        result.append(value)
-                    value += 1
-            elif srange.count('-') > 1:
-                pass
-            else:
-                value = int(srange.strip())
-                if value not in result:
-                    result.append(value)
-        return result
+        return parse_parts(self.parts)
+
+class GamePlayers(Base):
+    """A valid number of players for a game, derived from Game.parts.
+       Lets the catalog be searched by number of players through an index.
+    """
+    __tablename__ = 'gameplayers'
+
+    players = Column(Integer, primary_key=True, autoincrement=False)
+    game_id = Column(Integer, ForeignKey('game.id'), primary_key=True)
+
+ATTENDANCE_STATUSES = (u'possible', u'confirmé', u'initiateur', u'attente')
+# the gamer wishes to play at the table, without a seat yet
+ATTENDANCE_WISH = u'possible'
+# the statuses that take a seat at the table
+ATTENDANCE_SEATED = (u'confirmé', u'initiateur')
+# a seat was requested while the table was full
+ATTENDANCE_WAITLIST = u'attente'
 
 class Attendance(Base):
     """An attendance is a participation or a possible participation of a gamer to a table"""
     __tablename__ = 'attendance'
+    __table_args__ = (
+        Index('ix_attendance_table_id_gamer_id', 'table_id', 'gamer_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     created = Column(DateTime, default=datetime.now)
@@ -245,16 +360,121 @@ class Attendance(Base):
     create_id = Column(Integer, ForeignKey('gamer.id'))
     modify_id = Column(Integer, ForeignKey('gamer.id'))
     active = Column(Boolean, default=True)
-    name = Column(String(50)) ## possible, confirmé, initiateur
+    name = Column(String(50)) ## possible, confirmé, initiateur, attente
     table_id = Column(Integer,ForeignKey('gametable.id'))
-    gamer_id = Column(Integer,ForeignKey('gamer.id'))
+    gamer_id = Column(Integer,ForeignKey('gamer.id'), index=True)
+    # optimistic concurrency : an update from a stale row raises StaleDataError
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     
     creator = relationship('Gamer', foreign_keys=[create_id])
     modifier = relationship('Gamer', foreign_keys=[modify_id])
     gamer = relationship('Gamer', foreign_keys=[gamer_id,])
 
+    __mapper_args__ = {'version_id_col': version}
+
+# Rollups of the seated attendances, maintained by triggers : see gamesess.stats.
+# Derived data : no foreign keys, the rows go with the rows they summarize.
+
+class TableStats(Base):
+    """ The seated gamers of a table, with the keys of its rollups """
+    __tablename__ = 'tablestats'
+
+    table_id = Column(Integer, primary_key=True, autoincrement=False)
+    session_id = Column(Integer, index=True)
+    club_id = Column(Integer, index=True)
+    game_id = Column(Integer)
+    min_part = Column(Integer)
+    max_part = Column(Integer)
+    seated = Column(Integer, nullable=False, default=0)
+
+class GamerSessionStats(Base):
+    """ The tables of a session where a gamer was seated : the history of the gamer """
+    __tablename__ = 'gamersessionstats'
+
+    gamer_id = Column(Integer, primary_key=True, autoincrement=False)
+    session_id = Column(Integer, primary_key=True, autoincrement=False)
+    tables = Column(Integer, nullable=False, default=0)
+
+class SessionStats(Base):
+    """ The attendance of a game session and the fill rate of its tables """
+    __tablename__ = 'sessionstats'
+
+    session_id = Column(Integer, primary_key=True, autoincrement=False)
+    club_id = Column(Integer, index=True)
+    gamers = Column(Integer, nullable=False, default=0) # distinct seated gamers
+    seats = Column(Integer, nullable=False, default=0) # seated attendances
+    tables = Column(Integer, nullable=False, default=0) # tables with a seated gamer
+    capacity = Column(Integer, nullable=False, default=0) # sum of the max_part of the tables
+    full_tables = Column(Integer, nullable=False, default=0) # tables with max_part seated gamers
+    short_tables = Column(Integer, nullable=False, default=0) # tables below min_part
+
+class ClubGameStats(Base):
+    """ How much a game is played in a club """
+    __tablename__ = 'clubgamestats'
+
+    club_id = Column(Integer, primary_key=True, autoincrement=False)
+    game_id = Column(Integer, primary_key=True, autoincrement=False)
+    plays = Column(Integer, nullable=False, default=0) # seated attendances
+    tables = Column(Integer, nullable=False, default=0) # tables with a seated gamer
+
+# Deferred work, run by the worker processes of gamesess.jobs
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed' # out of attempts
+
+class Job(Base):
+    """ A unit of deferred work : a handler (kind) and its JSON payload """
+    __tablename__ = 'job'
+    __table_args__ = (
+        Index('ix_job_state_run_at', 'state', 'run_at'),
+        # one pending job per key : queued again, the job is not duplicated
+        Index('ix_job_pending_key', 'kind', 'key', unique=True, sqlite_where=text("state = 'pending'")),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, default=datetime.now)
+    kind = Column(String(40), nullable=False)
+    key = Column(String(255))
+    payload = Column(Text)
+    state = Column(String(10), nullable=False, default=JOB_PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    run_at = Column(DateTime, nullable=False, default=datetime.now)
+    locked_by = Column(String(64)) # the claim of the worker running it
+    locked_until = Column(DateTime) # claimed again after, by another worker
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    error = Column(Text) # of the last attempt
+
+class Notification(Base):
+    """ A change to tell a gamer, sent with the others in one digest mail """
+    __tablename__ = 'notification'
+    __table_args__ = (
+        Index('ix_notification_gamer_id_sent', 'gamer_id', 'sent'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, default=datetime.now)
+    gamer_id = Column(Integer, ForeignKey('gamer.id'), nullable=False)
+    session_id = Column(Integer, ForeignKey('gamesession.id'))
+    table_id = Column(Integer, ForeignKey('gametable.id'))
+    event = Column(String(20)) # the new state of the session : confirmed/cancel
+    sent = Column(DateTime)
+
+# the derived tables register their DDL on Base.metadata (after_create) : they
+# are created along with the models, whatever creates them
+import gamesess.search
+import gamesess.geo
+import gamesess.stats
+
 if __name__ == '__main__':
-    engine = create_engine('sqlite:///gamesess_test1.db', echo=False)
+    # the classes of the package, whose metadata carries the DDL listeners
+    from gamesess.models import *
+    from gamesess.config import settings
+    from gamesess.database import make_engine
+    config = settings()
+    engine = make_engine(config['SQLALCHEMY_DATABASE_URI'], config)
 
     Base.metadata.create_all(engine)
     Session = sessionmaker(bind=engine)
@@ -270,7 +490,7 @@ if __name__ == '__main__':
         password=u'admin',
         email='dev@soft-ethnic.be')
     session.add(admin)
-    session.commit()
+    session.flush()
     admin_id = admin.id
     print admin_id
     print admin.password_hashed
@@ -285,7 +505,7 @@ if __name__ == '__main__':
         birthdate = date(1966,02,17),
         email='philmer.vdm@gmail.com')
     session.add(club_manager)
-    session.commit()
+    session.flush()
     cmanager_id = club_manager.id
     print club_manager.password_hashed
 
@@ -297,7 +517,7 @@ if __name__ == '__main__':
         password=u'vincianne',
         create_id = cmanager_id)
     session.add(gamer)
-    session.commit()
+    session.flush()
     gamer_a = gamer.id
 
     gamer = Gamer(
@@ -308,7 +528,7 @@ if __name__ == '__main__':
         password=u'sylvain',
         create_id = cmanager_id)
     session.add(gamer)
-    session.commit()
+    session.flush()
     gamer_b = gamer.id
 
     gamer = Gamer(
@@ -319,7 +539,7 @@ if __name__ == '__main__':
         password=u'simon',
         create_id = cmanager_id)
     session.add(gamer)
-    session.commit()
+    session.flush()
     gamer_c = gamer.id
 
     gamer = Gamer(
@@ -330,7 +550,7 @@ if __name__ == '__main__':
         password=u'thomas',
         create_id = cmanager_id)
     session.add(gamer)
-    session.commit()
+    session.flush()
     gamer_thomas_id = gamer.id
 
     mormont = Club(
@@ -342,7 +562,7 @@ if __name__ == '__main__':
         public = True,
         create_id = admin.id)
     session.add(mormont)
-    session.commit()
+    session.flush()
     mormont_id = mormont.id
 
     thomas = Club(
@@ -353,7 +573,7 @@ if __name__ == '__main__':
         public = True,
         create_id = admin.id)
     session.add(thomas)
-    session.commit()
+    session.flush()
     thomas_club_id = thomas.id
 
     thomas_thomas = GamerClub(
@@ -362,7 +582,7 @@ if __name__ == '__main__':
         club_id = thomas_club_id,
         create_id = admin.id)
     session.add(thomas_thomas)
-    session.commit()
+    session.flush()
 
     philmer_mormont = GamerClub(
         role = 'manager',
@@ -370,21 +590,21 @@ if __name__ == '__main__':
         club_id = mormont_id,
         create_id = admin.id)
     session.add(philmer_mormont)
-    session.commit()
+    session.flush()
     sylvain_mormont = GamerClub(
         role = 'user',
         gamer_id = gamer_b,
         club_id = mormont_id,
         create_id = admin.id)
     session.add(sylvain_mormont)
-    session.commit()
+    session.flush()
     simon_mormont = GamerClub(
         role = 'user',
         gamer_id = gamer_c,
         club_id = mormont_id,
         create_id = admin.id)
     session.add(simon_mormont)
-    session.commit()
+    session.flush()
     
     prec = GameSession(
        name = u"Soirée du 21/4/2017 à Mormont",
@@ -393,7 +613,7 @@ if __name__ == '__main__':
        #club_id = mormont_id
        create_id = admin.id)
     session.add(prec)
-    session.commit()
+    session.flush()
     prec_id = prec.id
 
     next = GameSession(
@@ -402,15 +622,29 @@ if __name__ == '__main__':
         end = datetime(2017,5,26,23,59,59),
         create_id = admin.id)
     session.add(next)
-    session.commit()
+    session.flush()
     next_id = next.id
 
+    # the next ones come from the rule of the club : manage.py materialize_sessions
+    last_friday = SessionRule(
+        club_id = mormont_id,
+        name = u"Soirée du {date:%d/%m/%Y} à Mormont",
+        frequency = RULE_MONTHLY,
+        weekday = 4,
+        nth = -1,
+        start = 20 * 60,
+        duration = 4 * 60,
+        first = date(2017,6,1),
+        create_id = admin.id)
+    session.add(last_friday)
+    session.flush()
+
     sw = Game(
         name = u'Small World',
         parts = '2-4',
         average_duration=150)
     session.add(sw)
-    session.commit()
+    session.flush()
     sw_id = sw.id
     
     swu = Game(
@@ -419,7 +653,7 @@ if __name__ == '__main__':
         parent_id = sw_id,
         average_duration=180)
     session.add(swu)
-    session.commit()
+    session.flush()
     swu_id = swu.id
     
     adr = Game(
@@ -427,7 +661,7 @@ if __name__ == '__main__':
         parts = '2-4',
         average_duration = 150)
     session.add(adr)
-    session.commit()
+    session.flush()
     adr_id = adr.id
     
     adr_inde = Game(
@@ -436,7 +670,7 @@ if __name__ == '__main__':
         average_duration = 120,
         parent_id = adr_id)
     session.add(adr_inde)
-    session.commit()
+    session.flush()
 
     adr_suisse = Game(
         name = u"Les Aventuriers du Rail - carte Suisse",
@@ -444,7 +678,7 @@ if __name__ == '__main__':
         average_duration = 150,
         parent_id = adr_id)
     session.add(adr_suisse)
-    session.commit()
+    session.flush()
     adr_suisse_id = adr_suisse.id
 
     toi = Game(
@@ -452,7 +686,7 @@ if __name__ == '__main__':
         parts = '2;4',
         average_duration = 300)
     session.add(toi)
-    session.commit()
+    session.flush()
     
     table_adr_suisse = GameTable(
         name = u"Première partie aux Aventuriers du Rail - carte Suisse",
@@ -464,7 +698,7 @@ if __name__ == '__main__':
         game_id = adr_suisse_id,
         session_id = next_id)
     session.add(table_adr_suisse)
-    session.commit()
+    session.flush()
     table1_id = table_adr_suisse.id
     
     table_sw = GameTable(
@@ -477,29 +711,15 @@ if __name__ == '__main__':
         game_id = sw_id,
         session_id = next_id)
     session.add(table_sw)
-    session.commit()
+    session.flush()
     table2_id = table_sw.id
     
-    att_adr_suisse = Attendance(
-        name = 'initiateur',
-        table_id = table1_id,
-        gamer_id = cmanager_id)
-    session.add(att_adr_suisse)
-    session.commit()
-    
-    att_sw = Attendance(
-        name = 'initiateur',
-        table_id = table2_id,
-        gamer_id = cmanager_id)
-    session.add(att_sw)
-    session.commit()
-    
-    att2_sw = Attendance(
-        name = 'possible',
-        table_id = table2_id,
-        gamer_id = gamer_b)
-    session.add(att2_sw)
+    # through the booking : the seats taken are counted
+    from gamesess.booking import join_table
     session.commit()
+    join_table(session, table1_id, cmanager_id, u'initiateur')
+    join_table(session, table2_id, cmanager_id, u'initiateur')
+    join_table(session, table2_id, gamer_b, u'possible')
     
     club = session.query(Club).first()
     print club.id
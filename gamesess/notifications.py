@@ -0,0 +1,148 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Mails to the gamers when a game session they attend is confirmed or
+    cancelled, sent by the job workers (see gamesess.jobs).
+
+    The change of the state of a session queues a 'session_state' job
+    within its transaction (one per session while pending). That job writes
+    a Notification for every attendance at the tables of the session and
+    queues a 'digest' job per gamer, delayed by DIGEST_DELAY : the changes
+    of that delay reach a gamer in one mail, whatever the number of tables
+    or sessions. The digest marks its notifications sent.
+"""
+import smtplib
+from collections import OrderedDict
+from datetime import datetime
+from email.header import Header
+from email.mime.text import MIMEText
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from gamesess.jobs import job, enqueue, on_idle
+from gamesess.models import Gamer, GameSession, GameTable, Attendance, Notification
+
+NOTIFIED_STATES = (u'confirmed', u'cancel')
+STATE_LABELS = {u'confirmed': u'confirmée', u'cancel': u'annulée'}
+
+
+def watch_session_states():
+    """ Queues a 'session_state' job when the state of a GameSession moves
+        to one of NOTIFIED_STATES, in the transaction of the change
+    """
+    @event.listens_for(Session, 'after_flush')
+    def _queue_state_changes(db_session, flush_context):
+        for instance in db_session.dirty:
+            if isinstance(instance, GameSession) and instance.state in NOTIFIED_STATES \
+                    and inspect(instance).attrs.state.history.has_changes():
+                enqueue(db_session, 'session_state', {'session_id': instance.id}, key=u'%i' % instance.id)
+
+
+@job('session_state')
+def notify_attendees(session, payload):
+    """ A notification for each attendance at the tables of the session,
+        then a digest queued for each of their gamers. Nothing when the
+        session moved out of NOTIFIED_STATES meanwhile.
+    """
+    game_session = session.query(GameSession).get(payload['session_id'])
+    if game_session is None or game_session.state not in NOTIFIED_STATES:
+        return
+    rows = session.query(Attendance.gamer_id, Attendance.table_id)\
+        .join(GameTable, Attendance.table_id == GameTable.id)\
+        .filter(GameTable.session_id == game_session.id, Attendance.active == True)\
+        .order_by(Attendance.gamer_id, Attendance.table_id)\
+        .all()
+    if not rows:
+        return
+    now = datetime.now()
+    session.execute(Notification.__table__.insert(), [
+        {'created': now, 'gamer_id': gamer_id, 'session_id': game_session.id, 'table_id': table_id,
+         'event': game_session.state} for gamer_id, table_id in rows])
+    delay = current_app.config['DIGEST_DELAY']
+    for gamer_id in sorted(set(gamer_id for gamer_id, table_id in rows)):
+        enqueue(session, 'digest', {'gamer_id': gamer_id}, key=u'%i' % gamer_id, delay=delay)
+
+
+def digest_text(gamer, rows):
+    """ The subject and the body of the mail of a gamer, from its
+        (Notification, GameSession, GameTable) rows
+    """
+    changes = OrderedDict()
+    for notification, game_session, table in rows:
+        tables = changes.setdefault((game_session, notification.event), [])
+        if table is not None:
+            tables.append(table.name or u'%i' % table.id)
+    lines = []
+    for (game_session, state), tables in changes.items():
+        lines.append(u'%s du %s : %s' % (game_session.name, game_session.begin.strftime('%d/%m/%Y %H:%M'),
+                                        STATE_LABELS.get(state, state)))
+        lines.extend(u'  - table %s' % name for name in tables)
+    if len(changes) == 1:
+        subject = u'%s : séance %s' % (game_session.name, STATE_LABELS.get(state, state))
+    else:
+        subject = u'Séances de Jeu : %i séances modifiées' % len(changes)
+    body = u'Bonjour %s,\n\n%s\n\nSéances de Jeu\n' % (gamer._get_name(), u'\n'.join(lines))
+    return subject, body
+
+
+class Mailer(object):
+    """ Sends the mails of a worker through one SMTP connection, opened on
+        demand and closed when the queue is idle
+    """
+
+    def __init__(self):
+        self.connection = None
+
+    def send(self, recipient, subject, body):
+        config = current_app.config
+        message = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
+        message['Subject'] = Header(subject, 'utf-8')
+        message['From'] = config['MAIL_SENDER']
+        message['To'] = recipient
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = smtplib.SMTP(config['SMTP_HOST'], config['SMTP_PORT'],
+                                               timeout=config['SMTP_TIMEOUT'])
+            try:
+                self.connection.sendmail(config['MAIL_SENDER'], [recipient], message.as_string())
+                return
+            except smtplib.SMTPServerDisconnected:
+                # closed by the server since the last mail : once more
+                self.connection = None
+                if attempt:
+                    raise
+            except:
+                self.close()
+                raise
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, IOError):
+                pass
+            self.connection = None
+
+mailer = Mailer()
+on_idle(mailer.close)
+
+
+@job('digest')
+def send_digest(session, payload):
+    """ One mail with the notifications of a gamer not sent yet """
+    gamer = session.query(Gamer).get(payload['gamer_id'])
+    rows = session.query(Notification, GameSession, GameTable)\
+        .join(GameSession, Notification.session_id == GameSession.id)\
+        .outerjoin(GameTable, Notification.table_id == GameTable.id)\
+        .filter(Notification.gamer_id == payload['gamer_id'], Notification.sent == None)\
+        .order_by(GameSession.begin, GameSession.id, Notification.id)\
+        .all()
+    if not rows:
+        return
+    if gamer is not None and gamer.email:
+        subject, body = digest_text(gamer, rows)
+        mailer.send(gamer.email, subject, body)
+    session.query(Notification)\
+        .filter(Notification.id.in_([notification.id for notification, game_session, table in rows]))\
+        .update({'sent': datetime.now()}, synchronize_session=False)
@@ -0,0 +1,177 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Recurring game sessions : the occurrences of the SessionRule of a club.
+
+    The occurrences are computed, never stored in advance for years :
+    materialize_sessions (manage.py materialize_sessions, run daily) creates
+    the GameSession rows over a rolling horizon only, starting where the
+    previous run stopped (SessionRule.materialized_until). A rule only goes
+    forward : a session cancelled, moved or deleted by hand is not created
+    again.
+
+    The calendars overlay the occurrences beyond the horizon on the stored
+    sessions (club_calendar) : only the rules of the club are read, the
+    dates of their occurrences are computed.
+"""
+import heapq
+from calendar import monthrange
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+from itertools import islice
+
+from sqlalchemy import or_
+
+from gamesess.models import GameSession, SessionRule, RULE_WEEKLY, RULE_WEEKEND, RULE_NTHS
+
+BATCH_SIZE = 500
+# the state of the sessions created from a rule
+RULE_SESSION_STATE = u'confirmed'
+SATURDAY = 5
+# a valid rule never skips that many periods in a row (a fifth Saturday of
+# February, yearly, skips up to 40) : the search for a date stops there
+MAX_EMPTY_PERIODS = 100
+
+# a not yet materialized occurrence, shown like a GameSession (id is None)
+Occurrence = namedtuple('Occurrence', 'id rule_id club_id name type state begin end')
+
+
+def nth_weekday(year, month, weekday, nth):
+    """ The `nth` `weekday` (0 = Monday) of a month, the last one for -1.
+        None when the month has less.
+    """
+    days = monthrange(year, month)[1]
+    if nth > 0:
+        day = 1 + (weekday - date(year, month, 1).weekday()) % 7 + 7 * (nth - 1)
+    else:
+        day = days - (date(year, month, days).weekday() - weekday) % 7 + 7 * (nth + 1)
+    if 1 <= day <= days:
+        return date(year, month, day)
+    return None
+
+
+def _dates(rule, since):
+    """ The dates of the occurrences of a rule, in order, from about `since`
+        (a date) : endless, the caller stops. Nothing for a monthly or weekend
+        rule with an nth out of RULE_NTHS (stored by hand).
+    """
+    interval = rule.interval or 1
+    if rule.frequency == RULE_WEEKLY:
+        day = rule.first + timedelta(days=(rule.weekday - rule.first.weekday()) % 7)
+        if since > day:
+            # straight to the first week on or after `since`
+            periods = -(-(since - day).days // (7 * interval))
+            day += timedelta(weeks=periods * interval)
+        while True:
+            yield day
+            day += timedelta(weeks=interval)
+    nth = rule.nth or 1
+    if nth not in RULE_NTHS:
+        return
+    first_month = rule.first.year * 12 + rule.first.month - 1
+    # a weekend may begin in the month before its Saturday
+    month = max(first_month, since.year * 12 + since.month - 2)
+    month += -(month - first_month) % interval
+    empty = 0
+    while empty < MAX_EMPTY_PERIODS:
+        year, month_index = divmod(month, 12)
+        if rule.frequency == RULE_WEEKEND:
+            # the weekend of the nth Saturday, beginning on rule.weekday
+            saturday = nth_weekday(year, month_index + 1, SATURDAY, nth)
+            day = saturday and saturday + timedelta(days=rule.weekday - SATURDAY)
+        else:
+            day = nth_weekday(year, month_index + 1, rule.weekday, nth)
+        if day is not None:
+            empty = 0
+            yield day
+        else:
+            empty += 1
+        month += interval
+
+
+def occurrences(rule, since, until=None):
+    """ Yields the (begin, end) of the occurrences of a rule beginning within
+        [since, until), datetimes. Endless without `until` or rule.last.
+    """
+    start = timedelta(minutes=rule.start)
+    duration = timedelta(minutes=rule.duration)
+    for day in _dates(rule, (since - start).date()):
+        if rule.last is not None and day > rule.last:
+            return
+        begin = datetime.combine(day, time()) + start
+        if until is not None and begin >= until:
+            return
+        if day >= rule.first and begin >= since:
+            yield begin, begin + duration
+
+
+def session_name(rule, begin):
+    return rule.name.format(date=begin)
+
+
+def materialize_sessions(session, until, today=None, batch_size=BATCH_SIZE):
+    """ Creates the sessions of the active rules beginning before `until`,
+        from where each rule stopped but never before `today`.
+
+        The sessions are inserted through the Core in batches, with one
+        transaction per rule moving its materialized_until forward. An
+        occurrence already stored (unique rule_id, begin) is left alone, so
+        a run interrupted or repeated creates nothing twice. Returns
+        {rule id: number of sessions created}.
+    """
+    today = today or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    rules = session.query(SessionRule)\
+        .filter(SessionRule.active == True,
+                or_(SessionRule.materialized_until == None, SessionRule.materialized_until < until))\
+        .order_by(SessionRule.id)\
+        .all()
+    insert = GameSession.__table__.insert().prefix_with('OR IGNORE')
+    created = {}
+    for rule in rules:
+        now = datetime.now()
+        since = max(rule.materialized_until or today, today)
+        created[rule.id] = 0
+        batch = []
+        for begin, end in occurrences(rule, since, until):
+            batch.append({
+                'created': now, 'modified': now, 'create_id': rule.create_id, 'active': True,
+                'name': session_name(rule, begin), 'begin': begin, 'end': end,
+                'type': rule.session_type, 'state': RULE_SESSION_STATE,
+                'club_id': rule.club_id, 'rule_id': rule.id})
+            if len(batch) == batch_size:
+                created[rule.id] += session.execute(insert, batch).rowcount
+                batch = []
+        if batch:
+            created[rule.id] += session.execute(insert, batch).rowcount
+        rule.materialized_until = until
+        session.commit()
+    return created
+
+
+def _pending(rule, since, until):
+    """ The occurrences of a rule not materialized yet, as (begin, rule id, Occurrence) """
+    since = max(since, rule.materialized_until or since)
+    for begin, end in occurrences(rule, since, until):
+        yield begin, rule.id, Occurrence(None, rule.id, rule.club_id, session_name(rule, begin),
+                                         rule.session_type, RULE_SESSION_STATE, begin, end)
+
+
+def club_calendar(session, club_id, since, until=None, limit=None):
+    """ The active game sessions of a club beginning within [since, until),
+        and the occurrences of its rules beyond their materialized sessions
+        as Occurrence, sorted on begin. `until` or `limit` is required.
+    """
+    if until is None and limit is None:
+        raise ValueError(u'An open calendar needs a limit')
+    query = session.query(GameSession)\
+        .filter(GameSession.club_id == club_id, GameSession.begin >= since,
+                GameSession.active == True)\
+        .order_by(GameSession.begin)
+    if until is not None:
+        query = query.filter(GameSession.begin < until)
+    if limit:
+        query = query.limit(limit)
+    streams = [((game_session.begin, 0, game_session) for game_session in query)]
+    rules = session.query(SessionRule).filter(SessionRule.club_id == club_id, SessionRule.active == True)
+    streams.extend(_pending(rule, since, until) for rule in rules)
+    merged = (item for begin, key, item in heapq.merge(*streams))
+    return list(islice(merged, limit))
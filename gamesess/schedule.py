@@ -0,0 +1,99 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Schedule conflicts : the tables booked by a gamer must not overlap in
+    time, and a table must stay within the window of its game session.
+
+    Intervals are half-open : a table ending at 22:00 does not conflict with
+    a table starting at 22:00. Tables without a begin or an end have no known
+    schedule and are left out.
+"""
+from collections import namedtuple
+from heapq import heappush, heappop
+
+from gamesess.models import GameSession, GameTable, Attendance, ATTENDANCE_SEATED, ATTENDANCE_WAITLIST
+
+# the statuses that book the time of the gamer
+ATTENDANCE_BOOKED = ATTENDANCE_SEATED + (ATTENDANCE_WAITLIST,)
+
+Conflict = namedtuple('Conflict', 'gamer_id first_id second_id')
+ScheduleReport = namedtuple('ScheduleReport', 'game_session tables outside conflicts')
+
+
+def sweep_conflicts(bookings):
+    """ The overlapping pairs of bookings of each gamer, in one pass.
+
+        `bookings` are (gamer_id, table_id, begin, end) rows sorted by gamer
+        then begin. The tables still running are kept in a heap by end : the
+        cost is O(n log n) plus the number of conflicts, instead of
+        comparing every pair of bookings.
+    """
+    conflicts = []
+    gamer = None
+    running = []
+    for gamer_id, table_id, begin, end in bookings:
+        if gamer_id != gamer:
+            gamer, running = gamer_id, []
+        while running and running[0][0] <= begin:
+            heappop(running)
+        for running_end, running_id in running:
+            conflicts.append(Conflict(gamer_id, running_id, table_id))
+        heappush(running, (end, table_id))
+    return conflicts
+
+
+def outside_session(table, game_session):
+    """ True when a scheduled table does not fit in its session window """
+    if table.begin is None or table.end is None:
+        return False
+    return (table.begin < game_session.begin or table.end > game_session.end
+            or table.end <= table.begin)
+
+
+def session_schedule(session, session_id):
+    """ The conflict report of a game session : the tables outside of the
+        session window and the overlapping bookings of every gamer, from
+        two queries and one sweep. None for an unknown session.
+    """
+    game_session = session.query(GameSession).get(session_id)
+    if game_session is None:
+        return None
+    tables = session.query(GameTable)\
+        .filter(GameTable.session_id == session_id, GameTable.active == True)\
+        .order_by(GameTable.begin, GameTable.id)\
+        .all()
+    outside = [table for table in tables if outside_session(table, game_session)]
+    bookings = session.query(Attendance.gamer_id, GameTable.id, GameTable.begin, GameTable.end)\
+        .join(GameTable, Attendance.table_id == GameTable.id)\
+        .filter(GameTable.session_id == session_id, GameTable.active == True,
+                GameTable.begin != None, GameTable.end != None,
+                Attendance.active == True, Attendance.name.in_(ATTENDANCE_BOOKED))\
+        .order_by(Attendance.gamer_id, GameTable.begin, GameTable.id)
+    return ScheduleReport(game_session, dict((table.id, table) for table in tables),
+                          outside, sweep_conflicts(bookings))
+
+
+def tables_between(session, session_id, begin, end):
+    """ The active tables of a session running at some point of [begin, end) """
+    return session.query(GameTable)\
+        .filter(GameTable.session_id == session_id, GameTable.active == True,
+                GameTable.begin < end, GameTable.end > begin)\
+        .order_by(GameTable.begin, GameTable.id)\
+        .all()
+
+
+def signup_conflicts(session, gamer_id, table_id):
+    """ The other tables booked by a gamer overlapping the table `table_id`,
+        in any session. Found from the bookings of the gamer (indexed on
+        gamer_id), not from the tables of the session.
+    """
+    table = session.query(GameTable).get(table_id)
+    if table is None or table.begin is None or table.end is None:
+        return []
+    return session.query(GameTable)\
+        .join(Attendance, Attendance.table_id == GameTable.id)\
+        .filter(Attendance.gamer_id == gamer_id, Attendance.active == True,
+                Attendance.name.in_(ATTENDANCE_BOOKED),
+                GameTable.id != table_id, GameTable.active == True,
+                GameTable.begin < table.end, GameTable.end > table.begin)\
+        .order_by(GameTable.begin)\
+        .all()
@@ -0,0 +1,168 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Schema maintenance helpers : in-place upgrade of existing SQLite files
+    and query plan checks of the hot queries of the application.
+"""
+import re
+from datetime import datetime
+
+from sqlalchemy import and_, func, inspect, select
+from sqlalchemy.orm import Session
+
+from gamesess.models import Base, Gamer, Club, GamerClub, GameSession, GameTable, Game, GamePlayers, Attendance
+from gamesess.models import ATTENDANCE_SEATED
+from gamesess.services import rebuild_player_counts
+from gamesess.search import SEARCH_TABLE, search_ddl, fill_search
+from gamesess.geo import GEO_TABLE, geo_ddl, fill_geo
+from gamesess.stats import STATS_TABLES, stats_ddl, fill_stats
+
+TRIGGER_NAME = re.compile(r'CREATE TRIGGER IF NOT EXISTS (\w+)')
+
+
+def backfill_seats_taken(connection):
+    """ GameTable.seats_taken of the existing tables, from their seated attendances """
+    seated = select([func.count(Attendance.id)])\
+        .where(and_(Attendance.table_id == GameTable.id, Attendance.active == True,
+                    Attendance.name.in_(ATTENDANCE_SEATED)))\
+        .as_scalar()
+    return connection.execute(GameTable.__table__.update().values(seats_taken=seated)).rowcount
+
+def trigger_names(statements):
+    """ The names of the triggers created by DDL statements """
+    return set(match.group(1) for match in map(TRIGGER_NAME.match, statements) if match)
+
+
+def existing_triggers(engine):
+    return set(row[0] for row in engine.execute(u"SELECT name FROM sqlite_master WHERE type = 'trigger'"))
+
+
+# (table, column) : function(connection) filling a column just added
+BACKFILLS = {
+    ('gametable', 'seats_taken'): backfill_seats_taken,
+}
+
+
+def upgrade_schema(engine):
+    """ Bring an existing database up to date with the models.
+
+        Missing tables are created, missing columns are added with
+        ALTER TABLE (and filled by their BACKFILLS in the same transaction)
+        and missing indexes are created. Nothing is ever dropped.
+        The full-text search index (see gamesess.search), the spatial
+        index of the clubs (see gamesess.geo) and the statistics rollups
+        (see gamesess.stats) are created when missing, and filled when they
+        or one of their triggers were missing : the changes made meanwhile
+        are not in them. A new gameplayers table is filled from Game.parts.
+        Returns the list of statements/objects applied.
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    triggers = existing_triggers(engine)
+    applied = [u'CREATE TABLE %s' % table.name for table in Base.metadata.sorted_tables
+               if table.name not in existing_tables]
+    Base.metadata.create_all(engine)
+    new_triggers = existing_triggers(engine) - triggers
+    applied.extend(u'CREATE TRIGGER %s' % name for name in sorted(new_triggers))
+    if SEARCH_TABLE not in existing_tables or new_triggers & trigger_names(search_ddl()):
+        with engine.begin() as connection:
+            count = fill_search(connection)
+        applied.append(u'Search index %s filled (%i entries)' % (SEARCH_TABLE, count))
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = set(col['name'] for col in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            ddl = u'ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name, column.type.compile(dialect=engine.dialect))
+            if column.server_default is not None:
+                # SQLite only adds a NOT NULL column with a default value
+                ddl += u" DEFAULT '%s'" % column.server_default.arg
+                if not column.nullable:
+                    ddl += u' NOT NULL'
+            backfill = BACKFILLS.get((table.name, column.name))
+            with engine.begin() as connection:
+                connection.execute(ddl)
+                if backfill is not None:
+                    ddl += u' (%i rows filled)' % backfill(connection)
+            applied.append(ddl)
+        existing_indexes = set(idx['name'] for idx in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            index.create(engine)
+            applied.append(u'CREATE INDEX %s' % index.name)
+    if GEO_TABLE not in existing_tables or new_triggers & trigger_names(geo_ddl()):
+        # after the coordinate columns
+        with engine.begin() as connection:
+            count = fill_geo(connection)
+        applied.append(u'Spatial index %s filled (%i entries)' % (GEO_TABLE, count))
+    if GamePlayers.__tablename__ not in existing_tables:
+        session = Session(bind=engine)
+        try:
+            invalid = rebuild_player_counts(session)
+            count = session.query(GamePlayers).count()
+        finally:
+            session.close()
+        applied.append(u'Player counts filled (%i rows, %i games with invalid parts)' % (count, len(invalid)))
+    if not existing_tables.issuperset(STATS_TABLES) or new_triggers & trigger_names(stats_ddl()):
+        with engine.begin() as connection:
+            count = fill_stats(connection)
+        applied.append(u'Statistics rollups filled (%i rows)' % count)
+    return applied
+
+
+def hot_queries(session):
+    """ The queries run on (almost) every request, by name.
+        Each of them must be answered through an index.
+    """
+    return [
+        ('login', session.query(Gamer).filter_by(email=u'x@y.z')),
+        ('clubs_list', session.query(Club).filter_by(public=True).order_by(Club.name)),
+        ('club_gamers', session.query(GamerClub).filter_by(club_id=1)),
+        ('gamer_clubs', session.query(GamerClub).filter_by(gamer_id=1)),
+        ('club_sessions', session.query(GameSession)
+            .filter(GameSession.club_id == 1, GameSession.begin >= datetime(2017, 1, 1))
+            .order_by(GameSession.begin)),
+        ('session_tables', session.query(GameTable).filter_by(session_id=1)),
+        ('session_tables_between', session.query(GameTable)
+            .filter(GameTable.session_id == 1, GameTable.begin < datetime(2017, 5, 27),
+                    GameTable.end > datetime(2017, 5, 26))),
+        ('gamer_bookings', session.query(GameTable)
+            .join(Attendance, Attendance.table_id == GameTable.id)
+            .filter(Attendance.gamer_id == 1, GameTable.begin < datetime(2017, 5, 27),
+                    GameTable.end > datetime(2017, 5, 26))),
+        ('table_attendances', session.query(Attendance).filter_by(table_id=1)),
+        ('gamer_attendances', session.query(Attendance).filter_by(gamer_id=1)),
+        ('table_gamer', session.query(Attendance).filter_by(table_id=1, gamer_id=1)),
+        ('game_children', session.query(Game).filter_by(parent_id=1)),
+        ('games_for_players', session.query(Game)
+            .join(GamePlayers, GamePlayers.game_id == Game.id)
+            .filter(GamePlayers.players == 4, Game.average_duration <= 60)),
+    ]
+
+
+def explain_query_plan(session, query):
+    """ Returns the details lines of the SQLite EXPLAIN QUERY PLAN of a query """
+    bind = session.get_bind()
+    compiled = query.statement.compile(dialect=bind.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    connection = bind.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + unicode(compiled), params)
+        # rows are (id, parent, notused, detail)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def plan_uses_index(details):
+    """ A plan is fine when no table is fully scanned and no temporary
+        sort is needed.
+    """
+    for detail in details:
+        if detail.startswith('SCAN') and 'INDEX' not in detail:
+            return False
+        if 'TEMP B-TREE' in detail:
+            return False
+    return True
@@ -0,0 +1,125 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Full-text search over the games, the public clubs and the game sessions.
+
+    One SQLite FTS5 table indexes the title and the text of every searchable
+    row. The unicode61 tokenizer folds the case and removes the diacritics,
+    so "liege" finds "Liège" and "LIÈGE". The index is kept up to date by
+    triggers on the indexed tables : the ORM, the Core bulk inserts and the
+    raw SQL all go through them.
+
+    The rowid of an entry is the id of the row times 4 plus the code of its
+    kind, which lets the triggers update an entry through its rowid.
+"""
+import re
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from gamesess.models import Base
+
+SEARCH_TABLE = 'search_index'
+# kind code : (table, title, text, condition to be indexed)
+SEARCH_KINDS = {
+    1: ('game', u"{row}.name", u"''", u'{row}.active'),
+    2: ('club', u"{row}.name", u"coalesce({row}.description, '') || ' ' || coalesce({row}.address, '')",
+        u'{row}.active AND {row}.public'),
+    3: ('gamesession', u"{row}.name", u"coalesce({row}.type, '')", u'{row}.active'),
+}
+SEARCH_COLUMNS = {
+    'game': 'name, active',
+    'club': 'name, description, address, active, public',
+    'gamesession': 'name, type, active',
+}
+# matches in the title weigh more than in the text
+TITLE_WEIGHT, TEXT_WEIGHT = 10.0, 1.0
+MAX_WORDS = 10
+
+SearchHit = namedtuple('SearchHit', 'kind id title')
+
+
+def _entry(code, row):
+    """ The rowid, title and text of the entry of `row` (new or old) """
+    table, title, body, condition = SEARCH_KINDS[code]
+    return (u'%s.id * 4 + %i' % (row, code), title.format(row=row),
+            body.format(row=row), condition.format(row=row))
+
+
+def search_ddl():
+    """ The statements creating the index and its triggers """
+    statements = [
+        u"CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, body, "
+        u"tokenize='unicode61 remove_diacritics 2', prefix='2 3')" % SEARCH_TABLE]
+    for code, (table, title, body, condition) in sorted(SEARCH_KINDS.items()):
+        rowid, title, body, condition = _entry(code, 'new')
+        insert = u'INSERT INTO %s(rowid, title, body) SELECT %s, %s, %s WHERE %s;' % (
+            SEARCH_TABLE, rowid, title, body, condition)
+        delete = u'DELETE FROM %s WHERE rowid = old.id * 4 + %i;' % (SEARCH_TABLE, code)
+        statements.extend([
+            u'CREATE TRIGGER IF NOT EXISTS %s_search_insert AFTER INSERT ON %s '
+            u'BEGIN %s END' % (table, table, insert),
+            u'CREATE TRIGGER IF NOT EXISTS %s_search_update AFTER UPDATE OF %s ON %s '
+            u'BEGIN %s %s END' % (table, SEARCH_COLUMNS[table], table, delete, insert),
+            u'CREATE TRIGGER IF NOT EXISTS %s_search_delete AFTER DELETE ON %s '
+            u'BEGIN %s END' % (table, table, delete),
+        ])
+    return statements
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    """ Creates the index and its triggers with the tables, when missing.
+        A new index on existing tables must be filled (see upgrade_schema).
+    """
+    if connection.dialect.name == 'sqlite':
+        for statement in search_ddl():
+            connection.execute(statement)
+
+
+def fill_search(connection):
+    """ Refills the whole index from the indexed tables, through a
+        connection or a session. Returns the number of entries.
+    """
+    connection.execute(u'DELETE FROM %s' % SEARCH_TABLE)
+    for code, (table, title, body, condition) in sorted(SEARCH_KINDS.items()):
+        rowid, title, body, condition = _entry(code, table)
+        connection.execute(u'INSERT INTO %s(rowid, title, body) SELECT %s, %s, %s FROM %s WHERE %s' % (
+            SEARCH_TABLE, rowid, title, body, table, condition))
+    connection.execute(u"INSERT INTO %s(%s) VALUES ('optimize')" % (SEARCH_TABLE, SEARCH_TABLE))
+    return connection.execute(u'SELECT count(*) FROM %s' % SEARCH_TABLE).scalar()
+
+
+def rebuild_search(session):
+    """ Refills the whole index and commits. Returns the number of entries. """
+    count = fill_search(session)
+    session.commit()
+    return count
+
+
+def match_expression(query):
+    """ The FTS5 expression of a user query : every word must match, the
+        words of two letters or more as prefixes. The words are quoted, the
+        FTS5 operators typed by the user are plain words.
+    """
+    words = re.findall(r'\w+', query, re.UNICODE)[:MAX_WORDS]
+    return u' '.join(len(word) > 1 and u'"%s"*' % word or u'"%s"' % word for word in words)
+
+
+def search(session, query, kind=None, limit=20):
+    """ The best matches of a user query, as SearchHit. `kind` is a table
+        name to only search the games, the clubs or the sessions.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return []
+    sql = u'SELECT rowid, title FROM %s WHERE %s MATCH :expression' % (SEARCH_TABLE, SEARCH_TABLE)
+    params = {'expression': expression, 'limit': limit}
+    if kind is not None:
+        codes = [code for code, kind_spec in SEARCH_KINDS.items() if kind_spec[0] == kind]
+        if not codes:
+            raise ValueError(u'Unknown search kind : %s' % kind)
+        sql += u' AND rowid % 4 = :code'
+        params['code'] = codes[0]
+    sql += u' ORDER BY bm25(%s, %s, %s) LIMIT :limit' % (SEARCH_TABLE, TITLE_WEIGHT, TEXT_WEIGHT)
+    return [SearchHit(SEARCH_KINDS[rowid % 4][0], rowid // 4, title)
+            for rowid, title in session.execute(sql, params)]
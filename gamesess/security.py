@@ -0,0 +1,173 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Password hashing and verification.
+
+    The hashing parameters are configurable (PASSWORD_HASH_*), verification
+    can be offloaded to a bounded pool of threads (PASSWORD_VERIFY_*) and
+    failed logins are throttled per email (LOGIN_*).
+"""
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher(object):
+    """ Hashes passwords with a tunable method and work factor """
+
+    def __init__(self, method='pbkdf2:sha256', iterations=150000, salt_length=8):
+        self.configure(method, iterations, salt_length)
+
+    def configure(self, method='pbkdf2:sha256', iterations=150000, salt_length=8):
+        self.method = method
+        self.iterations = iterations
+        self.salt_length = salt_length
+        self._dummy_hash = None
+
+    @property
+    def dummy_hash(self):
+        """ The hash of a random password, made with the current parameters :
+            checked in place of a missing hash, for the same time
+        """
+        if self._dummy_hash is None:
+            self._dummy_hash = self.hash(os.urandom(16).encode('hex'))
+        return self._dummy_hash
+
+    @property
+    def full_method(self):
+        if self.method.startswith('pbkdf2:') and self.iterations:
+            return '%s:%i' % (self.method, self.iterations)
+        return self.method
+
+    def hash(self, password):
+        return generate_password_hash(password, method=self.full_method,
+                                      salt_length=self.salt_length)
+
+    def verify(self, hashed, password):
+        if not hashed:
+            # as long as a real check : the time tells nothing of the account
+            check_password_hash(self.dummy_hash, password)
+            return False
+        # SQLite gives back unicode, hashlib wants a native string method name
+        return check_password_hash(str(hashed), password)
+
+    def needs_rehash(self, hashed):
+        """ True when the hash was not made with the current parameters """
+        if not hashed or hashed.count('$') < 2:
+            return True
+        method, salt, _ = hashed.split('$', 2)
+        return method != self.full_method or len(salt) != self.salt_length
+
+
+class VerificationPool(object):
+    """ Runs password verifications in a bounded pool of worker threads.
+
+        hashlib releases the GIL while computing PBKDF2 : at most `workers`
+        hashes burn CPU at the same time whatever the number of request
+        threads, and no more than `queue_size` verifications can wait.
+        With no workers, verifications run inline.
+    """
+
+    def __init__(self, workers=0, queue_size=32, timeout=10):
+        self.configure(workers, queue_size, timeout)
+
+    def configure(self, workers=0, queue_size=32, timeout=10):
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            # its threads end once the verifications already queued are done
+            pool.close()
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+
+    def verify(self, hasher, hashed, password):
+        """ Returns True/False, or None when the pool is saturated or too slow """
+        if not self.workers:
+            return hasher.verify(hashed, password)
+        if not self._slots.acquire(False):
+            return None
+        try:
+            result = self._get_pool().apply_async(hasher.verify, (hashed, password))
+            return result.get(self.timeout)
+        except TimeoutError:
+            return None
+        finally:
+            self._slots.release()
+
+
+class LoginThrottle(object):
+    """ Counts the failed logins per email over a sliding window.
+
+        Once `max_failures` is reached, the email is blocked until the
+        oldest failure leaves the window : no hash is computed meanwhile.
+    """
+
+    def __init__(self, max_failures=5, window=300, max_entries=10000):
+        self.configure(max_failures, window, max_entries)
+
+    def configure(self, max_failures=5, window=300, max_entries=10000):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_entries = max_entries
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        failures = [stamp for stamp in self._failures.get(key, ()) if stamp > now - self.window]
+        if failures:
+            self._failures[key] = failures
+        else:
+            self._failures.pop(key, None)
+        return failures
+
+    def is_blocked(self, email):
+        if not self.max_failures:
+            return False
+        with self._lock:
+            return len(self._recent(email.lower(), time.time())) >= self.max_failures
+
+    def failure(self, email):
+        now = time.time()
+        with self._lock:
+            if len(self._failures) >= self.max_entries:
+                for key in list(self._failures):
+                    self._recent(key, now)
+            failures = self._recent(email.lower(), now)
+            failures.append(now)
+            self._failures[email.lower()] = failures[-max(self.max_failures, 1):]
+
+    def reset(self, email):
+        with self._lock:
+            self._failures.pop(email.lower(), None)
+
+
+hasher = PasswordHasher()
+verifier = VerificationPool()
+login_throttle = LoginThrottle()
+
+
+def init_security(app):
+    """ Applies the application configuration to the module instances """
+    config = app.config
+    hasher.configure(
+        method=config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256'),
+        iterations=config.get('PASSWORD_HASH_ITERATIONS', 150000),
+        salt_length=config.get('PASSWORD_SALT_LENGTH', 8))
+    verifier.configure(
+        workers=config.get('PASSWORD_VERIFY_WORKERS', 0),
+        queue_size=config.get('PASSWORD_VERIFY_QUEUE', 32),
+        timeout=config.get('PASSWORD_VERIFY_TIMEOUT', 10))
+    login_throttle.configure(
+        max_failures=config.get('LOGIN_MAX_FAILURES', 5),
+        window=config.get('LOGIN_FAILURE_WINDOW', 300))
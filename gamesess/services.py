@@ -0,0 +1,379 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Read services used by the views : each one answers a page in a fixed,
+    small number of queries whatever the amount of data.
+"""
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+from sqlalchemy import and_, or_, case, func, literal, select, union, DateTime
+from sqlalchemy.orm import aliased
+
+from gamesess.models import Club, Gamer, GamerClub, GamerIdentity, GameSession, GameTable, Game, Attendance
+from gamesess.models import SessionRule
+from gamesess.models import GamePlayers, parse_parts, ATTENDANCE_STATUSES, ATTENDANCE_SEATED, ATTENDANCE_WAITLIST
+from gamesess.geo import nearby_clubs, nearest_clubs
+from gamesess.recurrence import club_calendar
+
+ClubListing = namedtuple('ClubListing', 'club managers')
+Page = namedtuple('Page', 'items next_after')
+
+
+def _after_club(query, session, after):
+    """ Keyset condition : clubs sorted after the club `after` on (name, id) """
+    if after is None:
+        return query
+    row = session.query(Club.name, Club.id).filter(Club.id == after).first()
+    if row is None:
+        return query
+    name, club_id = row
+    if name is None:
+        # SQLite sorts NULL names first
+        return query.filter(or_(Club.name != None, and_(Club.name == None, Club.id > club_id)))
+    return query.filter(or_(Club.name > name, and_(Club.name == name, Club.id > club_id)))
+
+
+def club_managers(session, club_ids):
+    """ {club id: [manager Gamer, ...]} for the given clubs, in one query """
+    result = dict((club_id, []) for club_id in club_ids)
+    if not club_ids:
+        return result
+    rows = session.query(GamerClub.club_id, Gamer)\
+        .join(Gamer, GamerClub.gamer_id == Gamer.id)\
+        .filter(GamerClub.club_id.in_(club_ids),
+                GamerClub.role == 'manager',
+                GamerClub.active == True)\
+        .order_by(GamerClub.club_id, Gamer.id)
+    for club_id, gamer in rows:
+        result[club_id].append(gamer)
+    return result
+
+
+def _club_page(session, query, after, per_page):
+    query = _after_club(query, session, after).order_by(Club.name, Club.id)
+    clubs = query.limit(per_page + 1).all()
+    next_after = None
+    if len(clubs) > per_page:
+        clubs = clubs[:per_page]
+        next_after = clubs[-1].id
+    managers = club_managers(session, [club.id for club in clubs])
+    return Page([ClubListing(club, managers[club.id]) for club in clubs], next_after)
+
+
+def public_clubs_page(session, after=None, per_page=20):
+    """ A page of public clubs with their managers, sorted on (name, id).
+        `after` is the id of the last club of the previous page.
+    """
+    query = session.query(Club).filter(Club.public == True)
+    return _club_page(session, query, after, per_page)
+
+
+def nearby_clubs_page(session, latitude, longitude, radius, per_page=20):
+    """ The public clubs nearest to a point within `radius` km, with their
+        managers : (Page, {club id: distance in km}), nearest first
+    """
+    hits = nearest_clubs(session, latitude, longitude, per_page, max_radius=radius)
+    clubs = {}
+    if hits:
+        clubs = dict((club.id, club) for club in
+                     session.query(Club).filter(Club.id.in_([hit.club_id for hit in hits])))
+    managers = club_managers(session, list(clubs))
+    return Page([ClubListing(clubs[hit.club_id], managers[hit.club_id]) for hit in hits], None), dict(hits)
+
+
+def is_club_member(session, club_id, gamer_id):
+    """ True when the gamer is an active member (or manager) of the club """
+    return session.query(GamerClub.id)\
+        .filter(GamerClub.club_id == club_id, GamerClub.gamer_id == gamer_id, GamerClub.active == True)\
+        .first() is not None
+
+
+def manages_a_club(session, gamer_id):
+    """ True when the gamer is an active manager of at least one club """
+    return session.query(GamerClub.id)\
+        .filter(GamerClub.gamer_id == gamer_id, GamerClub.role == 'manager', GamerClub.active == True)\
+        .first() is not None
+
+
+def may_edit_game(session, game, gamer_id):
+    """ The catalog is shared : a game is changed by its creator or by the
+        managers of the clubs
+    """
+    return game.create_id == gamer_id or manages_a_club(session, gamer_id)
+
+
+def gamer_clubs_page(session, gamer_id, after=None, per_page=20):
+    """ A page of the clubs a gamer belongs to, with their managers """
+    query = session.query(Club)\
+        .join(GamerClub, GamerClub.club_id == Club.id)\
+        .filter(GamerClub.gamer_id == gamer_id, GamerClub.active == True)\
+        .distinct()
+    return _club_page(session, query, after, per_page)
+
+
+ClubOverview = namedtuple('ClubOverview', 'club managers sessions')
+
+
+def club_overview(session, club_id, since=None, limit=20):
+    """ A club with its managers and its next game sessions """
+    club = session.query(Club).get(club_id)
+    if club is None:
+        return None
+    since = since or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    # with the occurrences of the rules of the club not materialized yet
+    sessions = club_calendar(session, club_id, since, limit=limit)
+    return ClubOverview(club, club_managers(session, [club_id])[club_id], sessions)
+
+
+AgendaTable = namedtuple('AgendaTable', 'table game counts seated remaining attendees')
+Agenda = namedtuple('Agenda', 'game_session tables')
+
+
+def session_agenda(session, session_id):
+    """ All the tables of a game session with their game, the number of
+        attendances per status, the remaining seats and the attendees.
+
+        Tables and counts come from one GROUP BY query, the attendees from a
+        second one. Returns None for an unknown session.
+    """
+    game_session = session.query(GameSession).get(session_id)
+    if game_session is None:
+        return None
+    count_columns = [
+        func.sum(case([(Attendance.name == status, 1)], else_=0))
+        for status in ATTENDANCE_STATUSES]
+    rows = session.query(GameTable, Game, *count_columns)\
+        .outerjoin(Game, GameTable.game_id == Game.id)\
+        .outerjoin(Attendance, and_(Attendance.table_id == GameTable.id,
+                                    Attendance.active == True))\
+        .filter(GameTable.session_id == session_id, GameTable.active == True)\
+        .group_by(GameTable.id, Game.id)\
+        .order_by(GameTable.begin, GameTable.id)\
+        .all()
+
+    attendees = dict((row[0].id, []) for row in rows)
+    name_columns = [getattr(Gamer, name) for name in GamerIdentity.columns]
+    attendee_rows = session.query(Attendance.table_id, Attendance.name, *name_columns)\
+        .join(GameTable, Attendance.table_id == GameTable.id)\
+        .join(Gamer, Attendance.gamer_id == Gamer.id)\
+        .filter(GameTable.session_id == session_id, GameTable.active == True,
+                Attendance.active == True)\
+        .order_by(Attendance.table_id, Attendance.id)
+    for row in attendee_rows:
+        gamer = GamerIdentity(**dict(zip(GamerIdentity.columns, row[2:])))
+        attendees[row[0]].append((row[1], gamer))
+
+    tables = []
+    for row in rows:
+        table, game = row[0], row[1]
+        counts = OrderedDict(zip(ATTENDANCE_STATUSES, [int(count or 0) for count in row[2:]]))
+        seated = sum(counts[status] for status in ATTENDANCE_SEATED)
+        remaining = None
+        if table.max_part is not None:
+            remaining = max(table.max_part - seated, 0)
+        tables.append(AgendaTable(table, game, counts, seated, remaining, attendees[table.id]))
+    return Agenda(game_session, tables)
+
+
+TableSeats = namedtuple('TableSeats', 'table game waiting status')
+
+
+def table_seats(session, table_id, gamer_id=None):
+    """ A table with its game, the size of its waitlist and the status of
+        the gamer at the table (None when absent). None for an unknown table.
+    """
+    row = session.query(GameTable, Game)\
+        .outerjoin(Game, GameTable.game_id == Game.id)\
+        .filter(GameTable.id == table_id)\
+        .first()
+    if row is None:
+        return None
+    waiting = session.query(func.count(Attendance.id))\
+        .filter(Attendance.table_id == table_id, Attendance.name == ATTENDANCE_WAITLIST,
+                Attendance.active == True)\
+        .scalar()
+    status = gamer_id and session.query(Attendance.name)\
+        .filter_by(table_id=table_id, gamer_id=gamer_id, active=True)\
+        .scalar()
+    return TableSeats(row[0], row[1], waiting, status or None)
+
+
+TableOccupancy = namedtuple('TableOccupancy', 'table_id session_id seated remaining waiting')
+
+
+def table_occupancy(session, table_ids):
+    """ The seated gamers, remaining seats (as on the session page) and
+        waitlist size of some tables, in one GROUP BY query
+    """
+    if not table_ids:
+        return []
+    seated = func.sum(case([(Attendance.name.in_(ATTENDANCE_SEATED), 1)], else_=0))
+    waiting = func.sum(case([(Attendance.name == ATTENDANCE_WAITLIST, 1)], else_=0))
+    rows = session.query(GameTable.id, GameTable.session_id, GameTable.max_part, seated, waiting)\
+        .outerjoin(Attendance, and_(Attendance.table_id == GameTable.id,
+                                    Attendance.active == True))\
+        .filter(GameTable.id.in_(table_ids))\
+        .group_by(GameTable.id)
+    result = []
+    for table_id, session_id, max_part, seated, waiting in rows:
+        seated = int(seated or 0)
+        remaining = None
+        if max_part is not None:
+            remaining = max(max_part - seated, 0)
+        result.append(TableOccupancy(table_id, session_id, seated, remaining, int(waiting or 0)))
+    return result
+
+
+def last_change(session, *sources):
+    """ (latest modified, number of rows) over several sources in one query.
+
+        Each source is a (model, criterion) pair. The row count catches the
+        deletions that the latest modified date alone would miss.
+    """
+    columns = []
+    for model, criterion in sources:
+        # Gamer.modified is declared as an Integer but holds datetimes
+        columns.append(select([func.max(model.modified, type_=DateTime)]).where(criterion).as_scalar())
+        columns.append(select([func.count(model.id)]).where(criterion).as_scalar())
+    row = session.query(*columns).one()
+    modified = [value for value in row[0::2] if value is not None]
+    return (modified and max(modified) or None, tuple(row[1::2]))
+
+
+def clubs_sources():
+    managers = select([GamerClub.gamer_id]).where(GamerClub.role == 'manager')
+    return [(Club, Club.public == True),
+            (GamerClub, GamerClub.role == 'manager'),
+            (Gamer, Gamer.id.in_(managers))]
+
+
+def club_sources(club_id):
+    gamers = select([GamerClub.gamer_id]).where(GamerClub.club_id == club_id)
+    return [(Club, Club.id == club_id),
+            (GamerClub, GamerClub.club_id == club_id),
+            (Gamer, Gamer.id.in_(gamers)),
+            (GameSession, GameSession.club_id == club_id),
+            (SessionRule, SessionRule.club_id == club_id)]
+
+
+def club_export_sources(club_id):
+    sessions = select([GameSession.id]).where(GameSession.club_id == club_id)
+    tables = select([GameTable.id]).where(GameTable.session_id.in_(sessions))
+    games = select([GameTable.game_id]).where(GameTable.session_id.in_(sessions))
+    return [(Club, Club.id == club_id),
+            (GameSession, GameSession.club_id == club_id),
+            (GameTable, GameTable.session_id.in_(sessions)),
+            (Attendance, Attendance.table_id.in_(tables)),
+            (Game, Game.id.in_(games))]
+
+
+def session_sources(session_id):
+    tables = select([GameTable.id]).where(GameTable.session_id == session_id)
+    games = select([GameTable.game_id]).where(GameTable.session_id == session_id)
+    attendees = select([Attendance.gamer_id]).where(Attendance.table_id.in_(tables))
+    return [(GameSession, GameSession.id == session_id),
+            (GameTable, GameTable.session_id == session_id),
+            (Attendance, Attendance.table_id.in_(tables)),
+            (Gamer, Gamer.id.in_(attendees)),
+            (Game, Game.id.in_(games))]
+
+
+def game_sources(game_id):
+    return [(Game, Game.id.in_(game_family_ids(game_id)))]
+
+
+def games_for_players(session, players, max_duration=None, limit=50):
+    """ Active games playable with exactly `players` players, optionally
+        lasting at most `max_duration` minutes, sorted by name.
+    """
+    query = session.query(Game)\
+        .join(GamePlayers, GamePlayers.game_id == Game.id)\
+        .filter(GamePlayers.players == players, Game.active == True)
+    if max_duration is not None:
+        query = query.filter(Game.average_duration <= max_duration)
+    return query.order_by(Game.name).limit(limit).all()
+
+
+def rebuild_player_counts(session):
+    """ Recomputes the GamePlayers rows of every game from Game.parts.
+        Returns the names of the games whose parts could not be parsed.
+    """
+    invalid = []
+    session.query(GamePlayers).delete(synchronize_session=False)
+    rows = []
+    for game_id, name, parts in session.query(Game.id, Game.name, Game.parts):
+        try:
+            counts = parse_parts(parts)
+        except ValueError:
+            invalid.append(name)
+            continue
+        rows.extend({'game_id': game_id, 'players': count} for count in counts)
+    if rows:
+        session.execute(GamePlayers.__table__.insert(), rows)
+    session.commit()
+    return invalid
+
+
+# Protects the recursive queries against a cycle in Game.parent_id
+MAX_GAME_DEPTH = 100
+
+GameNode = namedtuple('GameNode', 'game children')
+
+
+def _game_tree_cte(game_id, towards_parent=False):
+    """ Recursive CTE of (id, depth) : the game and its descendants, or the
+        game and its ancestors when `towards_parent` is set.
+    """
+    name = towards_parent and 'game_ancestors' or 'game_descendants'
+    tree = select([Game.id.label('id'), Game.parent_id.label('parent_id'),
+                   literal(0).label('depth')])\
+        .where(Game.id == game_id)\
+        .cte(name, recursive=True)
+    step = aliased(Game)
+    if towards_parent:
+        link = step.id == tree.c.parent_id
+    else:
+        link = step.parent_id == tree.c.id
+    return tree.union_all(
+        select([step.id, step.parent_id, tree.c.depth + 1])
+        .where(and_(link, tree.c.depth < MAX_GAME_DEPTH)))
+
+
+def game_ancestors(session, game_id):
+    """ The ancestors of a game, from the root game down to its parent """
+    tree = _game_tree_cte(game_id, towards_parent=True)
+    rows = session.query(Game)\
+        .join(tree, Game.id == tree.c.id)\
+        .filter(tree.c.depth > 0)\
+        .order_by(tree.c.depth.desc())
+    return rows.all()
+
+
+def game_family(session, game_id):
+    """ The GameNode tree of a game and all its descendants (expansions,
+        maps, scenarios, ...) at any depth, loaded in a single query.
+        Returns None for an unknown game.
+    """
+    tree = _game_tree_cte(game_id)
+    games = session.query(Game)\
+        .join(tree, Game.id == tree.c.id)\
+        .order_by(tree.c.depth, Game.name, Game.id)\
+        .all()
+    if not games:
+        return None
+    nodes = {}
+    for game in games:
+        if game.id in nodes:
+            # only a cycle in parent_id brings a game twice
+            continue
+        nodes[game.id] = GameNode(game, [])
+        if game.id != game_id:
+            nodes[game.parent_id].children.append(nodes[game.id])
+    return nodes[game_id]
+
+
+def game_family_ids(game_id):
+    """ Selectable of the ids of a game, its ancestors and its descendants """
+    descendants = _game_tree_cte(game_id)
+    ancestors = _game_tree_cte(game_id, towards_parent=True)
+    return union(select([descendants.c.id]), select([ancestors.c.id]))
@@ -0,0 +1,291 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" Attendance and play statistics, precomputed in rollup tables.
+
+    The seated attendances (ATTENDANCE_SEATED, active) are summed up per
+    table (tablestats), per gamer and session (gamersessionstats), per
+    session (sessionstats) and per game in a club (clubgamestats). Triggers
+    keep the rollups up to date on every change of an attendance, of a
+    table or of a session : each change adds or removes its own
+    contribution, nothing is recounted. The triggers of the attendances
+    update the first two rollups, the triggers of these update the next.
+
+    The dashboards only read the rollups (and the rows they name).
+    fill_stats recomputes everything from the attendances : check_stats
+    compares both.
+"""
+from collections import namedtuple
+
+from sqlalchemy import event, func
+
+from gamesess.models import Base, Club, Game, GameSession
+from gamesess.models import GamerSessionStats, SessionStats, ClubGameStats, ATTENDANCE_SEATED
+
+# in the order they are filled
+STATS_TABLES = ('tablestats', 'gamersessionstats', 'sessionstats', 'clubgamestats')
+SEATED = (u'{row}.active AND {row}.name IN (%s) AND {row}.table_id IS NOT NULL '
+          u'AND {row}.gamer_id IS NOT NULL' % u', '.join(u"'%s'" % name for name in ATTENDANCE_SEATED))
+# the contribution of a tablestats row to the rollup of its session and to
+# the rollup of its game in its club
+SESSION_TERMS = (
+    ('seats', u'{row}.seated'),
+    ('tables', u'({row}.seated > 0)'),
+    ('capacity', u'coalesce({row}.max_part, 0)'),
+    ('full_tables', u'coalesce({row}.seated >= {row}.max_part, 0)'),
+    ('short_tables', u'coalesce({row}.seated < {row}.min_part, 0)'),
+)
+CLUB_GAME_TERMS = (
+    ('plays', u'{row}.seated'),
+    ('tables', u'({row}.seated > 0)'),
+)
+# rows without any data, left behind by the triggers and not by fill_stats
+EMPTY_ROWS = {
+    'gamersessionstats': u'tables = 0',
+    'clubgamestats': u'plays = 0 AND tables = 0',
+}
+
+STATS_COLUMNS = {
+    'tablestats': u'table_id, session_id, club_id, game_id, min_part, max_part, seated',
+    'gamersessionstats': u'gamer_id, session_id, tables',
+    'sessionstats': u'session_id, club_id, gamers, ' + u', '.join(column for column, term in SESSION_TERMS),
+    'clubgamestats': u'club_id, game_id, ' + u', '.join(column for column, term in CLUB_GAME_TERMS),
+}
+
+ClubStats = namedtuple('ClubStats', 'club games sessions totals')
+SessionTotals = namedtuple('SessionTotals', 'sessions seats capacity full_tables short_tables')
+HistoryEntry = namedtuple('HistoryEntry', 'game_session club tables')
+
+
+def _insert(table, select, ignore=True):
+    """ INSERT (OR IGNORE) of the rows of a SELECT into a rollup """
+    return u'INSERT %sINTO %s (%s) %s;' % (ignore and u'OR IGNORE ' or u'', table, STATS_COLUMNS[table], select)
+
+
+def _apply(table, keys, terms, row, sign):
+    """ Adds (sign '+') or removes ('-') the terms of a tablestats row """
+    changes = u', '.join(u'%s = %s %s %s' % (column, column, sign, term.format(row=row))
+                         for column, term in terms)
+    where = u' AND '.join(u'%s = %s.%s' % (key, row, key) for key in keys)
+    return u'UPDATE %s SET %s WHERE %s;' % (table, changes, where)
+
+
+def _session_row(session_id):
+    """ Creates the missing sessionstats row of an existing session """
+    zeros = u', '.join(u'0' for column in ('gamers',) + tuple(column for column, term in SESSION_TERMS))
+    return _insert('sessionstats', u'SELECT id, club_id, %s FROM gamesession WHERE id = %s' % (zeros, session_id))
+
+
+def _table_rollups(row, sign):
+    """ Adds or removes the contribution of a tablestats row to the rollups """
+    statements = []
+    if sign == '+':
+        statements.append(_session_row(u'%s.session_id' % row))
+        statements.append(_insert('clubgamestats', u'SELECT {row}.club_id, {row}.game_id, 0, 0 '
+                                  u'WHERE {row}.club_id IS NOT NULL AND {row}.game_id IS NOT NULL'.format(row=row)))
+    statements.append(_apply('sessionstats', ('session_id',), SESSION_TERMS, row, sign))
+    statements.append(_apply('clubgamestats', ('club_id', 'game_id'), CLUB_GAME_TERMS, row, sign))
+    return u' '.join(statements)
+
+
+def _seat(row, sign):
+    """ Adds or removes the seat of an attendance row, when seated """
+    seated = SEATED.format(row=row)
+    statements = []
+    if sign == '+':
+        statements.append(_insert('tablestats',
+            u'SELECT gametable.id, gametable.session_id, gamesession.club_id, gametable.game_id, '
+            u'gametable.min_part, gametable.max_part, 0 FROM gametable '
+            u'LEFT JOIN gamesession ON gamesession.id = gametable.session_id '
+            u'WHERE gametable.id = {row}.table_id AND {seated}'.format(row=row, seated=seated)))
+        statements.append(_insert('gamersessionstats',
+            u'SELECT {row}.gamer_id, session_id, 0 FROM gametable '
+            u'WHERE id = {row}.table_id AND session_id IS NOT NULL AND {seated}'.format(row=row, seated=seated)))
+    statements.append(u'UPDATE tablestats SET seated = seated {sign} 1 '
+                      u'WHERE table_id = {row}.table_id AND {seated};'.format(row=row, sign=sign, seated=seated))
+    statements.append(u'UPDATE gamersessionstats SET tables = tables {sign} 1 WHERE gamer_id = {row}.gamer_id '
+                      u'AND session_id = (SELECT session_id FROM gametable WHERE id = {row}.table_id) '
+                      u'AND {seated};'.format(row=row, sign=sign, seated=seated))
+    return u' '.join(statements)
+
+
+def _table_gamers(table_id, session_id, sign):
+    """ Adds or removes the seated gamers of a table to a session of their history """
+    gamers = u'SELECT gamer_id FROM attendance WHERE table_id = %s AND %s' % (
+        table_id, SEATED.format(row='attendance'))
+    statements = []
+    if sign == '+':
+        statements.append(_insert('gamersessionstats',
+            u'SELECT gamer_id, %s, 0 FROM attendance WHERE table_id = %s AND %s AND %s IS NOT NULL' % (
+                session_id, table_id, SEATED.format(row='attendance'), session_id)))
+    statements.append(u'UPDATE gamersessionstats SET tables = tables %s 1 '
+                      u'WHERE session_id = %s AND gamer_id IN (%s);' % (sign, session_id, gamers))
+    return u' '.join(statements)
+
+
+def stats_ddl():
+    """ The statements creating the triggers of the rollups """
+    table_row = _insert('tablestats', u'SELECT new.id, new.session_id, '
+                        u'(SELECT club_id FROM gamesession WHERE id = new.session_id), '
+                        u'new.game_id, new.min_part, new.max_part, 0')
+    triggers = [
+        # attendances : the seats of the tables and the history of the gamers
+        ('attendance_stats_insert', u'AFTER INSERT ON attendance', _seat('new', '+')),
+        ('attendance_stats_update', u'AFTER UPDATE OF active, name, table_id, gamer_id ON attendance',
+         _seat('old', '-') + u' ' + _seat('new', '+')),
+        ('attendance_stats_delete', u'AFTER DELETE ON attendance', _seat('old', '-')),
+        # tables
+        ('gametable_stats_insert', u'AFTER INSERT ON gametable', table_row),
+        ('gametable_stats_update', u'AFTER UPDATE OF session_id, game_id, min_part, max_part ON gametable',
+         u'%s UPDATE tablestats SET session_id = new.session_id, '
+         u'club_id = (SELECT club_id FROM gamesession WHERE id = new.session_id), game_id = new.game_id, '
+         u'min_part = new.min_part, max_part = new.max_part WHERE table_id = new.id;' % table_row),
+        ('gametable_stats_move', u'AFTER UPDATE OF session_id ON gametable '
+         u'WHEN old.session_id IS NOT new.session_id',
+         _table_gamers('new.id', 'old.session_id', '-') + u' ' + _table_gamers('new.id', 'new.session_id', '+')),
+        ('gametable_stats_delete', u'AFTER DELETE ON gametable',
+         _table_gamers('old.id', 'old.session_id', '-') + u' DELETE FROM tablestats WHERE table_id = old.id;'),
+        # sessions
+        ('gamesession_stats_insert', u'AFTER INSERT ON gamesession', _session_row('new.id')),
+        ('gamesession_stats_update', u'AFTER UPDATE OF club_id ON gamesession',
+         u'UPDATE tablestats SET club_id = new.club_id WHERE session_id = new.id; '
+         u'UPDATE sessionstats SET club_id = new.club_id WHERE session_id = new.id;'),
+        ('gamesession_stats_delete', u'AFTER DELETE ON gamesession',
+         u'UPDATE tablestats SET club_id = NULL WHERE session_id = old.id; '
+         u'DELETE FROM sessionstats WHERE session_id = old.id;'),
+        # the rollups of the rollups
+        ('tablestats_insert', u'AFTER INSERT ON tablestats', _table_rollups('new', '+')),
+        ('tablestats_update', u'AFTER UPDATE ON tablestats',
+         _table_rollups('old', '-') + u' ' + _table_rollups('new', '+')),
+        ('tablestats_delete', u'AFTER DELETE ON tablestats', _table_rollups('old', '-')),
+        ('gamersessionstats_insert', u'AFTER INSERT ON gamersessionstats WHEN new.tables > 0',
+         _session_row('new.session_id') + u' UPDATE sessionstats SET gamers = gamers + 1 '
+         u'WHERE session_id = new.session_id;'),
+        ('gamersessionstats_update', u'AFTER UPDATE OF tables ON gamersessionstats '
+         u'WHEN (old.tables > 0) != (new.tables > 0)',
+         _session_row('new.session_id') + u' UPDATE sessionstats SET gamers = gamers '
+         u'+ (new.tables > 0) - (old.tables > 0) WHERE session_id = new.session_id;'),
+        ('gamersessionstats_delete', u'AFTER DELETE ON gamersessionstats WHEN old.tables > 0',
+         u'UPDATE sessionstats SET gamers = gamers - 1 WHERE session_id = old.session_id;'),
+    ]
+    return [u'CREATE TRIGGER IF NOT EXISTS %s %s BEGIN %s END' % trigger for trigger in triggers]
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_stats_triggers(target, connection, **kw):
+    """ Creates the triggers of the rollups with the tables, when missing.
+        New rollups of existing data must be filled (see upgrade_schema).
+    """
+    if connection.dialect.name == 'sqlite':
+        for statement in stats_ddl():
+            connection.execute(statement)
+
+
+def fill_stats(connection):
+    """ Recomputes every rollup from the attendances, through a connection
+        or a session. Returns the number of rows of the rollups.
+    """
+    for table in reversed(STATS_TABLES):
+        connection.execute(u'DELETE FROM %s' % table)
+    seated = SEATED.format(row='attendance')
+    connection.execute(_insert('tablestats',
+        u'SELECT gametable.id, gametable.session_id, gamesession.club_id, gametable.game_id, '
+        u'gametable.min_part, gametable.max_part, '
+        u'(SELECT count(*) FROM attendance WHERE attendance.table_id = gametable.id AND %s) '
+        u'FROM gametable LEFT JOIN gamesession ON gamesession.id = gametable.session_id' % seated, False))
+    connection.execute(_insert('gamersessionstats',
+        u'SELECT attendance.gamer_id, gametable.session_id, count(*) '
+        u'FROM attendance JOIN gametable ON gametable.id = attendance.table_id '
+        u'WHERE %s AND gametable.session_id IS NOT NULL '
+        u'GROUP BY attendance.gamer_id, gametable.session_id' % seated, False))
+    # the triggers of the rows inserted above filled these : start again
+    connection.execute(u'DELETE FROM clubgamestats')
+    connection.execute(u'DELETE FROM sessionstats')
+    sums = u', '.join(u'coalesce(sum(%s), 0)' % term.format(row='tablestats') for column, term in SESSION_TERMS)
+    connection.execute(_insert('sessionstats',
+        u'SELECT gamesession.id, gamesession.club_id, coalesce(gamers.count, 0), %s '
+        u'FROM gamesession LEFT JOIN tablestats ON tablestats.session_id = gamesession.id '
+        u'LEFT JOIN (SELECT session_id, count(*) AS count FROM gamersessionstats WHERE tables > 0 '
+        u'GROUP BY session_id) AS gamers ON gamers.session_id = gamesession.id '
+        u'GROUP BY gamesession.id' % sums, False))
+    sums = u', '.join(u'sum(%s)' % term.format(row='tablestats') for column, term in CLUB_GAME_TERMS)
+    connection.execute(_insert('clubgamestats',
+        u'SELECT club_id, game_id, %s FROM tablestats '
+        u'WHERE club_id IS NOT NULL AND game_id IS NOT NULL GROUP BY club_id, game_id' % sums, False))
+    return sum(connection.execute(u'SELECT count(*) FROM %s' % table).scalar() for table in STATS_TABLES)
+
+
+def rebuild_stats(session):
+    """ Recomputes every rollup and commits. Returns the number of rows. """
+    count = fill_stats(session)
+    session.commit()
+    return count
+
+
+def stats_snapshot(session):
+    """ {rollup table: sorted rows}, without the rows holding no data """
+    snapshot = {}
+    for table in STATS_TABLES:
+        sql = u'SELECT * FROM %s' % table
+        if table in EMPTY_ROWS:
+            sql += u' WHERE NOT (%s)' % EMPTY_ROWS[table]
+        snapshot[table] = sorted(tuple(row) for row in session.execute(sql))
+    return snapshot
+
+
+def check_stats(session):
+    """ The differences between the rollups and a full recomputation, as
+        (table, row, 'missing' or 'extra') : 'missing' rows are only in the
+        recomputation. Nothing is changed : the recomputation is rolled back.
+    """
+    session.commit()
+    current = stats_snapshot(session)
+    try:
+        fill_stats(session)
+        expected = stats_snapshot(session)
+    finally:
+        session.rollback()
+    differences = []
+    for table in STATS_TABLES:
+        rows, expected_rows = set(current[table]), set(expected[table])
+        differences.extend((table, row, 'missing') for row in sorted(expected_rows - rows))
+        differences.extend((table, row, 'extra') for row in sorted(rows - expected_rows))
+    return differences
+
+
+def club_stats(session, club_id, games=10, sessions=20):
+    """ The most played games of a club, its last sessions with their
+        attendance and the totals over all its sessions, from the rollups
+    """
+    club = session.query(Club).get(club_id)
+    if club is None:
+        return None
+    top_games = session.query(Game, ClubGameStats.plays, ClubGameStats.tables)\
+        .join(ClubGameStats, ClubGameStats.game_id == Game.id)\
+        .filter(ClubGameStats.club_id == club_id, ClubGameStats.plays > 0)\
+        .order_by(ClubGameStats.plays.desc(), ClubGameStats.tables.desc(), Game.id)\
+        .limit(games).all()
+    last_sessions = session.query(GameSession, SessionStats)\
+        .join(SessionStats, SessionStats.session_id == GameSession.id)\
+        .filter(GameSession.club_id == club_id)\
+        .order_by(GameSession.begin.desc())\
+        .limit(sessions).all()
+    totals = session.query(func.count(SessionStats.session_id),
+                           func.coalesce(func.sum(SessionStats.seats), 0),
+                           func.coalesce(func.sum(SessionStats.capacity), 0),
+                           func.coalesce(func.sum(SessionStats.full_tables), 0),
+                           func.coalesce(func.sum(SessionStats.short_tables), 0))\
+        .filter(SessionStats.club_id == club_id).one()
+    return ClubStats(club, top_games, last_sessions, SessionTotals(*totals))
+
+
+def gamer_history(session, gamer_id, limit=50):
+    """ The last sessions where a gamer was seated, with the number of
+        tables, as HistoryEntry
+    """
+    rows = session.query(GameSession, Club, GamerSessionStats.tables)\
+        .join(GamerSessionStats, GamerSessionStats.session_id == GameSession.id)\
+        .outerjoin(Club, Club.id == GameSession.club_id)\
+        .filter(GamerSessionStats.gamer_id == gamer_id, GamerSessionStats.tables > 0)\
+        .order_by(GameSession.begin.desc())\
+        .limit(limit)
+    return [HistoryEntry(*row) for row in rows]
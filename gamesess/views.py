@@ -0,0 +1,271 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" The pages of the site : clubs, sessions, tables, games and search """
+import hmac
+from functools import wraps
+from math import isinf, isnan
+
+from flask import Blueprint, current_app, g
+from flask import render_template, redirect, request, url_for, flash, abort
+from flask import Response, stream_with_context
+from flask.ext.login import current_user, login_required
+
+from gamesess.models import Club, Game, GameSession
+from gamesess.models import ATTENDANCE_WAITLIST
+from gamesess.forms import SeatForm, ImageForm
+from gamesess.extensions import db, response_cache, live_hub, image_store
+from gamesess.services import public_clubs_page, gamer_clubs_page, nearby_clubs_page, session_agenda, club_overview
+from gamesess.services import game_family, game_ancestors, table_seats
+from gamesess.booking import join_table, leave_table
+from gamesess.schedule import signup_conflicts
+from gamesess.search import search
+from gamesess.services import last_change, clubs_sources, club_sources, session_sources, game_sources
+from gamesess.services import club_export_sources, club_managers, may_edit_game, is_club_member
+from gamesess.stats import club_stats, gamer_history
+from gamesess.export import club_ical, club_json, feed_token
+from gamesess.conditional import conditional
+
+main = Blueprint('main', __name__)
+
+# tags of the cached views, see ResponseCache
+CLUB_TAGS = ('club', 'gamerclub', 'gamer')
+AGENDA_TAGS = ('gamesession', 'gametable', 'attendance', 'game', 'gamer')
+
+@main.route('/')
+@response_cache.cached(vary_user=True)
+def home():
+    return render_template('home.html')
+
+@main.route('/about')
+def about():
+    return str(current_user)+'Auth:'+str(current_user.is_authenticated)+'About Flask Game Club Sessions'
+
+@main.route('/clubs')
+@login_required
+@conditional(lambda: last_change(db.session, *clubs_sources()))
+@response_cache.cached(tags=CLUB_TAGS)
+def clubs_list():
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    if latitude is not None and longitude is not None:
+        max_radius = current_app.config['NEARBY_RADIUS']
+        radius = request.args.get('radius', max_radius, type=float)
+        # float() accepts 'nan' and 'inf' (out of the ranges for the coordinates)
+        if isnan(radius) or isinf(radius) or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            abort(400)
+        radius = min(radius, max_radius)
+        page, distances = nearby_clubs_page(db.session, latitude, longitude, max(radius, 0),
+                                            per_page=current_app.config['CLUBS_PER_PAGE'])
+        return render_template('club_list.html', clubs=page.items, distances=distances,
+                               radius=radius)
+    page = public_clubs_page(db.session,
+                             after=request.args.get('after', type=int),
+                             per_page=current_app.config['CLUBS_PER_PAGE'])
+    return render_template('club_list.html', clubs=page.items,
+                           next_url=page.next_after and url_for('.clubs_list', after=page.next_after))
+
+@main.route('/myclubs')
+@login_required
+@response_cache.cached(tags=CLUB_TAGS, vary_user=True)
+def user_clubs_list():
+    page = gamer_clubs_page(db.session, current_user.id,
+                            after=request.args.get('after', type=int),
+                            per_page=current_app.config['CLUBS_PER_PAGE'])
+    return render_template('club_list.html', clubs=page.items,
+                           next_url=page.next_after and url_for('.user_clubs_list', after=page.next_after))
+
+@main.route('/club/<int:club_id>/')
+@login_required
+@conditional(lambda club_id: last_change(db.session, *club_sources(club_id)), daily=True)
+def club_details(club_id):
+    overview = club_overview(db.session, club_id)
+    if overview is None:
+        abort(404)
+    token = is_club_member(db.session, club_id, current_user.id) and \
+        feed_token(current_app.config['SECRET_KEY'], club_id) or None
+    return render_template('club.html', overview=overview, form=ImageForm(), feed_token=token)
+
+@main.route('/club/<int:club_id>/stats')
+@login_required
+def club_statistics(club_id):
+    managers = club_managers(db.session, [club_id])[club_id]
+    if current_user.id not in [manager.id for manager in managers]:
+        abort(403)
+    stats = club_stats(db.session, club_id)
+    if stats is None:
+        abort(404)
+    return render_template('club_stats.html', stats=stats)
+
+@main.route('/club/<int:club_id>/logo', methods=['POST'])
+@login_required
+def club_logo(club_id):
+    managers = club_managers(db.session, [club_id])[club_id]
+    if current_user.id not in [manager.id for manager in managers]:
+        abort(403)
+    club = db.session.query(Club).get(club_id)
+    if club is None:
+        abort(404)
+    name = _store_image()
+    if name is not None:
+        club.logo = name
+        club.modify_id = current_user.id
+        db.session.commit()
+    return redirect(url_for('.club_details', club_id=club_id))
+
+@main.route('/myhistory')
+@login_required
+def user_history():
+    return render_template('history.html', history=gamer_history(db.session, current_user.id))
+
+def _feed_access(view):
+    """ The feeds of a public club are open to all, those of a private club
+        to its members and to the requests bearing its feed token. The
+        gamers attending are only told to the members.
+    """
+    @wraps(view)
+    def wrapper(club_id):
+        club = db.session.query(Club).filter_by(id=club_id, active=True).first()
+        if club is None:
+            abort(404)
+        member = current_user.is_authenticated and is_club_member(db.session, club_id, current_user.id)
+        if not (club.public or member):
+            token = request.args.get('token', u'').encode('utf-8')
+            if not hmac.compare_digest(token, feed_token(current_app.config['SECRET_KEY'], club_id)):
+                if not current_user.is_authenticated:
+                    return current_app.login_manager.unauthorized()
+                abort(403)
+        g.feed_club, g.feed_member = club, member
+        return view(club_id=club_id)
+    return wrapper
+
+def _club_export(chunks, mimetype):
+    # the rows are read while the response is sent, within the request
+    return Response(stream_with_context(chunks), mimetype=mimetype)
+
+@main.route('/club/<int:club_id>/sessions.ics')
+@_feed_access
+@conditional(lambda club_id: last_change(db.session, *club_export_sources(club_id)))
+def club_calendar(club_id):
+    return _club_export(club_ical(db.session, g.feed_club), 'text/calendar')
+
+@main.route('/club/<int:club_id>/export.json')
+@_feed_access
+@conditional(lambda club_id: last_change(db.session, *club_export_sources(club_id)))
+def club_export(club_id):
+    return _club_export(club_json(db.session, g.feed_club, gamer_ids=g.feed_member), 'application/json')
+
+@main.route('/session/<int:session_id>/')
+@main.route('/soiree/<int:session_id>/')
+@main.route('/weekend/<int:session_id>/')
+@conditional(lambda session_id: last_change(db.session, *session_sources(session_id)))
+@response_cache.cached(tags=AGENDA_TAGS)
+def session_details(session_id):
+    agenda = session_agenda(db.session, session_id)
+    if agenda is None:
+        abort(404)
+    return render_template('session.html', agenda=agenda)
+
+@main.route('/session/<int:session_id>/live')
+def session_live(session_id):
+    if db.session.query(GameSession.id).filter_by(id=session_id).first() is None:
+        abort(404)
+    # no request context nor database connection is held while streaming
+    response = Response(live_hub.stream(session_id, request.headers.get('Last-Event-ID', type=int)),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@main.route('/table/<int:table_id>/')
+def table_details(table_id):
+    seats = table_seats(db.session, table_id,
+                        current_user.is_authenticated and current_user.id or None)
+    if seats is None:
+        abort(404)
+    return render_template('table.html', seats=seats, form=SeatForm())
+
+@main.route('/table/<int:table_id>/join', methods=['POST'])
+@login_required
+def table_join(table_id):
+    if not SeatForm().validate_on_submit():
+        abort(400)
+    status = join_table(db.session, table_id, current_user.id)
+    if status is None:
+        abort(404)
+    if status == ATTENDANCE_WAITLIST:
+        flash('The table is full : you are on the waiting list.')
+    for table in signup_conflicts(db.session, current_user.id, table_id):
+        flash(u'This table overlaps %s (%s - %s).' % (
+            table, table.begin.strftime('%d/%m %H:%M'), table.end.strftime('%H:%M')))
+    return redirect(url_for('.table_details', table_id=table_id))
+
+@main.route('/table/<int:table_id>/leave', methods=['POST'])
+@login_required
+def table_leave(table_id):
+    if not SeatForm().validate_on_submit():
+        abort(400)
+    leave_table(db.session, table_id, current_user.id)
+    return redirect(url_for('.table_details', table_id=table_id))
+
+@main.route('/gamer/<int:gamer_id>/')
+@login_required
+def gamer_details(gamer_id):
+    return 'Details on gamer %i' % gamer_id
+
+@main.route('/game/<int:game_id>/')
+@conditional(lambda game_id: last_change(db.session, *game_sources(game_id)))
+def game_details(game_id):
+    family = game_family(db.session, game_id)
+    if family is None:
+        abort(404)
+    may_edit = current_user.is_authenticated and may_edit_game(db.session, family.game, current_user.id)
+    return render_template('game.html', game=family.game, family=family,
+                           ancestors=game_ancestors(db.session, game_id), form=ImageForm(),
+                           may_edit=may_edit)
+
+@main.route('/game/<int:game_id>/image', methods=['POST'])
+@login_required
+def game_image(game_id):
+    game = db.session.query(Game).get(game_id)
+    if game is None:
+        abort(404)
+    if not may_edit_game(db.session, game, current_user.id):
+        abort(403)
+    name = _store_image()
+    if name is not None:
+        game.image = name
+        game.modify_id = current_user.id
+        db.session.commit()
+    return redirect(url_for('.game_details', game_id=game_id))
+
+@main.route('/search')
+def search_results():
+    query = request.args.get('q', u'')
+    try:
+        hits = search(db.session, query, kind=request.args.get('kind') or None,
+                      limit=current_app.config['SEARCH_RESULTS'])
+    except ValueError:
+        abort(400)
+    return render_template('search.html', query=query, hits=hits)
+
+def _store_image():
+    """ Stores the image of an ImageForm and queues its resizing : its
+        name, None for a file refused
+    """
+    form = ImageForm()
+    if not form.validate_on_submit():
+        abort(400)
+    try:
+        name = image_store.save(form.image.data.stream)
+    except ValueError as error:
+        flash(u'%s' % error)
+        return None
+    image_store.submit(name)
+    return name
+
+@main.route('/get_image/<variant>/<name>')
+def get_image(variant, name):
+    response = image_store.send(variant, name)
+    if response is None:
+        abort(404)
+    return response
@@ -0,0 +1,11 @@
+#!/usr.bin/python
+# -*- coding: utf-8 -*-
+""" The application of the WSGI servers, e.g. gunicorn -w 4 --preload gamesess.wsgi:app
+
+    Production settings unless GAMESESS_ENV says otherwise.
+"""
+import os
+
+from gamesess.app import create_app
+
+app = create_app(os.environ.get('GAMESESS_ENV') or 'production')
@@ -1,8 +1,824 @@
+import re
+import sys
+
+from flask import current_app
 from flask.ext.script import Manager
-from gamesess.app import app
+from gamesess.app import create_app
+from gamesess.extensions import db, response_cache
+
+# the commands run within the application built for the chosen environment
+manager = Manager(create_app)
+manager.add_option('-e', '--env', dest='config_name', required=False,
+                   help='development (default), testing or production')
+
+def echo(text):
+    """ print for the reports with names in them : a pipe has no encoding,
+        print would encode them as ASCII
+    """
+    if isinstance(text, unicode):
+        text = text.encode(sys.stdout.encoding or 'utf-8', 'replace')
+    print(text)
+
+@manager.command
+def upgrade_db():
+    """ Add the missing tables, columns and indexes to an existing database """
+    from gamesess.schema import upgrade_schema
+    applied = upgrade_schema(db.engine)
+    for statement in applied:
+        print(statement)
+    print('%i change(s) applied' % len(applied))
+
+@manager.command
+def clear_cache():
+    """ Empty the response cache """
+    response_cache.backend.clear()
+
+@manager.command
+def rebuild_player_counts():
+    """ Recompute the indexed player counts of every game from Game.parts """
+    from gamesess.services import rebuild_player_counts
+    for name in rebuild_player_counts(db.session):
+        print(u'Invalid number of players for %s' % name)
+
+@manager.command
+def rebuild_seat_counts():
+    """ Recompute the seat counter of every table from its seated attendances """
+    from gamesess.booking import rebuild_seat_counts
+    fixed = rebuild_seat_counts(db.session)
+    response_cache.invalidate('gametable')
+    print('%i table(s) fixed' % len(fixed))
+
+@manager.command
+def rebuild_search_index():
+    """ Refill the full-text search index from the games, clubs and sessions """
+    from gamesess.search import rebuild_search
+    print('%i entries indexed' % rebuild_search(db.session))
+
+@manager.option('-d', '--days', dest='days', type=int, default=None)
+def materialize_sessions(days):
+    """ Create the game sessions of the club rules over the coming days (SESSION_HORIZON) """
+    from datetime import datetime, timedelta
+    from gamesess.recurrence import materialize_sessions
+    days = days or current_app.config['SESSION_HORIZON']
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    until = today + timedelta(days=days)
+    created = materialize_sessions(db.session, until, today)
+    response_cache.invalidate('gamesession')
+    print('%i session(s) created from %i rule(s) up to %s' % (
+        sum(created.values()), len(created), until.strftime('%Y-%m-%d')))
+
+@manager.command
+def rebuild_stats():
+    """ Recompute the statistics rollups from the attendances """
+    from gamesess.stats import rebuild_stats
+    print('%i rollup rows' % rebuild_stats(db.session))
+
+@manager.command
+def check_stats():
+    """ Compare the statistics rollups with a full recomputation, without changing them """
+    from gamesess.stats import check_stats
+    differences = check_stats(db.session)
+    for table, row, kind in differences[:50]:
+        print('%s %s : %r' % (kind, table, row))
+    print('%i difference(s)' % len(differences))
+    if differences:
+        sys.exit(1)
+
+@manager.command
+def compile_templates():
+    """ Compile every template into the bytecode cache (TEMPLATE_CACHE_DIR) before starting the workers """
+    env = current_app.jinja_env
+    if env.bytecode_cache is None:
+        print('No TEMPLATE_CACHE_DIR : the templates are compiled by each worker')
+        sys.exit(1)
+    names = env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    for name in names:
+        env.get_template(name)
+    print('%i template(s) compiled into %s' % (len(names), current_app.config['TEMPLATE_CACHE_DIR']))
+
+@manager.command
+def check_indexes():
+    """ Check with EXPLAIN QUERY PLAN that every hot query uses an index """
+    from gamesess.schema import hot_queries, explain_query_plan, plan_uses_index
+    failures = 0
+    for name, query in hot_queries(db.session):
+        details = explain_query_plan(db.session, query)
+        ok = plan_uses_index(details)
+        if not ok:
+            failures += 1
+        print('%-20s %s  %s' % (name, ok and 'OK  ' or 'FAIL', ' | '.join(details)))
+    if failures:
+        sys.exit(1)
+
+@manager.option('-g', '--gamer', dest='gamer_id', type=int, default=None)
+@manager.option('-n', '--requests', dest='requests', type=int, default=20)
+def check_user_cache(gamer_id, requests):
+    """ Count the gamer queries and identity cache hits over authenticated requests """
+    from sqlalchemy import event
+    from gamesess.models import Gamer
+    from gamesess.identity import identity_cache
+    if gamer_id is None:
+        gamer_id = db.session.query(Gamer.id).filter_by(active=True).order_by(Gamer.id).first()[0]
+    statements = []
+    def count_gamer_selects(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('SELECT') and re.search(r'FROM gamer\b', statement):
+            statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count_gamer_selects)
+    client = current_app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = unicode(gamer_id)
+        sess['_fresh'] = True
+    for i in range(requests):
+        client.get('/clubs')
+    event.remove(db.engine, 'before_cursor_execute', count_gamer_selects)
+    print('%i requests on /clubs, %i gamer queries, cache %r' % (
+        requests, len(statements), identity_cache.stats()))
+
+@manager.option('-n', '--requests', dest='requests', type=int, default=20)
+@manager.option('-p', '--profile', dest='profile', action='store_true', default=False)
+@manager.option('-u', '--url', dest='url', default=None)
+def report_metrics(requests, profile, url):
+    """ Per endpoint timings and SQL of a running server (--url of its /metrics) or of replayed requests """
+    import time
+    import urllib2
+    from gamesess.models import Gamer, Club, GameSession, GameTable, Game
+    from gamesess.metrics import instrumentation, parse_prometheus
+    if url:
+        scrape = urllib2.Request(url)
+        if current_app.config.get('METRICS_TOKEN'):
+            scrape.add_header('Authorization', 'Bearer %s' % current_app.config['METRICS_TOKEN'])
+        metrics = parse_prometheus(urllib2.urlopen(scrape).read())
+    else:
+        gamer_id = db.session.query(Gamer.id).filter_by(active=True).order_by(Gamer.id).first()[0]
+        paths = ['/', '/clubs', '/myclubs', '/search?q=a']
+        for model, path in ((Club, '/club/%i/'), (GameSession, '/session/%i/'),
+                            (GameTable, '/table/%i/'), (Game, '/game/%i/')):
+            first = db.session.query(model.id).order_by(model.id).first()
+            if first:
+                paths.append(path % first[0])
+        client = current_app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = unicode(gamer_id)
+            sess['_fresh'] = True
+        def replay():
+            start = time.time()
+            for i in range(requests):
+                for path in paths:
+                    client.get(path)
+            return time.time() - start
+        replay()
+        plain = replay()
+        instrumentation.enable()
+        instrumentation.reset()
+        if profile:
+            instrumentation.profiler.start()
+        instrumented = replay()
+        instrumentation.profiler.stop()
+        metrics = parse_prometheus(instrumentation.prometheus())
+        print('%i requests : %.2f ms/request without instrumentation, %.2f ms/request with it' % (
+            requests * len(paths), plain * 1000 / (requests * len(paths)),
+            instrumented * 1000 / (requests * len(paths))))
+    print('%-20s %8s %10s %10s %8s %10s %6s' % ('endpoint', 'requests', 'ms/req', 'render ms',
+                                               'sql/req', 'sql ms', 'N+1'))
+    for endpoint, values in sorted(metrics.items(), key=lambda item: -item[1]['request_seconds_sum']):
+        count = values['request_seconds_count'] or 1
+        print('%-20s %8i %10.2f %10.2f %8.1f %10.2f %6i' % (
+            endpoint, values['request_seconds_count'], values['request_seconds_sum'] * 1000 / count,
+            values['render_seconds_total'] * 1000 / count, values['sql_statements_total'] / count,
+            values['sql_seconds_total'] * 1000 / count, values['n_plus_one_total']))
+    if not url:
+        for endpoint, stats in instrumentation.snapshot():
+            if stats.repeated:
+                print('N+1 in %s : %i x %s' % (endpoint, stats.repeated[0], stats.repeated[1]))
+        if profile:
+            samples = instrumentation.profiler.samples.most_common(10)
+            for stack, count in samples:
+                frames = stack.split(';')
+                print('%5i %s ... %s' % (count, frames[0], ';'.join(frames[-3:])))
+
+@manager.option('-c', '--clubs', dest='clubs', type=int, default=20)
+@manager.option('-g', '--gamers', dest='gamers', type=int, default=500)
+@manager.option('-s', '--sessions', dest='sessions', type=int, default=10, help='per club')
+@manager.option('-t', '--tables', dest='tables', type=int, default=8, help='per session')
+@manager.option('-G', '--games', dest='games', type=int, default=300)
+@manager.option('-a', '--attendances', dest='attendances', type=int, default=4, help='per table')
+@manager.option('-n', '--requests', dest='requests', type=int, default=2000)
+@manager.option('-w', '--workers', dest='workers', type=int, default=4)
+@manager.option('-C', '--concurrency', dest='concurrency', type=int, default=8)
+@manager.option('-o', '--output', dest='output', default=None, help='save the results as JSON')
+@manager.option('-b', '--baseline', dest='baseline', default=None, help='JSON results to compare with')
+@manager.option('--tolerance', dest='tolerance', type=float, default=0.25)
+@manager.option('-f', '--file', dest='path', default='/tmp/gamesess_bench_site.db')
+def bench_site(clubs, gamers, sessions, tables, games, attendances, requests, workers, concurrency,
+               output, baseline, tolerance, path):
+    """ Load test of the routes on a synthetic site : latency percentiles, throughput and queries
+        (manage.py -e production bench_site ... measures the deployed settings)
+    """
+    import glob
+    import os
+    from gamesess.bench import memory_session, seed_site
+    from gamesess.loadtest import request_plan, run_client, serve, stop, run_http, environment
+    from gamesess.loadtest import save_results, load_results, compare_results
+    for name in glob.glob(path + '*'):
+        os.remove(name)
+    seeding = memory_session('sqlite:///' + path)
+    counts = seed_site(seeding, clubs, gamers, sessions, tables, games, attendances)
+    seeding.close()
+    seeding.get_bind().dispose()
+    db.use_database(current_app, 'sqlite:///' + path)
+    plan = request_plan(counts, requests)
+    settings = dict((key, current_app.config[key]) for key in sorted(current_app.config)
+                    if key.startswith(('SQLALCHEMY_POOL', 'SQLITE_', 'CACHE_BACKEND', 'DB_', 'METRICS_',
+                                       'PASSWORD_', 'TEMPLATE', 'DEBUG')))
+    results = {'scale': counts, 'requests': requests, 'environment': environment(settings), 'phases': {}}
+    response_cache.backend.clear()
+    results['phases']['client'] = run_client(current_app, plan)
+    # the workers start with an empty cache and no database connection
+    response_cache.backend.clear()
+    db.session.remove()
+    db.dispose(current_app)
+    port, processes = serve(current_app._get_current_object(), workers)
+    try:
+        results['phases']['server'] = run_http(port, plan, concurrency, workers=workers)
+    finally:
+        stop(processes)
+    print(', '.join('%i %s' % (count, table) for table, count in sorted(counts.items())))
+    for phase in ('client', 'server'):
+        summary = results['phases'][phase]
+        print('%s : %i requests in %.1f s, %.1f requests/s' % (
+            phase == 'client' and 'test client, 1 at a time' or
+            'HTTP, %i workers, %i clients' % (workers, concurrency),
+            summary['requests'], summary['seconds'], summary['throughput']))
+        print('  %-10s %6s %6s %9s %9s %9s %8s' % ('route', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                  'queries'))
+        for name, route in sorted(summary['routes'].items()):
+            print('  %-10s %6i %6i %9.2f %9.2f %9.2f %8s' % (
+                name, route['count'], route['errors'], route['p50_ms'], route['p95_ms'], route['p99_ms'],
+                route['queries'] is None and '-' or '%.1f' % route['queries']))
+        for error in summary.get('client_errors', ()):
+            print('  %s' % error)
+    db.dispose(current_app)
+    for name in glob.glob(path + '*'):
+        os.remove(name)
+    if output:
+        save_results(output, results)
+        print('Results saved to %s' % output)
+    if baseline:
+        problems = compare_results(load_results(baseline), results, tolerance)
+        for problem in problems:
+            print(problem)
+        print('%i regression(s) against %s' % (len(problems), baseline))
+        if problems:
+            sys.exit(1)
+
+@manager.option('-r', '--runs', dest='runs', type=int, default=5)
+@manager.option('-p', '--path', dest='path', default='/login')
+@manager.option('-c', '--command', dest='commands', action='append', default=None,
+                help='manage.py command to time, repeatable (default clear_cache)')
+def bench_startup(runs, path, commands):
+    """ Time from a new process to its first requests, per environment, and of manage.py commands """
+    import os
+    import shutil
+    from gamesess.bench import startup_times, command_time, STARTUP_STEPS
+    root = os.path.dirname(os.path.abspath(__file__))
+    directory = current_app.config['TEMPLATE_CACHE_DIR']
+    print('%-24s %s %9s' % ('median ms', ' '.join('%14s' % step for step in STARTUP_STEPS), 'total'))
+    for config_name, label, cold in (('development', 'development', False),
+                                     ('production', 'production, cold cache', True),
+                                     ('production', 'production', False)):
+        measures = []
+        for i in range(runs):
+            if cold and directory and os.path.isdir(directory):
+                shutil.rmtree(directory)
+            measures.append(startup_times(config_name, path, root))
+        steps = [sorted(values)[len(values) // 2] for values in zip(*measures)]
+        totals = sorted(sum(values) for values in measures)
+        print('%-24s %s %9.0f' % (label, ' '.join('%14.1f' % step for step in steps),
+                                  totals[len(totals) // 2]))
+    for command in commands or ['clear_cache']:
+        durations = sorted(command_time(command.split(), root) for i in range(runs))
+        print('manage.py %-14s %9.0f ms' % (command, durations[len(durations) // 2]))
+
+@manager.option('-t', '--tables', dest='tables', type=int, default=500)
+@manager.option('-a', '--attendances', dest='attendances', type=int, default=5000)
+@manager.option('-r', '--runs', dest='runs', type=int, default=10)
+def bench_agenda(tables, attendances, runs):
+    """ Query count and latency of the session agenda on synthetic data """
+    from gamesess.bench import QueryCounter, memory_session, seed_agenda, timed
+    from gamesess.services import session_agenda
+    session = memory_session()
+    session_id = seed_agenda(session, tables, attendances)
+    with QueryCounter(session.get_bind()) as counter:
+        agenda = session_agenda(session, session_id)
+    durations = sorted(timed(lambda: session_agenda(session, session_id), runs))
+    print('%i tables, %i attendances : %i queries, min %.1f ms, median %.1f ms, max %.1f ms' % (
+        len(agenda.tables), sum(len(entry.attendees) for entry in agenda.tables),
+        counter.count, durations[0], durations[len(durations) // 2], durations[-1]))
+
+@manager.option('-d', '--depth', dest='depth', type=int, default=90)
+@manager.option('-w', '--width', dest='width', type=int, default=2000)
+def check_game_family(depth, width):
+    """ Check the recursive game family queries on a deep and a wide synthetic tree """
+    from gamesess.bench import QueryCounter, memory_session, seed_game_trees
+    from gamesess.services import game_family, game_ancestors
+    session = memory_session()
+    deep_root, deep_leaf, wide_root = seed_game_trees(session, depth, width)
+    def count_nodes(node):
+        return 1 + sum(count_nodes(child) for child in node.children)
+    def tree_depth(node):
+        return 1 + max([tree_depth(child) for child in node.children] or [0])
+    with QueryCounter(session.get_bind()) as counter:
+        deep = game_family(session, deep_root)
+        ancestors = game_ancestors(session, deep_leaf)
+        wide = game_family(session, wide_root)
+    checks = [
+        ('deep tree depth', tree_depth(deep), depth),
+        ('deep leaf ancestors', len(ancestors), depth - 1),
+        ('ancestors start at the root', ancestors and ancestors[0].id, deep_root),
+        ('wide tree nodes', count_nodes(wide), width + 1),
+        ('queries', counter.count, 3),
+    ]
+    failures = 0
+    for label, value, expected in checks:
+        ok = value == expected
+        failures += not ok
+        print('%-28s %-6s %s (expected %s)' % (label, ok and 'OK' or 'FAIL', value, expected))
+    if failures:
+        sys.exit(1)
+
+@manager.option('path', help='.csv, .jsonl or .json file')
+@manager.option('kind', choices=('gamers', 'clubs', 'members', 'games'))
+@manager.option('-b', '--batch', dest='batch_size', type=int, default=1000)
+@manager.option('-p', '--processes', dest='processes', type=int, default=None,
+                help='password hashing processes (default: one per CPU)')
+def import_data(kind, path, batch_size, processes):
+    """ Bulk import gamers, clubs, club members or games from a file """
+    from gamesess.importer import BulkImporter, read_rows
+    importer = BulkImporter(db.session, batch_size=batch_size, processes=processes)
+    inserted, skipped, seconds = importer.run(kind, read_rows(path))
+    for error in importer.errors:
+        print(error)
+    response_cache.invalidate('gamer', 'club', 'gamerclub', 'game')
+    print('%i %s imported, %i skipped in %.1f s (%.0f rows/s)' % (
+        inserted, kind, skipped, seconds, (inserted + skipped) / max(seconds, 0.001)))
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=4)
+@manager.option('-s', '--seconds', dest='seconds', type=int, default=5)
+@manager.option('-f', '--file', dest='path', default='/tmp/gamesess_bench_writes.db')
+def bench_writes(workers, seconds, path):
+    """ Writes/sec of parallel writer processes, default vs tuned SQLite engine """
+    from gamesess.bench import bench_writes
+    for tuned in (False, True):
+        writes, errors, rate = bench_writes(path, current_app.config, workers, seconds, tuned)
+        print('%-8s %i workers : %i writes, %i "database is locked", %.0f writes/s' % (
+            tuned and 'tuned' or 'default', workers, writes, errors, rate))
+
+@manager.option('session_id', type=int)
+def check_schedule(session_id):
+    """ Report the tables outside of a session and the overlapping bookings """
+    from gamesess.models import Gamer
+    from gamesess.schedule import session_schedule
+    report = session_schedule(db.session, session_id)
+    if report is None:
+        print('Unknown session %i' % session_id)
+        sys.exit(1)
+    for table in report.outside:
+        echo(u'%s (%s - %s) is outside of the session' % (table, table.begin, table.end))
+    gamer_ids = set(conflict.gamer_id for conflict in report.conflicts)
+    gamers = dict((gamer.id, gamer) for gamer in
+                  db.session.query(Gamer).filter(Gamer.id.in_(gamer_ids))) if gamer_ids else {}
+    for conflict in report.conflicts:
+        echo(u'%s : %s overlaps %s' % (gamers.get(conflict.gamer_id, conflict.gamer_id),
+                                       report.tables[conflict.first_id], report.tables[conflict.second_id]))
+    print('%i table(s) outside of the session, %i conflict(s)' % (
+        len(report.outside), len(report.conflicts)))
+
+@manager.option('-t', '--tables', dest='tables', type=int, default=400)
+@manager.option('-g', '--gamers', dest='gamers', type=int, default=300)
+@manager.option('-b', '--bookings', dest='bookings', type=int, default=8)
+def bench_schedule(tables, gamers, bookings):
+    """ Conflict report of a synthetic week-end : sweep vs pairwise comparison """
+    from gamesess.bench import QueryCounter, memory_session, seed_convention, pairwise_conflicts, timed
+    from gamesess.schedule import session_schedule
+    session = memory_session()
+    session_id = seed_convention(session, tables, gamers, bookings)
+    with QueryCounter(session.get_bind()) as counter:
+        report = session_schedule(session, session_id)
+    sweep = min(timed(lambda: session_schedule(session, session_id), 3))
+    rows = [(gamer_id, table_id, table.begin, table.end)
+            for gamer_id, table_id in session.execute('SELECT gamer_id, table_id FROM attendance')
+            for table in [report.tables[table_id]]]
+    pairwise = min(timed(lambda: pairwise_conflicts(rows), 1))
+    same = (set((c.gamer_id, frozenset((c.first_id, c.second_id))) for c in report.conflicts) ==
+            set((c.gamer_id, frozenset((c.first_id, c.second_id))) for c in pairwise_conflicts(rows)))
+    print('%i tables, %i bookings : %i outside, %i conflicts in %i queries' % (
+        tables, len(rows), len(report.outside), len(report.conflicts), counter.count))
+    print('report %.1f ms (SQL + sweep), pairwise comparison %.1f ms, same conflicts : %s' % (
+        sweep, pairwise, same and 'OK' or 'FAIL'))
+    if not same:
+        sys.exit(1)
+
+@manager.option('session_id', type=int)
+@manager.option('-a', '--apply', dest='apply', action='store_true', default=False)
+@manager.option('-l', '--time-limit', dest='time_limit', type=float, default=5.0)
+def allocate_tables(session_id, apply, time_limit):
+    """ Place the gamers of a session at the tables they wish (dry run without --apply) """
+    from gamesess.allocation import allocate_session, apply_allocation
+    allocation = allocate_session(db.session, session_id, time_limit)
+    for table_id, gamer_ids in sorted(allocation.assignments.items()):
+        print('Table %i : gamers %s' % (table_id, ', '.join(str(gamer_id) for gamer_id in gamer_ids)))
+    for table_id in sorted(allocation.closed):
+        print('Table %i : not enough players' % table_id)
+    placed = sum(len(gamer_ids) for gamer_ids in allocation.assignments.values())
+    print('%i wish(es) granted, %i not granted' % (placed, len(allocation.unsatisfied)))
+    if apply:
+        try:
+            apply_allocation(db.session, allocation)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        response_cache.invalidate('gametable', 'attendance')
+        print('Allocation applied')
+
+@manager.option('-t', '--tables', dest='tables', type=int, default=200)
+@manager.option('-g', '--gamers', dest='gamers', type=int, default=1000)
+@manager.option('-w', '--wishes', dest='wishes', type=int, default=3)
+def bench_allocation(tables, gamers, wishes):
+    """ Table allocation of a synthetic week-end : greedy pass vs local search """
+    import time
+    from gamesess.allocation import AllocationSolver, session_problem
+    from gamesess.bench import memory_session, seed_wishes, check_allocation, allocation_bound
+    session = memory_session()
+    session_id = seed_wishes(session, tables, gamers, wishes)
+    problem = session_problem(session, session_id)
+    print('%i tables, %i gamers, %i wishes : at most %i can be granted' % (
+        tables, gamers, len(problem[1]), allocation_bound(problem[0], problem[1])))
+    failures = 0
+    for name, time_limit in (('greedy', 0), ('search', 10.0)):
+        start = time.time()
+        allocation = AllocationSolver(*problem, time_limit=time_limit).solve(session_id)
+        elapsed = time.time() - start
+        problems = check_allocation(problem[0], problem[1], problem[2], allocation)
+        failures += len(problems)
+        for message in problems[:10]:
+            print(message)
+        placed = sum(len(gamer_ids) for gamer_ids in allocation.assignments.values())
+        print('%-7s %i wishes granted, %i table(s) closed, %.0f ms, %s' % (
+            name, placed, len(allocation.closed), elapsed * 1000, problems and 'FAIL' or 'OK'))
+    if failures:
+        sys.exit(1)
+
+@manager.option('-g', '--games', dest='games', type=int, default=100000)
+def bench_search(games):
+    """ Full-text search over a synthetic catalog vs a LIKE scan of the game names """
+    import time
+    from gamesess.models import Game
+    from gamesess.bench import memory_session, seed_catalog, timed
+    from gamesess.search import search
+    session = memory_session()
+    start = time.time()
+    seed_catalog(session, games)
+    print('%i games inserted and indexed in %.1f s' % (games, time.time() - start))
+    for query in (u'aventuriers rail', u'liege', u'CHATEAU foret', u'dra', u'ile pirates 42'):
+        hits = search(session, query)
+        fts = min(timed(lambda: search(session, query), 5))
+        words = query.split()
+        like = session.query(Game.id).filter(*[Game.name.like(u'%%%s%%' % word) for word in words]).limit(20)
+        scan = min(timed(lambda: like.all(), 3))
+        echo(u'%-18s %2i hits, first : %-32s search %.2f ms, LIKE scan %.2f ms' % (
+            query, len(hits), hits and hits[0].title or u'-', fts, scan))
+
+@manager.option('-c', '--clubs', dest='clubs', type=int, default=100000)
+def bench_nearby(clubs):
+    """ Clubs near a point through the R*Tree vs a haversine scan of every club """
+    import time
+    from gamesess.bench import memory_session, seed_geo_clubs, scan_nearby, timed
+    from gamesess.geo import GEO_TABLE, bounding_boxes, candidates, nearby_clubs, nearest_clubs
+    session = memory_session()
+    start = time.time()
+    seed_geo_clubs(session, clubs)
+    indexed = session.execute('SELECT count(*) FROM %s' % GEO_TABLE).scalar()
+    print('%i clubs inserted, %i indexed in %.1f s' % (clubs, indexed, time.time() - start))
+    failures = 0
+    points = ((u'Paris', 48.857, 2.352), (u'Liege', 50.633, 5.567), (u'Marseille', 43.296, 5.370),
+              (u'Brest', 48.390, -4.486), (u'Strasbourg', 48.573, 7.752))
+    for name, latitude, longitude in points:
+        for radius in (5, 25, 100):
+            hits = nearby_clubs(session, latitude, longitude, radius)
+            expected = scan_nearby(session, latitude, longitude, radius)
+            same = [hit.club_id for hit in hits] == [hit.club_id for hit in expected]
+            failures += not same
+            boxed = len(candidates(session, bounding_boxes(latitude, longitude, radius)))
+            rtree = min(timed(lambda: nearby_clubs(session, latitude, longitude, radius, 20), 5))
+            scan = min(timed(lambda: scan_nearby(session, latitude, longitude, radius, 20), 3))
+            print(u'%-10s %3i km : %5i clubs of %6i candidates, R*Tree %7.2f ms, scan %7.1f ms, %s' % (
+                name, radius, len(hits), boxed, rtree, scan, same and 'same' or 'DIFFERENT'))
+        nearest = min(timed(lambda: nearest_clubs(session, latitude, longitude, 20), 5))
+        print(u'%-10s 20 nearest clubs : %.2f ms' % (name, nearest))
+    if failures:
+        sys.exit(1)
+
+@manager.option('-c', '--clubs', dest='clubs', type=int, default=20)
+@manager.option('-s', '--sessions', dest='sessions', type=int, default=150)
+@manager.option('-n', '--changes', dest='changes', type=int, default=2000)
+def bench_stats(clubs, sessions, changes):
+    """ Statistics rollups : maintained through random changes vs recomputed, and dashboard timings """
+    import time
+    from gamesess.bench import memory_session, seed_site, mutate_site, live_club_stats, timed
+    from gamesess.stats import check_stats, club_stats, fill_stats
+    session = memory_session()
+    start = time.time()
+    counts = seed_site(session, clubs=clubs, gamers=2000, sessions=sessions, tables=8, games=500)
+    print('%i sessions, %i tables, %i attendances inserted in %.1f s (rollups included)' % (
+        counts['gamesession'], counts['gametable'], counts['attendance'], time.time() - start))
+    start = time.time()
+    done = mutate_site(session, counts, changes)
+    print('%i changes in %.1f s : %s' % (changes, time.time() - start,
+                                        ', '.join('%s %i' % item for item in sorted(done.items()))))
+    differences = check_stats(session)
+    for table, row, kind in differences[:20]:
+        print('%s %s : %r' % (kind, table, row))
+    print('incremental vs full rebuild : %i difference(s)' % len(differences))
+    rebuild = min(timed(lambda: (fill_stats(session), session.rollback()), 3))
+    rollups = min(timed(lambda: club_stats(session, 1), 10))
+    live = min(timed(lambda: live_club_stats(session, 1), 5))
+    stats = club_stats(session, 1)
+    print('club 1 : top game %s, %i sessions ; dashboard from the rollups %.2f ms, joins %.1f ms, '
+          'full rebuild %.0f ms' % (stats.games and stats.games[0][1] or 0, stats.totals.sessions,
+                                    rollups, live, rebuild))
+    if differences:
+        sys.exit(1)
+
+@manager.option('-p', '--processes', dest='processes', type=int, default=None,
+                help='resizing processes, one per CPU by default')
+def make_thumbnails(processes):
+    """ Make the missing resized variants of every stored image """
+    from gamesess.extensions import image_store
+    made = failed = 0
+    for name, variants, error in image_store.make_missing(processes):
+        if error:
+            failed += 1
+            print(u'%s : %s' % (name, error))
+        made += len(variants)
+    print('%i variant(s) made, %i image(s) failed' % (made, failed))
+    if failed:
+        sys.exit(1)
+
+@manager.option('-i', '--images', dest='images', type=int, default=20)
+@manager.option('-n', '--requests', dest='requests', type=int, default=500, help='per client')
+@manager.option('-w', '--workers', dest='workers', type=int, default=2)
+@manager.option('-C', '--concurrency', dest='concurrency', type=int, default=4)
+def bench_images(images, requests, workers, concurrency):
+    """ Image variants made by the worker pool, then served from the disk cache over HTTP """
+    import shutil
+    import tempfile
+    import time
+    from gamesess.bench import seed_images, fetch_images
+    from gamesess.extensions import image_store
+    from gamesess.images import ORIGINAL, VARIANTS
+    from gamesess.loadtest import serve, stop
+    image_store.root = tempfile.mkdtemp(prefix='gamesess_bench_images')
+    try:
+        start = time.time()
+        names = seed_images(image_store, images)
+        print('%i images stored in %.1f s' % (images, time.time() - start))
+        # before the resizing : the originals, never resized by a request
+        db.dispose(current_app)
+        port, processes = serve(current_app._get_current_object(), workers)
+        try:
+            pending = ['/get_image/thumb/%s' % name for name in names]
+            received, seconds, statuses = fetch_images(port, pending, len(pending), 1)
+            print('thumb before resizing : %s, %.0f KiB each' % (
+                statuses, received / 1024.0 / len(pending)))
+            start = time.time()
+            made = sum(len(variants) for name, variants, error in image_store.make_missing())
+            print('%i variants made in %.2f s (%.0f ms per image)' % (
+                made, time.time() - start, (time.time() - start) * 1000.0 / images))
+            phases = [(variant, variant, names, {}) for variant in sorted(VARIANTS) + [ORIGINAL]]
+            phases.append(('original range', ORIGINAL, names, {'Range': 'bytes=0-65535'}))
+            phases.append(('revalidation', ORIGINAL, names[:1],
+                           {'If-None-Match': '"%s-%s"' % (ORIGINAL, names[0])}))
+            failed = False
+            for phase, variant, phase_names, headers in phases:
+                paths = ['/get_image/%s/%s' % (variant, name) for name in phase_names]
+                received, seconds, statuses = fetch_images(port, paths, requests, concurrency, headers)
+                count = sum(statuses.values())
+                failed = failed or [status for status in statuses if status not in (200, 206, 304)]
+                print('%-15s %6i requests %s : %8.1f req/s, %8.1f MiB/s' % (
+                    phase, count, statuses, count / seconds, received / seconds / 1048576.0))
+        finally:
+            stop(processes)
+    finally:
+        shutil.rmtree(image_store.root)
+    if failed:
+        sys.exit(1)
+
+@manager.option('-s', '--sessions', dest='sessions', type=int, default=20000)
+@manager.option('-f', '--file', dest='path', default='/tmp/gamesess_bench_export.db')
+def bench_export(sessions, path):
+    """ Memory of the streamed club exports vs loading the history with .all() """
+    import os
+    import time
+    from gamesess.models import Club, GameSession, GameTable, Attendance
+    from gamesess.bench import memory_session, seed_club_history, max_rss
+    from gamesess.export import club_ical, club_json
+    if os.path.exists(path):
+        os.remove(path)
+    session = memory_session('sqlite:///' + path)
+    club_id = seed_club_history(session, sessions)
+    club = session.query(Club).get(club_id)
+    for name, export in (('ics', club_ical), ('json', club_json)):
+        before, start, size = max_rss(), time.time(), 0
+        for chunk in export(session, club):
+            size += len(chunk)
+        print('%-5s streamed %.1f MiB in %.1f s, peak memory +%.1f MiB' % (
+            name, size / 1048576.0, time.time() - start, max_rss() - before))
+    before, start = max_rss(), time.time()
+    rows = (session.query(GameSession).filter_by(club_id=club_id).all() +
+            session.query(GameTable).join(GameSession, GameTable.session_id == GameSession.id)
+            .filter(GameSession.club_id == club_id).all() +
+            session.query(Attendance).all())
+    print('.all() loaded %i objects in %.1f s, peak memory +%.1f MiB' % (
+        len(rows), time.time() - start, max_rss() - before))
+    session.close()
+    os.remove(path)
+
+@manager.option('-n', '--subscribers', dest='subscribers', type=int, default=2000)
+@manager.option('-e', '--events', dest='events', type=int, default=50)
+@manager.option('-c', '--channels', dest='channels', type=int, default=10)
+def bench_live(subscribers, events, channels):
+    """ Fan-out of the live updates : idle cost and delivery latency of many subscribers """
+    from gamesess.bench import bench_live
+    idle, latencies, expected = bench_live(subscribers, events, channels)
+    print('%i subscribers on %i channels : %.3f CPU s/s while idle' % (subscribers, channels, idle))
+    if latencies:
+        print('%i/%i events delivered, latency median %.1f ms, p99 %.1f ms, max %.1f ms' % (
+            len(latencies), expected, latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)], latencies[-1]))
+    if len(latencies) != expected:
+        sys.exit(1)
+
+@manager.option('-t', '--threads', dest='threads', type=int, default=16)
+@manager.option('-n', '--requests', dest='requests', type=int, default=3000)
+@manager.option('-s', '--seats', dest='seats', type=int, default=5)
+@manager.option('-f', '--file', dest='path', default='/tmp/gamesess_stress_seats.db')
+def stress_seats(threads, requests, seats, path):
+    """ Concurrent join/leave requests : check that no table is ever overbooked """
+    from gamesess.bench import stress_seats
+    done, errors, rate, problems = stress_seats(path, current_app.config, threads, requests, seats=seats)
+    for problem in problems:
+        print(problem)
+    print('%i threads : %i requests, %i "database is locked", %.0f requests/s, %s' % (
+        threads, done, errors, rate, problems and 'FAIL' or 'no overbooking'))
+    if problems or errors:
+        sys.exit(1)
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='worker processes, JOB_WORKERS by default')
+@manager.option('-d', '--drain', dest='drain', action='store_true', default=False,
+                help='stop when no job is left instead of waiting for more')
+def run_jobs(workers, drain):
+    """ Run the deferred jobs (mails, rebuilds) in worker processes until interrupted """
+    from multiprocessing import Queue
+    from gamesess.jobs import start_workers
+    db.dispose(current_app)
+    reports = Queue()
+    processes = start_workers(current_app._get_current_object(), workers or current_app.config['JOB_WORKERS'],
+                              drain, reports)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # the workers finish their current job
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    print_worker_reports(reports)
+
+def print_worker_reports(reports):
+    """ The jobs of each worker that ended, from the queue given to start_workers """
+    from Queue import Empty
+    while True:
+        try:
+            number, jobs, seconds, stats = reports.get(timeout=0.1)
+        except Empty:
+            break
+        echo(u'worker %i : %i jobs in %.1f s, %s' % (number, jobs, seconds, stats))
+
+@manager.command
+def job_stats():
+    """ Jobs per kind and state, retries, latency and throughput """
+    from gamesess.jobs import queue_stats
+    print('%-16s %8s %8s %8s %8s %8s %10s %10s %10s' % (
+        'kind', 'pending', 'running', 'done', 'failed', 'retries', 'mean s', 'max s', 'jobs/s'))
+    for stats in queue_stats(db.session):
+        print('%-16s %8i %8i %8i %8i %8i %10s %10s %10s' % (
+            stats.kind, stats.pending, stats.running, stats.done, stats.failed, stats.retries,
+            stats.mean_latency is None and '-' or '%.2f' % stats.mean_latency,
+            stats.max_latency is None and '-' or '%.2f' % stats.max_latency,
+            stats.throughput is None and '-' or '%.1f' % stats.throughput))
+
+@manager.option('-d', '--days', dest='days', type=int, default=None, help='JOB_RETENTION by default')
+def purge_jobs(days):
+    """ Delete the jobs done for more than JOB_RETENTION days """
+    from datetime import datetime, timedelta
+    from gamesess.jobs import purge_jobs
+    days = current_app.config['JOB_RETENTION'] if days is None else days
+    print('%i job(s) deleted' % purge_jobs(db.session, datetime.now() - timedelta(days=days)))
+
+@manager.option('-p', '--port', dest='port', type=int, default=8025)
+def smtp_sink(port):
+    """ Local SMTP server printing the mails instead of sending them (SMTP_PORT of the development) """
+    import time
+    from gamesess.bench import SmtpSink
+    sink = SmtpSink(port, echo=True)
+    sink.start()
+    print('SMTP stand-in listening on 127.0.0.1:%i' % sink.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sink.stop()
 
-manager = Manager(app)
-app.config['DEBUG'] = True # Enable debugger
+@manager.option('-s', '--sessions', dest='sessions', type=int, default=5, help='per club, 20 clubs')
+@manager.option('-w', '--workers', dest='workers', type=int, default=2)
+@manager.option('-r', '--refused', dest='refused', type=int, default=20,
+                help='mails refused first by the SMTP stand-in (retried)')
+@manager.option('-d', '--delay', dest='delay', type=float, default=5.0, help='DIGEST_DELAY, seconds')
+@manager.option('-f', '--file', dest='path', default='/tmp/gamesess_bench_jobs.db')
+def bench_jobs(sessions, workers, refused, delay, path):
+    """ Mails of cancelled then confirmed sessions through the job workers and a local SMTP stand-in """
+    import glob
+    import os
+    import time
+    from multiprocessing import Queue
+    from sqlalchemy import distinct, func
+    from gamesess.bench import memory_session, seed_site, SmtpSink
+    from gamesess.jobs import start_workers, queue_stats
+    from gamesess.models import Gamer, GameSession, GameTable, Attendance, Notification, Job
+    for name in glob.glob(path + '*'):
+        os.remove(name)
+    seeding = memory_session('sqlite:///' + path)
+    counts = seed_site(seeding, clubs=20, gamers=2000, sessions=sessions, tables=8, games=300)
+    seeding.close()
+    seeding.get_bind().dispose()
+    db.use_database(current_app, 'sqlite:///' + path)
+    attendees = db.session.query(Attendance)\
+        .join(GameTable, Attendance.table_id == GameTable.id)\
+        .filter(GameTable.session_id != None, Attendance.active == True)
+    attendances = attendees.count()
+    gamers = attendees.join(Gamer, Attendance.gamer_id == Gamer.id)\
+        .filter(Gamer.email != None).with_entities(func.count(distinct(Attendance.gamer_id))).scalar()
+    print('%i sessions, %i tables, %i attendances of %i gamers' % (
+        counts['gamesession'], counts['gametable'], attendances, gamers))
+    sink = SmtpSink(failures=refused)
+    sink.start()
+    current_app.config.update(SMTP_HOST='127.0.0.1', SMTP_PORT=sink.port, DIGEST_DELAY=delay, JOB_BACKOFF=0.05,
+                              JOB_MAX_BACKOFF=0.5, JOB_POLL_INTERVAL=0.05)
+    failures = 0
+    try:
+        # the sessions of seed_site are confirmed
+        for state in (u'cancel', u'confirmed'):
+            start = time.time()
+            for game_session in db.session.query(GameSession):
+                game_session.state = state
+            db.session.commit()
+            queued = db.session.query(Job).filter_by(kind='session_state', state='pending').count()
+            print('%s : %i jobs queued with the changes in %.2f s' % (state, queued, time.time() - start))
+            received = len(sink.messages)
+            db.session.remove()
+            db.dispose(current_app)
+            start = time.time()
+            reports = Queue()
+            for process in start_workers(current_app._get_current_object(), workers, drain=True, reports=reports):
+                process.join()
+            print_worker_reports(reports)
+            seconds = time.time() - start
+            mails = sink.messages[received:]
+            recipients = set(recipient for sender, recipients, data in mails for recipient in recipients)
+            print('%s : %i mails to %i gamers in %.2f s including the %.1f s of DIGEST_DELAY '
+                  '(%.1f attendances per mail)' % (state, len(mails), len(recipients), seconds, delay,
+                                                    attendances / float(max(len(mails), 1))))
+            failures += len(recipients) != gamers
+        unsent = db.session.query(Notification).filter_by(sent=None).count()
+        print('%i mails refused by the SMTP stand-in and retried, %i notifications unsent' % (sink.refused, unsent))
+        failures += unsent
+        for error, count in db.session.query(Job.error, func.count()).filter(Job.error != None).group_by(Job.error):
+            print('%4i x %s' % (count, error))
+        print('%-16s %8s %8s %8s %10s %10s' % ('kind', 'done', 'failed', 'retries', 'mean s', 'jobs/s'))
+        for stats in queue_stats(db.session):
+            print('%-16s %8i %8i %8i %10.3f %10.1f' % (
+                stats.kind, stats.done, stats.failed, stats.retries, stats.mean_latency or 0, stats.throughput or 0))
+            failures += stats.failed + stats.pending + stats.running
+    finally:
+        sink.stop()
+        db.session.remove()
+        db.dispose(current_app)
+        for name in glob.glob(path + '*'):
+            os.remove(name)
+    if failures:
+        sys.exit(1)
 
 if __name__ == '__main__':
     manager.run()